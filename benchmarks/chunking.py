@@ -0,0 +1,64 @@
+import argparse
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from langchain.text_splitter import CharacterTextSplitter
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "llm_searcher"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from clean_text import load_markdown, DEFAULT_PDFS_LOCATION  # noqa: E402
+from src.PdfReader import clean_text  # noqa: E402
+from src.chunking import split_markdown, chunk_texts, count_tokens, ENCODING_NAME  # noqa: E402
+from src.embeddings import CHUNK_OVERLAP  # noqa: E402
+
+
+def legacy_split(text: str, max_tokens: int) -> list:
+    splitter = CharacterTextSplitter.from_tiktoken_encoder(
+        encoding_name=ENCODING_NAME, chunk_size=max_tokens, chunk_overlap=CHUNK_OVERLAP, separator=' ',
+    )
+    return splitter.split_text(clean_text(text))
+
+
+def markdown_split(text: str, max_tokens: int) -> list:
+    return chunk_texts(text, split_markdown(text, max_tokens, CHUNK_OVERLAP))
+
+
+def measure(split, documents: dict, max_tokens: int) -> dict:
+    begin = time.perf_counter()
+    chunks = [chunk for text in documents.values() for chunk in split(text, max_tokens)]
+    elapsed = time.perf_counter() - begin
+    tokens = count_tokens(chunks)
+    return {
+        "seconds": elapsed,
+        "chunks": len(chunks),
+        "mean_tokens": sum(tokens) / max(len(chunks), 1),
+        "fill": sum(tokens) / max(len(chunks) * max_tokens, 1),
+        "max_tokens": max(tokens, default=0),
+        "headings_at_start": sum(chunk.startswith("#") for chunk in chunks),
+    }
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare the markdown chunker with the previous text splitter")
+    parser.add_argument("--pdfs", default=str(DEFAULT_PDFS_LOCATION))
+    parser.add_argument("--parse_cache", default=str(Path(tempfile.gettempdir()) / "llm_searcher_parse_cache"))
+    parser.add_argument("--max_tokens", type=int, nargs="+", default=[256, 1024])
+    args = parser.parse_args()
+
+    documents = load_markdown(Path(args.pdfs), args.parse_cache)
+    megabytes = sum(len(text) for text in documents.values()) / 2 ** 20
+
+    for max_tokens in args.max_tokens:
+        for (name, split) in (("legacy", legacy_split), ("markdown", markdown_split)):
+            result = measure(split, documents, max_tokens)
+            print(f"{max_tokens} tokens, {name}: {result['chunks']} chunks, "
+                  f"{result['mean_tokens']:.0f} mean / {result['max_tokens']} max tokens ({result['fill']:.0%} full), "
+                  f"{result['headings_at_start']} start at a heading, "
+                  f"{megabytes / result['seconds']:.2f} MiB/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+import argparse
+import random
+import re
+import sys
+import time
+import tempfile
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "llm_searcher"))
+
+from src.PdfReader import clean_text, clean_text_chunks, file_hash, read_file, ParseCache  # noqa: E402
+
+
+DEFAULT_PDFS_LOCATION = Path(__file__).resolve().parent.parent / "docs" / "perovskite"
+
+
+def legacy_clean_text(text: str, fix_none: bool = False) -> str:
+    if fix_none:
+        text = re.sub(r"(?<=\|)[ \t]*None[ \t]*(?=\|)", "", text)
+    text = re.sub(r"[\n]+", r"\n", text)
+    text = re.sub(r"[ |]+", r" ", text)
+    text = re.sub(r"\n+\s+", r"\n", text)
+    text = re.sub(r"\s+\n+", r"\n", text)
+    if not fix_none:
+        text = re.sub(r"None", r"", text)
+    return text
+
+
+def load_markdown(pdfs_location: Path, cache_location: str) -> dict:
+    cache = ParseCache(cache_location)
+    documents = {}
+    for path in sorted(pdfs_location.glob("*.pdf")):
+        hash_ = file_hash(path)
+        text = cache.get(hash_)
+        if text is None:
+            print(f"Parsing {path.name}", file=sys.stderr)
+            text = read_file(path)
+            with open(cache.path_for(hash_), "w", encoding="utf8") as file:
+                file.write(text)
+        documents[path.name] = text
+    return documents
+
+
+def best_time(func, text: str, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        func(text)
+        times.append(time.perf_counter() - begin)
+    return min(times)
+
+
+def split_randomly(text: str, rng: random.Random) -> list:
+    cuts = sorted(rng.sample(range(len(text)), min(len(text), 64)))
+    return [text[begin:end] for begin, end in zip([0] + cuts, cuts + [len(text)])]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare clean_text with the previous regex cleaner")
+    parser.add_argument("--pdfs", default=str(DEFAULT_PDFS_LOCATION))
+    parser.add_argument("--parse_cache", default=str(Path(tempfile.gettempdir()) / "llm_searcher_parse_cache"))
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+
+    documents = load_markdown(Path(args.pdfs), args.parse_cache)
+    rng = random.Random(0)
+
+    total_legacy, total_new = 0.0, 0.0
+    for name, text in documents.items():
+        # Synthetic empty table cells and prose "None" exercise the behaviour change
+        text = text + "\n|a|None|  None |b|\nNone of the samples degraded.\n"
+        expected = legacy_clean_text(text, fix_none=True)
+        assert clean_text(text) == expected, f"clean_text output differs for {name}"
+        assert "".join(clean_text_chunks(split_randomly(text, rng))) == expected, \
+            f"clean_text_chunks output differs for {name}"
+        assert "None of the samples" in expected and "None of the samples" not in legacy_clean_text(text)
+
+        legacy = best_time(legacy_clean_text, text, args.repeat)
+        new = best_time(clean_text, text, args.repeat)
+        total_legacy += legacy
+        total_new += new
+        print(f"{name}: {len(text)} chars, legacy {legacy * 1e3:.2f} ms, new {new * 1e3:.2f} ms, "
+              f"speedup {legacy / new:.1f}x")
+
+    print(f"total: legacy {total_legacy * 1e3:.2f} ms, new {total_new * 1e3:.2f} ms, "
+          f"speedup {total_legacy / total_new:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,228 @@
+import argparse
+import asyncio
+import json
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+import pymupdf
+from pandas import DataFrame
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "llm_searcher"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from stubs import HashEmbedder, ReplayChat  # noqa: E402
+from src import search  # noqa: E402
+from src.gradio import SearcherForGradio  # noqa: E402
+from src.EmbeddingStore import EmbeddingStore  # noqa: E402
+from src.embeddings import CHUNK_OVERLAP, normalize_embeddings  # noqa: E402
+from src.chunking import CHUNKER_NAME  # noqa: E402
+from src.MyRetriever import MyRetriever  # noqa: E402
+
+
+MAX_TOKENS = 64
+SESSION_REBUILD_S = 0.5
+
+
+def random_text(rng: random.Random, num_of_words: int) -> str:
+    return " ".join(
+        "".join(rng.choice("abcdefghijklmnopqrstuvwxyz") for _ in range(rng.randint(4, 9)))
+        for _ in range(num_of_words)
+    )
+
+
+def write_pdf(path: Path, text: str) -> None:
+    document = pymupdf.open()
+    page = document.new_page()
+    page.insert_textbox(page.rect + (36, 36, -36, -36), text, fontsize=9)
+    document.save(path)
+
+
+def slow_embedder(embedder_name, config) -> HashEmbedder:
+    # Stands in for the parsing and embedding of a rebuild, so running it on the event loop shows up as a stall
+    time.sleep(SESSION_REBUILD_S)
+    return HashEmbedder()
+
+
+def check_sessions(workdir: Path, rng: random.Random, num_of_documents: int) -> tuple:
+    # The memory budget fits one retriever, so the first session's searcher is evicted and rebuilt on its next question
+    search.get_embedder = slow_embedder
+    search.create_chat_model = lambda config: ReplayChat(None)
+    config = {}
+    for name in ("first", "second"):
+        folder = workdir / f"{name}_pdfs"
+        folder.mkdir()
+        for i in range(num_of_documents):
+            (folder / f"{name}{i}.txt").write_text(random_text(rng, 300), encoding="utf8")
+        config[name] = {
+            "database_location": str(workdir / f"{name}.csv"),
+            "pdfs_location": str(folder),
+            "max_num_of_tokens": MAX_TOKENS,
+            "searcher_cache_memory_mb": 1e-6,
+        }
+    sessions = SearcherForGradio(config, "first")
+    sessions.get_searcher("second")
+    cached = sessions.cache_stats("second")["registry"]["searchers"]
+
+    async def stream(searcher_name: str) -> tuple:
+        begin = time.perf_counter()
+        first_token_s, answer = None, ""
+        async for token in sessions.ask_question_stream("what is in the documents", searcher_name):
+            if first_token_s is None:
+                first_token_s = time.perf_counter() - begin
+            answer += token
+        return first_token_s, answer
+
+    async def heartbeat(stopped: asyncio.Event) -> float:
+        longest, last = 0.0, time.perf_counter()
+        while not stopped.is_set():
+            await asyncio.sleep(0.005)
+            now = time.perf_counter()
+            longest, last = max(longest, now - last), now
+        return longest
+
+    async def run() -> tuple:
+        stopped = asyncio.Event()
+        beat = asyncio.create_task(heartbeat(stopped))
+        rebuilt, other = await asyncio.gather(stream("first"), stream("second"))
+        stopped.set()
+        return rebuilt, other, await beat
+
+    (rebuild_s, rebuilt_answer), (other_first_token_s, other_answer), longest_stall_s = asyncio.run(run())
+    failures = []
+    if cached != ["second"]:
+        failures.append({"sessions": f"expected only the second searcher cached before the rebuild, got {cached}"})
+    if not rebuilt_answer or not other_answer:
+        failures.append({"sessions": "a session streamed an empty answer"})
+    if other_first_token_s >= rebuild_s or longest_stall_s >= rebuild_s / 4:
+        failures.append({"sessions": f"rebuilding a searcher for {rebuild_s:.2f}s stalled the event loop "
+                                     f"for {longest_stall_s:.2f}s"})
+    stats = {
+        "rebuild_first_token_s": rebuild_s,
+        "other_session_first_token_s": other_first_token_s,
+        "longest_event_loop_stall_s": longest_stall_s,
+    }
+    return stats, failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fire parallel queries while documents are uploaded")
+    parser.add_argument("--documents", type=int, default=50)
+    parser.add_argument("--uploads", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--session_documents", type=int, default=200)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    workdir = Path(tempfile.mkdtemp())
+    data = DataFrame({
+        "name": [f"doc{i}.pdf" for i in range(args.documents)],
+        "text": [random_text(rng, 300) for _ in range(args.documents)],
+    })
+    embedder = HashEmbedder()
+    store = EmbeddingStore(str(workdir / "store"), embedder.model_name, CHUNKER_NAME, MAX_TOKENS, CHUNK_OVERLAP)
+    retriever = MyRetriever(data, embedder, MAX_TOKENS, store=store)
+    retriever.set_num_of_relevant_chunks(3)
+
+    initial_chunks = list(retriever.snapshot.data["text"].values)
+    upload_paths = []
+    for i in range(args.uploads):
+        path = workdir / f"upload{i}.pdf"
+        write_pdf(path, random_text(rng, 200))
+        upload_paths.append(path)
+
+    failures = []
+    snapshots = set()
+    lock = threading.Lock()
+    uploading = threading.Event()
+    uploading.set()
+
+    def upload():
+        try:
+            for path in upload_paths:
+                retriever.add_document(path)
+        finally:
+            uploading.clear()
+
+    def check_rows(i: int, snapshot, result: DataFrame) -> list:
+        # Every row must come from the snapshot the query started on, with its own vector at the same position
+        data, vector_index, _ = snapshot
+        positions = result.index.values
+        if len(positions) and (positions.max() >= len(data) or positions.max() >= len(vector_index)):
+            return [{"query": i, "positions": positions.tolist(), "snapshot_chunks": len(data)}]
+        if list(data["text"].values[positions]) != list(result["text"].values):
+            return [{"query": i, "rows": "returned rows differ from the snapshot data"}]
+        expected_vectors = normalize_embeddings(embedder.embed_documents(list(result["text"].values)))
+        if not np.allclose(np.asarray(vector_index.embeddings[positions]), expected_vectors, atol=1e-5):
+            return [{"query": i, "rows": "returned rows do not match the snapshot vectors"}]
+        return []
+
+    def query(i: int) -> float:
+        expected = initial_chunks[i % len(initial_chunks)]
+        snapshot = retriever.snapshot
+        begin = time.perf_counter()
+        result = retriever.search_embeddings(retriever.embed_queries([expected]), None, [expected], snapshot)[0]
+        elapsed = time.perf_counter() - begin
+        problems = check_rows(i, snapshot, result)
+        if not len(result) or result["text"].values[0] != expected:
+            problems.append({"query": i, "got": list(result["text"].values[:1])})
+        with lock:
+            snapshots.add(id(snapshot))
+            failures.extend(problems)
+        return elapsed
+
+    counter = iter(range(sys.maxsize))
+
+    def worker() -> list:
+        latencies = []
+        while True:
+            i = next(counter)
+            if i >= args.queries and not uploading.is_set():
+                return latencies
+            latencies.append(query(i))
+
+    begin = time.perf_counter()
+    uploader = threading.Thread(target=upload)
+    uploader.start()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        latencies = [latency for result in executor.map(lambda _: worker(), range(args.threads)) for latency in result]
+    uploader.join()
+    elapsed = time.perf_counter() - begin
+
+    data, vector_index, lexical_index = retriever.snapshot
+    if len(data) != len(vector_index) or (lexical_index is not None and len(lexical_index) != len(data)):
+        failures.append({"snapshot": f"{len(data)} chunks but {len(vector_index)} vectors"})
+    for text in data["text"].values[len(initial_chunks):]:
+        result = retriever.search(text)
+        if result["text"].values[0] != text:
+            failures.append({"uploaded_chunk": text[:40]})
+
+    sessions, session_failures = check_sessions(workdir, rng, args.session_documents)
+    failures.extend(session_failures)
+
+    latencies = np.array(latencies) * 1000
+    print(json.dumps({
+        "queries": len(latencies),
+        "uploads": args.uploads,
+        "threads": args.threads,
+        "elapsed_s": elapsed,
+        "queries_per_s": len(latencies) / elapsed,
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+        "snapshots_seen": len(snapshots),
+        "chunks": len(data),
+        "sessions": sessions,
+        "failures": failures[:10],
+        "num_of_failures": len(failures),
+    }, indent=4))
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+import argparse
+import json
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from pandas import DataFrame
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "llm_searcher"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from clean_text import load_markdown, DEFAULT_PDFS_LOCATION  # noqa: E402
+from stubs import HashEmbedder, ReplayChat, clustered_embeddings, DEFAULT_ANSWERS_LOCATION  # noqa: E402
+from src.PdfReader import load_pdfs, clean_text  # noqa: E402
+from src.chunking import split_markdown, chunk_texts, count_tokens  # noqa: E402
+from src.embeddings import CHUNK_OVERLAP, normalize_embeddings  # noqa: E402
+from src.VectorIndex import create_vector_index, recall_at_k  # noqa: E402
+from src.LexicalIndex import BM25Index  # noqa: E402
+from src.MyRetriever import MyRetriever  # noqa: E402
+from src.search import Searcher  # noqa: E402
+
+
+ROOT = Path(__file__).resolve().parent.parent
+DEFAULT_QUESTIONS_LOCATION = ROOT / "docs" / "perovskite_questions.json"
+DEFAULT_RESULTS_LOCATION = Path(__file__).resolve().parent / "results"
+DEFAULT_SIZES = [1_000, 10_000, 100_000, 1_000_000]
+
+RETRIEVAL_VARIANTS = {
+    "flat_vector": {"vector_index": "flat", "retrieval": "vector"},
+    "ivf_vector": {"vector_index": "ivf", "retrieval": "vector"},
+    "flat_hybrid": {"vector_index": "flat", "retrieval": "hybrid"},
+    "ivf_hybrid": {"vector_index": "ivf", "retrieval": "hybrid"},
+}
+
+
+def latency_stats(latencies_s: list) -> dict:
+    latencies = np.asarray(latencies_s) * 1000
+    return {
+        "count": len(latencies),
+        "mean_ms": float(latencies.mean()),
+        "p50_ms": float(np.percentile(latencies, 50)),
+        "p95_ms": float(np.percentile(latencies, 95)),
+        "p99_ms": float(np.percentile(latencies, 99)),
+    }
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def timed(func, *args, **kwargs):
+    begin = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - begin
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True, check=True,
+        ).stdout.strip()
+    except Exception:
+        return "unknown"
+
+
+def measure_ingestion(args, embedder: HashEmbedder) -> tuple:
+    data, load_s = timed(
+        load_pdfs, args.pdfs, DataFrame(columns=["name", "text"]), cache_location=args.parse_cache,
+    )
+    raw = load_markdown(Path(args.pdfs), args.parse_cache)
+    _, clean_s = timed(lambda: [clean_text(text) for text in raw.values()])
+    megabytes = sum(len(text) for text in raw.values()) / 2 ** 20
+
+    texts = data["text"].astype(str).tolist()
+    boundaries, chunk_s = timed(lambda: [split_markdown(text, args.max_tokens, CHUNK_OVERLAP) for text in texts])
+    chunks = [chunk for (text, spans) in zip(texts, boundaries) for chunk in chunk_texts(text, spans)]
+    embeddings, embed_s = timed(lambda: normalize_embeddings(embedder.embed_documents(chunks)))
+
+    index_build_s = {}
+    for name in ("flat", "ivf"):
+        _, index_build_s[name] = timed(create_vector_index, embeddings, {"vector_index": name})
+    _, index_build_s["bm25"] = timed(BM25Index.build, chunks)
+
+    return data, {
+        "documents": len(texts),
+        "text_mib": megabytes,
+        "chunks": len(chunks),
+        "mean_chunk_tokens": float(np.mean(count_tokens(chunks))) if chunks else 0.0,
+        "load_pdfs_s": load_s,
+        "clean_text_mib_per_s": megabytes / max(clean_s, 1e-9),
+        "chunking_mib_per_s": megabytes / max(chunk_s, 1e-9),
+        "embedding_chunks_per_s": len(chunks) / max(embed_s, 1e-9),
+        "index_build_s": index_build_s,
+    }
+
+
+def measure_questions(args, data: DataFrame, embedder: HashEmbedder, questions: list) -> dict:
+    chat = ReplayChat(args.answers)
+    results, exact = {}, None
+    for (variant, index_config) in RETRIEVAL_VARIANTS.items():
+        retriever, build_s = timed(MyRetriever, data, embedder, args.max_tokens, index_config=index_config)
+        searcher = Searcher({"num_of_relevant_chunks": args.k}, retriever=retriever, chat_model=chat)
+
+        retrieval_latencies, answer_latencies, found = [], [], []
+        for question in questions:
+            chunks, retrieval_s = timed(searcher.retrieve, question)
+            _, answer_s = timed(searcher.answer, question, chunks)
+            retrieval_latencies.append(retrieval_s)
+            answer_latencies.append(retrieval_s + answer_s)
+            found.append(set(chunks["text_hash"].values))
+        exact = exact or found
+
+        results[variant] = {
+            "build_s": build_s,
+            "retrieval": latency_stats(retrieval_latencies),
+            "end_to_end": latency_stats(answer_latencies),
+            f"recall_at_{args.k}": sum(len(a & b) for (a, b) in zip(exact, found)) / max(sum(map(len, exact)), 1),
+        }
+        print(f"questions, {variant}: p50 {results[variant]['retrieval']['p50_ms']:.2f} ms, "
+              f"recall {results[variant][f'recall_at_{args.k}']:.3f}", file=sys.stderr)
+    return results
+
+
+def synthetic_texts(count: int, rng: np.random.Generator, words_per_chunk: int = 64) -> list:
+    vocabulary = np.array([f"w{i}" for i in range(50_000)])
+    words = vocabulary[np.minimum(rng.zipf(1.3, size=(count, words_per_chunk)) - 1, len(vocabulary) - 1)]
+    return [" ".join(row) for row in words]
+
+
+def measure_scaling(args) -> list:
+    rng = np.random.default_rng(0)
+    results = []
+    for size in args.sizes:
+        embeddings = clustered_embeddings(size, args.dim, max(size // 1000, 16))
+        queries = embeddings[rng.choice(size, min(args.queries, size), replace=False)]
+        queries = normalize_embeddings(queries + 0.05 * rng.standard_normal(queries.shape, dtype=np.float32))
+        result = {"chunks": size, "dim": args.dim, "embeddings_mb": embeddings.nbytes / 2 ** 20, "indexes": {}}
+
+        for name in ("flat", "ivf"):
+            index, build_s = timed(create_vector_index, embeddings, {"vector_index": name})
+            latencies = [timed(index.search, query, args.k)[1] for query in queries]
+            result["indexes"][name] = {
+                "build_s": build_s,
+                "search": latency_stats(latencies),
+                f"recall_at_{args.k}": recall_at_k(index, queries, args.k),
+            }
+            del index
+
+        if size <= args.lexical_max_chunks:
+            texts = synthetic_texts(size, rng)
+            index, build_s = timed(BM25Index.build, texts)
+            latencies = [timed(index.search, texts[i][:200], args.k)[1] for i in rng.choice(size, len(queries))]
+            result["indexes"]["bm25"] = {"build_s": build_s, "search": latency_stats(latencies), "mb": index.nbytes / 2 ** 20}
+            del index, texts
+
+        result["peak_rss_mb"] = peak_rss_mb()
+        results.append(result)
+        print(f"{size} chunks: flat p99 {result['indexes']['flat']['search']['p99_ms']:.2f} ms, "
+              f"ivf p99 {result['indexes']['ivf']['search']['p99_ms']:.2f} ms, "
+              f"ivf recall {result['indexes']['ivf'][f'recall_at_{args.k}']:.3f}, "
+              f"peak RSS {result['peak_rss_mb']:.0f} MB", file=sys.stderr)
+        del embeddings, queries
+    return results
+
+
+def flatten(result, prefix: str = "") -> dict:
+    if isinstance(result, dict):
+        return {key: value for (name, item) in result.items() for (key, value) in flatten(item, f"{prefix}{name}.").items()}
+    if isinstance(result, list):
+        return {key: value for (i, item) in enumerate(result) for (key, value) in flatten(item, f"{prefix}{i}.").items()}
+    return {prefix[:-1]: result} if isinstance(result, (int, float)) and not isinstance(result, bool) else {}
+
+
+def compare(previous: dict, current: dict) -> None:
+    before, after = flatten(previous), flatten(current)
+    for key in sorted(before.keys() & after.keys()):
+        if before[key] and (key.endswith("_s") or key.endswith("_ms") or "recall" in key or "per_s" in key):
+            change = after[key] / before[key] - 1
+            if abs(change) >= 0.1:
+                print(f"{key}: {before[key]:.4g} -> {after[key]:.4g} ({change:+.0%})")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Offline ingestion, retrieval and latency benchmark")
+    parser.add_argument("--pdfs", default=str(DEFAULT_PDFS_LOCATION))
+    parser.add_argument("--parse_cache", default=None, help="defaults to a fresh directory, so parsing is timed cold")
+    parser.add_argument("--questions", default=str(DEFAULT_QUESTIONS_LOCATION))
+    parser.add_argument("--answers", default=str(DEFAULT_ANSWERS_LOCATION), help="recorded answers replayed by the stub chat model")
+    parser.add_argument("--max_tokens", type=int, default=1024)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--lexical_max_chunks", type=int, default=100_000)
+    parser.add_argument("--skip_documents", action="store_true")
+    parser.add_argument("--output", default=None, help="defaults to results/<commit>.json")
+    parser.add_argument("--compare", default=None, help="earlier results file to diff against")
+    args = parser.parse_args()
+    args.parse_cache = args.parse_cache or tempfile.mkdtemp(prefix="llm_searcher_parse_cache")
+
+    results = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "arguments": {key: value for (key, value) in vars(args).items() if key not in ("output", "compare")},
+    }
+    if not args.skip_documents:
+        embedder = HashEmbedder(args.dim)
+        data, results["ingestion"] = measure_ingestion(args, embedder)
+        with open(args.questions, "r", encoding="utf8") as file:
+            questions = json.load(file)["questions"]
+        results["questions"] = measure_questions(args, data, embedder, questions)
+    results["scaling"] = measure_scaling(args)
+
+    output = Path(args.output) if args.output else DEFAULT_RESULTS_LOCATION / f"{results['commit']}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w", encoding="utf8") as file:
+        json.dump(results, file, indent=4)
+    print(f"Saved results to {output}", file=sys.stderr)
+
+    if args.compare:
+        with open(args.compare, "r", encoding="utf8") as file:
+            compare(json.load(file), results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+import argparse
+import json
+import sys
+import tempfile
+from pathlib import Path
+
+import numpy as np
+from pandas import DataFrame
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "llm_searcher"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from clean_text import DEFAULT_PDFS_LOCATION  # noqa: E402
+from end_to_end import DEFAULT_QUESTIONS_LOCATION, latency_stats, timed  # noqa: E402
+from stubs import HashEmbedder, clustered_embeddings  # noqa: E402
+from src.PdfReader import load_pdfs  # noqa: E402
+from src.embeddings import normalize_embeddings, CHUNK_OVERLAP  # noqa: E402
+from src.chunking import CHUNKER_NAME  # noqa: E402
+from src.EmbeddingStore import EmbeddingStore  # noqa: E402
+from src.MyRetriever import MyRetriever  # noqa: E402
+from src.VectorIndex import create_vector_index  # noqa: E402
+
+
+QUANTIZATIONS = ("float32", "float16", "int8")
+
+
+def recall(expected: list, found: list) -> float:
+    hits = sum(len(set(a) & set(b)) for (a, b) in zip(expected, found))
+    return hits / max(sum(len(a) for a in expected), 1)
+
+
+def measure_questions(args) -> dict:
+    data = load_pdfs(args.pdfs, DataFrame(columns=["name", "text"]), cache_location=args.parse_cache)
+    with open(args.questions, "r", encoding="utf8") as file:
+        questions = json.load(file)["questions"]
+    embedder = HashEmbedder(args.dim)
+    store_location = tempfile.mkdtemp()
+
+    results, exact = {}, None
+    for quantization in QUANTIZATIONS:
+        config = {"vector_index": args.index, "retrieval": "vector", "vector_quantization": quantization}
+        store = EmbeddingStore(store_location, embedder.model_name, CHUNKER_NAME, args.max_tokens, CHUNK_OVERLAP)
+        retriever = MyRetriever(data, embedder, args.max_tokens, store=store, index_config=config)
+        query_embeddings = retriever.embed_queries(questions)
+        latencies, found = [], []
+        for embedding in query_embeddings:
+            (_, ids), elapsed = timed(retriever.snapshot.vector_index.search, embedding, args.k)
+            latencies.append(elapsed)
+            found.append(ids[0].tolist())
+        exact = exact or found
+        results[quantization] = {
+            "chunks": len(retriever.snapshot.data),
+            "matrix_mb": retriever.snapshot.vector_index.nbytes / 2 ** 20,
+            "search": latency_stats(latencies),
+            f"recall_at_{args.k}": recall(exact, found),
+        }
+    return results
+
+
+def measure_synthetic(args, size: int) -> dict:
+    rng = np.random.default_rng(0)
+    embeddings = clustered_embeddings(size, args.dim, max(size // 1000, 16))
+    queries = embeddings[rng.choice(size, min(args.queries, size), replace=False)]
+    queries = normalize_embeddings(queries + 0.05 * rng.standard_normal(queries.shape, dtype=np.float32))
+
+    # Serve full precision rows from a memory map, as the embedding store does
+    path = Path(tempfile.mkdtemp()) / "embeddings.f32"
+    embeddings.tofile(path)
+    mapped = np.memmap(path, dtype=np.float32, mode="r", shape=embeddings.shape)
+    del embeddings
+
+    results, exact = {}, None
+    for quantization in QUANTIZATIONS:
+        config = {"vector_index": args.index, "vector_quantization": quantization, "rescore_factor": args.rescore_factor}
+        index, build_s = timed(create_vector_index, mapped, config)
+        latencies, found = [], []
+        for query in queries:
+            (_, ids), elapsed = timed(index.search, query, args.k)
+            latencies.append(elapsed)
+            found.append(ids[0].tolist())
+        exact = exact or found
+        results[quantization] = {
+            "build_s": build_s,
+            "resident_mb": (index.nbytes if index.quantized is not None else mapped.nbytes) / 2 ** 20,
+            "search": latency_stats(latencies),
+            f"recall_at_{args.k}": recall(exact, found),
+        }
+        print(f"{size} chunks, {quantization}: {results[quantization]['resident_mb']:.0f} MB, "
+              f"p50 {results[quantization]['search']['p50_ms']:.2f} ms, "
+              f"recall {results[quantization][f'recall_at_{args.k}']:.4f}", file=sys.stderr)
+        del index
+    del mapped
+    path.unlink()
+    return {"chunks": size, "dim": args.dim, "quantizations": results}
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare float32, float16 and int8 embedding matrices")
+    parser.add_argument("--pdfs", default=str(DEFAULT_PDFS_LOCATION))
+    parser.add_argument("--parse_cache", default=str(Path(tempfile.gettempdir()) / "llm_searcher_parse_cache"))
+    parser.add_argument("--questions", default=str(DEFAULT_QUESTIONS_LOCATION))
+    parser.add_argument("--max_tokens", type=int, default=256)
+    parser.add_argument("--index", choices=["flat", "ivf"], default="flat")
+    parser.add_argument("--rescore_factor", type=int, default=4)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--dim", type=int, default=768)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000])
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    results = {
+        "arguments": vars(args),
+        "questions": measure_questions(args),
+        "synthetic": [measure_synthetic(args, size) for size in args.sizes],
+    }
+    text = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as file:
+            file.write(text)
+    print(text)
+
+
+if __name__ == "__main__":
+    main()
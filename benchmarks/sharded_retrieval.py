@@ -0,0 +1,167 @@
+import argparse
+import hashlib
+import json
+import multiprocessing
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+from pandas import DataFrame
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "llm_searcher"))
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+from end_to_end import latency_stats, timed  # noqa: E402
+from stubs import HashEmbedder, clustered_embeddings  # noqa: E402
+from src.embeddings import normalize_embeddings  # noqa: E402
+from src.IndexSnapshot import write_snapshot, load_latest_snapshot  # noqa: E402
+from src.MyRetriever import MyRetriever  # noqa: E402
+from src.ShardedRetriever import ShardedRetriever, HttpShard, LocalShard, partition, shard_location  # noqa: E402
+from src.ShardServer import ShardServer  # noqa: E402
+from src.VectorIndex import create_vector_index  # noqa: E402
+
+
+CONFIG = {"retrieval": "vector"}
+
+
+class SlowShard(LocalShard):
+    def __init__(self, shard: LocalShard, delay_s: float):
+        super().__init__(shard.retriever, f"slow-{shard.name}")
+        self.delay_s = delay_s
+
+    def search(self, query_embeddings: np.ndarray, k: int):
+        time.sleep(self.delay_s)
+        return super().search(query_embeddings, k)
+
+
+def build_corpus(size: int, dim: int, num_of_documents: int) -> tuple:
+    embeddings = clustered_embeddings(size, dim, max(size // 1000, 16))
+    documents = np.arange(size) % num_of_documents
+    document_hashes = [hashlib.sha1(str(document).encode("utf8")).hexdigest() for document in range(num_of_documents)]
+    chunks = DataFrame({
+        "name": [f"document-{document}.pdf" for document in documents],
+        "chunk": np.arange(size) // num_of_documents,
+        "text": [f"chunk {row}" for row in range(size)],
+        "text_hash": [hashlib.sha1(f"chunk {row}".encode("utf8")).hexdigest() for row in range(size)],
+        "document_hash": [document_hashes[document] for document in documents],
+    })
+    return chunks, embeddings
+
+
+def write_shards(location: str, chunks: DataFrame, embeddings: np.ndarray, num_of_shards: int) -> list:
+    sizes = []
+    for (shard, rows) in enumerate(partition(chunks, num_of_shards)):
+        write_snapshot(
+            shard_location(location, shard), chunks.iloc[rows], create_vector_index(embeddings[rows], CONFIG), None,
+            {}, {"embedder_model_name": HashEmbedder.model_name},
+        )
+        sizes.append(len(rows))
+    return sizes
+
+
+def serve_worker(location: str, dim: int, urls) -> None:
+    retriever = MyRetriever.from_snapshot(load_latest_snapshot(location), HashEmbedder(dim), index_config=CONFIG)
+    server = ShardServer(retriever, "127.0.0.1", 0)
+    urls.put((location, server.url))
+    server.serve_forever()
+
+
+def recall(expected: list, found: list) -> float:
+    hits = sum(len(set(a) & set(b)) for (a, b) in zip(expected, found))
+    return hits / max(sum(len(a) for a in expected), 1)
+
+
+def run_queries(retriever: ShardedRetriever, queries: np.ndarray, k: int) -> tuple:
+    latencies, found, missing = [], [], set()
+    for query in queries:
+        (chunks,), elapsed = timed(retriever.search_embeddings, query[None, :], k)
+        latencies.append(elapsed)
+        found.append(chunks["text_hash"].tolist())
+        missing.update(chunks.attrs["missing_shards"])
+    return latencies, found, sorted(missing)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Run shard workers on localhost and check merged, degraded results")
+    parser.add_argument("--chunks", type=int, default=50_000)
+    parser.add_argument("--documents", type=int, default=500)
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--shards", type=int, default=3)
+    parser.add_argument("--queries", type=int, default=100)
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--timeout_s", type=float, default=1.0)
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args()
+
+    chunks, embeddings = build_corpus(args.chunks, args.dim, args.documents)
+    rng = np.random.default_rng(0)
+    queries = embeddings[rng.choice(len(embeddings), args.queries, replace=False)]
+    queries = normalize_embeddings(queries + 0.05 * rng.standard_normal(queries.shape, dtype=np.float32))
+    _, exact_ids = create_vector_index(embeddings, CONFIG).search(queries, args.k)
+    exact = [chunks["text_hash"].values[row].tolist() for row in exact_ids]
+
+    location = tempfile.mkdtemp()
+    sizes = write_shards(location, chunks, embeddings, args.shards)
+    del embeddings
+
+    context = multiprocessing.get_context("spawn")
+    urls = context.Queue()
+    workers = [
+        context.Process(target=serve_worker, args=(shard_location(location, shard), args.dim, urls), daemon=True)
+        for shard in range(args.shards)
+    ]
+    for worker in workers:
+        worker.start()
+    started = dict(urls.get(timeout=120) for _ in workers)
+    shard_urls = [started[shard_location(location, shard)] for shard in range(args.shards)]
+
+    failures = []
+    results = {"arguments": vars(args), "shard_sizes": sizes, "shard_urls": shard_urls}
+    try:
+        retriever = ShardedRetriever(
+            [HttpShard(url, args.timeout_s) for url in shard_urls], HashEmbedder(args.dim), args.timeout_s,
+        )
+        latencies, found, missing = run_queries(retriever, queries, args.k)
+        results["healthy"] = {"search": latency_stats(latencies), f"recall_at_{args.k}": recall(exact, found),
+                              "missing_shards": missing}
+        if recall(exact, found) < 1.0 or missing:
+            failures.append("healthy shards must return the exact top k")
+
+        local = [LocalShard(MyRetriever.from_snapshot(load_latest_snapshot(shard_location(location, shard)),
+                                                      HashEmbedder(args.dim), index_config=CONFIG), f"shard-{shard}")
+                 for shard in range(args.shards)]
+        slow = ShardedRetriever(
+            [HttpShard(url, args.timeout_s) for url in shard_urls[1:]] + [SlowShard(local[0], 5 * args.timeout_s)],
+            HashEmbedder(args.dim), args.timeout_s,
+        )
+        latencies, found, missing = run_queries(slow, queries[:10], args.k)
+        results["slow_shard"] = {"search": latency_stats(latencies), f"recall_at_{args.k}": recall(exact[:10], found),
+                                 "missing_shards": missing}
+        if max(latencies) > 2 * args.timeout_s or not missing:
+            failures.append("a slow shard must be dropped after the timeout")
+
+        workers[-1].terminate()
+        workers[-1].join()
+        latencies, found, missing = run_queries(retriever, queries, args.k)
+        results["dead_shard"] = {"search": latency_stats(latencies), f"recall_at_{args.k}": recall(exact, found),
+                                 "missing_shards": missing}
+        if missing != [shard_urls[-1]] or not all(found):
+            failures.append("a dead shard must degrade results of the other shards")
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+    results["failures"] = failures
+    text = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, "w", encoding="utf8") as file:
+            file.write(text)
+    print(text)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
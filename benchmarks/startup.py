@@ -0,0 +1,65 @@
+import argparse
+import json
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent / "llm_searcher"
+sys.path.insert(0, str(PACKAGE_ROOT))
+
+from src.startup import MODE_MODULES, import_times  # noqa: E402
+
+
+# Only the code paths that need these may import them
+DEFERRED_MODULES = {
+    "stdio": ["gradio", "langchain", "langchain_core", "langchain_community", "pymupdf4llm", "pymupdf", "tiktoken"],
+    "gradio": ["langchain", "langchain_core", "langchain_community", "pymupdf4llm", "pymupdf", "tiktoken"],
+    "shard": ["gradio", "langchain", "langchain_core", "langchain_community", "pymupdf4llm", "pymupdf", "tiktoken"],
+    "build-index": ["gradio", "langchain", "langchain_core", "langchain_community", "pymupdf4llm", "pymupdf", "tiktoken"],
+}
+DEFAULT_BUDGET_S = {"stdio": 1.5, "gradio": 6.0, "build-index": 1.5, "shard": 1.5}
+
+
+def cold_start_s(module: str) -> float:
+    begin = time.perf_counter()
+    subprocess.run([sys.executable, "-c", f"import {module}"], cwd=PACKAGE_ROOT, check=True)
+    return time.perf_counter() - begin
+
+
+def loaded_modules(module: str) -> set:
+    result = subprocess.run(
+        [sys.executable, "-c", f"import sys, {module}; print(' '.join(sys.modules))"],
+        cwd=PACKAGE_ROOT, capture_output=True, text=True, check=True,
+    )
+    return set(result.stdout.split())
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Fail when cold start of a mode exceeds its budget")
+    parser.add_argument("--mode", choices=list(MODE_MODULES), default="stdio")
+    parser.add_argument("--budget_s", type=float, default=None)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    module = MODE_MODULES[args.mode]
+    budget_s = args.budget_s or DEFAULT_BUDGET_S[args.mode]
+    best_s = min(cold_start_s(module) for _ in range(args.repeat))
+    loaded = loaded_modules(module)
+    unexpected = [name for name in DEFERRED_MODULES[args.mode] if name in loaded]
+    slowest = sorted(import_times(module), key=lambda item: -item[1])[:10]
+
+    print(json.dumps({
+        "mode": args.mode,
+        "cold_start_s": best_s,
+        "budget_s": budget_s,
+        "unexpected_modules": unexpected,
+        "slowest_self_s": {name.strip(): self_s for (name, self_s, _) in slowest},
+    }, indent=4))
+
+    if best_s > budget_s or unexpected:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
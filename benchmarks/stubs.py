@@ -0,0 +1,72 @@
+import hashlib
+import json
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import AsyncIterator, Iterator, Optional
+
+import numpy as np
+
+from src.embedders import Embedder
+
+
+DEFAULT_ANSWERS_LOCATION = Path(__file__).resolve().parent.parent / "questions_results_modified.jsonl"
+
+
+@lru_cache(maxsize=1 << 16)
+def word_vector(word: str, dim: int) -> np.ndarray:
+    seed = int(hashlib.md5(word.encode("utf8")).hexdigest()[:8], 16)
+    return np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+
+
+class HashEmbedder(Embedder):
+    model_name = "hash-embedder"
+
+    def __init__(self, dim: int = 256):
+        self.dim = dim
+
+    def embed_query(self, query: str) -> list:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in query.lower().split():
+            vector += word_vector(word, self.dim)
+        return vector.tolist()
+
+
+class ReplayChat:
+    model_name = "replay-chat"
+
+    def __init__(self, answers_location: Optional[Path] = DEFAULT_ANSWERS_LOCATION, delay_s: float = 0.0):
+        self.delay_s = delay_s
+        self.answers = {}
+        if answers_location is not None and Path(answers_location).exists():
+            with open(answers_location, "r", encoding="utf8") as file:
+                for line in file:
+                    record = json.loads(line)
+                    self.answers[record["question"]] = record["answer"]
+
+    def ask_question(self, question: str, context: str) -> str:
+        time.sleep(self.delay_s)
+        return self.answers.get(question, context[:200])
+
+    def ask_question_stream(self, question: str, context: str) -> Iterator[str]:
+        for word in self.ask_question(question, context).split(" "):
+            yield word + " "
+
+    async def ask_question_async(self, question: str, context: str) -> str:
+        return self.ask_question(question, context)
+
+    async def ask_question_stream_async(self, question: str, context: str) -> AsyncIterator[str]:
+        for token in self.ask_question_stream(question, context):
+            yield token
+
+
+def clustered_embeddings(count: int, dim: int, num_of_clusters: int, seed: int = 0) -> np.ndarray:
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((num_of_clusters, dim)).astype(np.float32)
+    embeddings = np.empty((count, dim), dtype=np.float32)
+    for begin in range(0, count, 1 << 16):
+        end = min(begin + (1 << 16), count)
+        embeddings[begin:end] = centroids[rng.integers(num_of_clusters, size=end - begin)]
+        embeddings[begin:end] += rng.standard_normal((end - begin, dim), dtype=np.float32)
+        embeddings[begin:end] /= np.linalg.norm(embeddings[begin:end], axis=1, keepdims=True)
+    return embeddings
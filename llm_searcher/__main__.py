@@ -1,5 +1,3 @@
-from src.main import main
-from src.gradio import gradio_main
 from src.logger import setup_default_logger, setup_logger
 import json
 import logging
@@ -18,12 +16,19 @@ def parse_arguments() -> argparse.Namespace:
     parser.add_argument("--config"
                         , default=DEFAULT_PATH_TO_CONFIG
                         , help="Path to config")
-    parser.add_argument("--mode", choices=["stdio", "gradio"]
+    parser.add_argument("--mode", choices=["stdio", "gradio", "build-index", "shard"]
                         , default="stdio"
-                        , help="Working mode")
-    parser.add_argument("--searcher", required=True, help="Which config to use")
+                        , help="Working mode, build-index writes an index snapshot for serving processes and exits, "
+                             "shard serves one index shard over HTTP")
+    parser.add_argument("--searcher", help="Which config to use")
+    parser.add_argument("--shard", type=int, help="Which of shard_urls to serve in shard mode")
     parser.add_argument("--publish_to_web", action='store_true')
-    return parser.parse_args()
+    parser.add_argument("--profile-startup", action='store_true'
+                        , help="Print import times of the selected mode and exit")
+    args = parser.parse_args()
+    if not args.searcher and not args.profile_startup:
+        parser.error("the following arguments are required: --searcher")
+    return args
 
 
 def remove_stream_log_handlers():
@@ -36,6 +41,11 @@ if __name__ == "__main__":
     setup_default_logger()
     args = parse_arguments()
 
+    if args.profile_startup:
+        from src.startup import profile_startup
+        print(profile_startup(args.mode))
+        sys.exit(0)
+
     configs = None
 
     try:
@@ -47,9 +57,18 @@ if __name__ == "__main__":
     setup_logger(configs.get("logging"))
 
     try:
+        # Modes import their own dependencies, so stdio runs never load gradio
         if args.mode == "gradio":
+            from src.gradio import gradio_main
             gradio_main(configs, args.searcher, publish_link_to_web=args.publish_to_web)
+        elif args.mode == "build-index":
+            from src.main import build_index
+            build_index(configs, args.searcher)
+        elif args.mode == "shard":
+            from src.main import serve_shard
+            serve_shard(configs, args.searcher, args.shard)
         else:
+            from src.main import main
             remove_stream_log_handlers()
             main(configs, args.searcher)
     except Exception as ex:
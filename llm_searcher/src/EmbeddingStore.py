@@ -0,0 +1,182 @@
+from pandas import DataFrame, read_csv, concat
+from pathlib import Path
+from typing import Optional
+import numpy as np
+import hashlib
+import json
+import logging
+import os
+import re
+
+
+logger = logging.getLogger(__name__)
+
+
+STORE_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+CHUNKS_FILE = "chunks.csv"
+EMBEDDINGS_FILE = "embeddings.f32"
+
+CHUNK_COLUMNS = ['name', 'chunk', 'text', 'text_hash', 'document_hash']
+
+
+def text_hash(text: str) -> str:
+    return hashlib.sha1(text.encode('utf8')).hexdigest()
+
+
+def store_key(embedder_model_name: str, chunker: str, chunk_size: int, chunk_overlap: int) -> str:
+    model = re.sub(r"[^A-Za-z0-9_.-]+", "_", embedder_model_name)
+    return f"{model}-{chunker}-{chunk_size}-{chunk_overlap}"
+
+
+def empty_chunks() -> DataFrame:
+    return DataFrame({column: [] for column in CHUNK_COLUMNS})
+
+
+class EmbeddingStore:
+    def __init__(self, location: str, embedder_model_name: str, chunker: str, chunk_size: int, chunk_overlap: int):
+        self.__path = Path(location) / store_key(embedder_model_name, chunker, chunk_size, chunk_overlap)
+        self.__manifest = {
+            "version": STORE_VERSION,
+            "embedder_model_name": embedder_model_name,
+            "chunker": chunker,
+            "chunk_size": chunk_size,
+            "chunk_overlap": chunk_overlap,
+            "dim": 0,
+            "count": 0,
+            "sources": {},
+        }
+        self.__chunks = empty_chunks()
+        self.__embeddings = np.empty((0, 0), dtype=np.float32)
+        self.__by_text_hash = {}
+        self.__by_document_hash = {}
+        self.__load()
+
+    @property
+    def path(self) -> Path:
+        return self.__path
+
+    @property
+    def chunks(self) -> DataFrame:
+        return self.__chunks
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self.__embeddings
+
+    def __len__(self) -> int:
+        return len(self.__chunks)
+
+    def find_text(self, hash_: str) -> Optional[int]:
+        return self.__by_text_hash.get(hash_)
+
+    def find_document(self, hash_: str) -> Optional[np.ndarray]:
+        return self.__by_document_hash.get(hash_)
+
+    @property
+    def sources(self) -> dict:
+        return self.__manifest["sources"]
+
+    def __load(self) -> None:
+        manifest_path = self.__path / MANIFEST_FILE
+        if not manifest_path.exists():
+            logger.info(f"Embedding store {self.__path} is empty")
+            return
+
+        try:
+            with open(manifest_path, 'r', encoding='utf8') as file:
+                manifest = json.load(file)
+            for key in ("version", "embedder_model_name", "chunker", "chunk_size", "chunk_overlap"):
+                if manifest.get(key) != self.__manifest[key]:
+                    raise RuntimeError(f"{key} mismatch: {manifest.get(key)} != {self.__manifest[key]}")
+
+            count, dim = manifest["count"], manifest["dim"]
+            chunks = read_csv(
+                self.__path / CHUNKS_FILE,
+                dtype={'name': str, 'text': str, 'text_hash': str, 'document_hash': str},
+                keep_default_na=False,
+                nrows=count,
+            )
+            if len(chunks) != count:
+                raise RuntimeError(f"expected {count} chunks, found {len(chunks)}")
+            embeddings = np.memmap(self.__path / EMBEDDINGS_FILE, dtype=np.float32, mode='r', shape=(count, dim)) \
+                if count else np.empty((0, dim), dtype=np.float32)
+        except Exception as ex:
+            logger.warning(f"Ignoring unreadable embedding store {self.__path}: {ex}")
+            return
+
+        self.__manifest = dict(manifest, sources=manifest.get("sources", {}))
+        self.__set(chunks, embeddings)
+        logger.info(f"Loaded {count} stored embeddings from {self.__path}")
+
+    def __set(self, chunks: DataFrame, embeddings: np.ndarray) -> None:
+        self.__chunks = chunks
+        self.__embeddings = embeddings
+        self.__by_text_hash = {}
+        self.__by_document_hash = {}
+        self.__index_hashes(chunks, offset=0)
+
+    def __index_hashes(self, chunks: DataFrame, offset: int) -> None:
+        for index, hash_ in enumerate(chunks['text_hash'].values, start=offset):
+            self.__by_text_hash[hash_] = index
+        for hash_, indexes in chunks.groupby('document_hash', sort=False).indices.items():
+            self.__by_document_hash[hash_] = np.asarray(indexes) + offset
+
+    def replace(self, chunks: DataFrame, embeddings: np.ndarray) -> None:
+        chunks = chunks[CHUNK_COLUMNS].reset_index(drop=True)
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if len(chunks) != len(embeddings):
+            raise RuntimeError(f"Got {len(chunks)} chunks but {len(embeddings)} embeddings")
+
+        self.__path.mkdir(parents=True, exist_ok=True)
+        manifest = dict(self.__manifest, count=len(chunks), dim=embeddings.shape[1] if embeddings.ndim == 2 else 0)
+
+        chunks.to_csv(self.__path / f"{CHUNKS_FILE}.tmp", index=False)
+        embeddings.tofile(self.__path / f"{EMBEDDINGS_FILE}.tmp")
+        os.replace(self.__path / f"{CHUNKS_FILE}.tmp", self.__path / CHUNKS_FILE)
+        os.replace(self.__path / f"{EMBEDDINGS_FILE}.tmp", self.__path / EMBEDDINGS_FILE)
+        self.__write_manifest(manifest)
+
+        self.__manifest = manifest
+        self.__load()
+        logger.info(f"Saved {len(chunks)} embeddings to {self.__path}")
+
+    def append(self, chunks: DataFrame, embeddings: np.ndarray, sources: Optional[dict] = None) -> None:
+        chunks = chunks[CHUNK_COLUMNS].reset_index(drop=True)
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        if len(chunks) != len(embeddings):
+            raise RuntimeError(f"Got {len(chunks)} chunks but {len(embeddings)} embeddings")
+
+        count, dim = len(self), self.__manifest["dim"]
+        if len(chunks) and count and embeddings.shape[1] != dim:
+            raise RuntimeError(f"Got embeddings of size {embeddings.shape[1]}, store has {dim}")
+
+        embeddings_path = self.__path / EMBEDDINGS_FILE
+        if len(chunks) and count and os.path.getsize(embeddings_path) != count * dim * 4:
+            logger.warning(f"Embedding store {self.__path} has trailing data, rewriting it")
+            self.replace(concat([self.__chunks, chunks], ignore_index=True), np.concatenate([self.__embeddings, embeddings]))
+            count, chunks = len(self), chunks.iloc[:0]
+        elif len(chunks):
+            self.__path.mkdir(parents=True, exist_ok=True)
+            with open(embeddings_path, 'ab' if count else 'wb') as file:
+                embeddings.tofile(file)
+            chunks.to_csv(self.__path / CHUNKS_FILE, mode='a' if count else 'w', header=not count, index=False)
+            dim = embeddings.shape[1]
+
+        manifest = dict(self.__manifest, count=count + len(chunks), dim=dim)
+        manifest["sources"] = dict(self.__manifest["sources"], **(sources or {}))
+        self.__path.mkdir(parents=True, exist_ok=True)
+        self.__write_manifest(manifest)
+        self.__manifest = manifest
+
+        if len(chunks):
+            self.__embeddings = np.memmap(embeddings_path, dtype=np.float32, mode='r', shape=(manifest["count"], dim))
+            self.__chunks = concat([self.__chunks, chunks], ignore_index=True)
+            self.__index_hashes(chunks, offset=count)
+        logger.info(f"Appended {len(chunks)} embeddings to {self.__path}")
+
+    def __write_manifest(self, manifest: dict) -> None:
+        tmp_path = self.__path / f"{MANIFEST_FILE}.tmp"
+        with open(tmp_path, 'w', encoding='utf8') as file:
+            json.dump(manifest, file, indent=4)
+        os.replace(tmp_path, self.__path / MANIFEST_FILE)
@@ -1,11 +1,20 @@
+from . import metrics
+
 from langchain.prompts.chat import ChatPromptTemplate
-from typing import Optional
+from typing import AsyncIterator, Iterator, Optional
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
+def count_tokens(message) -> None:
+    usage = getattr(message, "usage_metadata", None)
+    if usage:
+        metrics.count("prompt_tokens", usage.get("input_tokens", 0))
+        metrics.count("completion_tokens", usage.get("output_tokens", 0))
+
+
 class ChatWrapper:
     def __init__(self, chat_model, prompt_template: Optional[str] = None):
         logger.info("Creating ModelWrapper")
@@ -21,10 +30,41 @@ class ChatWrapper:
                 ("human", "{text}"),
             ])      
 
-    def ask_question(self, question: str, context: str) -> str:
-        prompt = self.__chat_prompt.format_messages(
-            context = context,
-            text = question      
-        )
+    @property
+    def model_name(self) -> str:
+        return getattr(self.__chat_model, "model", None) or type(self.__chat_model).__name__
+
+    def __format_prompt(self, question: str, context: str) -> list:
+        with metrics.span("prompt_formatting"):
+            prompt = self.__chat_prompt.format_messages(
+                context = context,
+                text = question      
+            )
         logger.debug(f"Invoking chat model with prompt: {prompt}")
-        return self.__chat_model.invoke(prompt).content
+        return prompt
+
+    def ask_question(self, question: str, context: str) -> str:
+        prompt = self.__format_prompt(question, context)
+        with metrics.span("generation"):
+            response = self.__chat_model.invoke(prompt)
+        count_tokens(response)
+        return response.content
+
+    def ask_question_stream(self, question: str, context: str) -> Iterator[str]:
+        for chunk in self.__chat_model.stream(self.__format_prompt(question, context)):
+            count_tokens(chunk)
+            if chunk.content:
+                yield chunk.content
+
+    async def ask_question_async(self, question: str, context: str) -> str:
+        prompt = self.__format_prompt(question, context)
+        with metrics.span("generation"):
+            response = await self.__chat_model.ainvoke(prompt)
+        count_tokens(response)
+        return response.content
+
+    async def ask_question_stream_async(self, question: str, context: str) -> AsyncIterator[str]:
+        async for chunk in self.__chat_model.astream(self.__format_prompt(question, context)):
+            count_tokens(chunk)
+            if chunk.content:
+                yield chunk.content
@@ -0,0 +1,224 @@
+from .EmbeddingStore import CHUNK_COLUMNS
+from .LexicalIndex import chunks_fingerprint
+
+from pandas import DataFrame, read_csv
+from pathlib import Path
+from typing import Callable, NamedTuple, Optional
+import numpy as np
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import threading
+import time
+import weakref
+
+
+logger = logging.getLogger(__name__)
+
+
+SNAPSHOT_FORMAT = 1
+MANIFEST_FILE = "manifest.json"
+CHUNKS_FILE = "chunks.csv"
+EMBEDDINGS_FILE = "embeddings.f32"
+LATEST_FILE = "LATEST"
+CHECKSUM_BLOCK = 1 << 20
+DEFAULT_SNAPSHOTS_TO_KEEP = 3
+DEFAULT_SNAPSHOT_POLL_INTERVAL_S = 30
+SNAPSHOT_DIR = re.compile(r"v(\d+)\Z")
+
+
+class IndexSnapshot(NamedTuple):
+    path: Path
+    manifest: dict
+    chunks: DataFrame
+    embeddings: np.ndarray
+
+    @property
+    def version(self) -> int:
+        return self.manifest["version"]
+
+    @property
+    def sources(self) -> dict:
+        return self.manifest["sources"]
+
+
+def file_checksum(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        while block := file.read(CHECKSUM_BLOCK):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def snapshot_path(location: str, version: int) -> Path:
+    return Path(location) / f"v{version:06d}"
+
+
+def latest_version(location: str) -> Optional[int]:
+    try:
+        with open(Path(location) / LATEST_FILE, 'r', encoding='utf8') as file:
+            return int(file.read().strip())
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        logger.warning(f"Ignoring unreadable snapshot pointer in {location}: {ex}")
+        return None
+
+
+def _existing_versions(location: Path) -> list:
+    if not location.exists():
+        return []
+    return sorted(int(match.group(1)) for match in map(SNAPSHOT_DIR.match, os.listdir(location)) if match)
+
+
+def write_snapshot(
+    location: str,
+    chunks: DataFrame,
+    vector_index,
+    lexical_index,
+    sources: dict,
+    metadata: dict,
+    keep: int = DEFAULT_SNAPSHOTS_TO_KEEP,
+) -> Path:
+    if len(chunks) != len(vector_index.embeddings):
+        raise RuntimeError(f"Snapshot has {len(chunks)} chunks but {len(vector_index.embeddings)} embeddings")
+
+    root = Path(location)
+    root.mkdir(parents=True, exist_ok=True)
+    version = max(_existing_versions(root) + [latest_version(location) or 0]) + 1
+    tmp_path = root / f".v{version:06d}.{os.getpid()}.tmp"
+    tmp_path.mkdir()
+
+    try:
+        chunks = chunks[CHUNK_COLUMNS].reset_index(drop=True)
+        embeddings = np.ascontiguousarray(vector_index.embeddings, dtype=np.float32)
+        chunks.to_csv(tmp_path / CHUNKS_FILE, index=False)
+        embeddings.tofile(tmp_path / EMBEDDINGS_FILE)
+        # Saved indexes are only a cache, they carry their own fingerprints and are rebuilt when stale
+        vector_index.save(tmp_path)
+        if lexical_index is not None:
+            lexical_index.save(tmp_path, chunks_fingerprint(chunks))
+
+        manifest = dict(
+            metadata,
+            format=SNAPSHOT_FORMAT,
+            version=version,
+            created=time.time(),
+            count=len(chunks),
+            dim=embeddings.shape[1] if embeddings.ndim == 2 else 0,
+            sources=sources,
+            checksums={name: file_checksum(tmp_path / name) for name in (CHUNKS_FILE, EMBEDDINGS_FILE)},
+        )
+        with open(tmp_path / MANIFEST_FILE, 'w', encoding='utf8') as file:
+            json.dump(manifest, file, indent=4)
+        os.rename(tmp_path, snapshot_path(location, version))
+    except Exception:
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        raise
+
+    pointer = root / f"{LATEST_FILE}.{os.getpid()}.tmp"
+    with open(pointer, 'w', encoding='utf8') as file:
+        file.write(str(version))
+    os.replace(pointer, root / LATEST_FILE)
+    logger.info(f"Wrote snapshot {version} with {len(chunks)} chunks to {root}")
+
+    # Serving processes keep old snapshots mapped, unlinking their files does not disturb them
+    for old_version in _existing_versions(root)[:-max(keep, 1)]:
+        shutil.rmtree(snapshot_path(location, old_version), ignore_errors=True)
+    return snapshot_path(location, version)
+
+
+def load_snapshot(path: Path, expected: Optional[dict] = None, verify: bool = True) -> IndexSnapshot:
+    with open(path / MANIFEST_FILE, 'r', encoding='utf8') as file:
+        manifest = json.load(file)
+    if manifest.get("format") != SNAPSHOT_FORMAT:
+        raise RuntimeError(f"Snapshot {path} has format {manifest.get('format')}, expected {SNAPSHOT_FORMAT}")
+    for (key, value) in (expected or {}).items():
+        if manifest.get(key) != value:
+            raise RuntimeError(f"Snapshot {path} {key} mismatch: {manifest.get(key)} != {value}")
+    if verify:
+        for (name, checksum) in manifest["checksums"].items():
+            if file_checksum(path / name) != checksum:
+                raise RuntimeError(f"Snapshot {path} is corrupted, checksum of {name} does not match")
+
+    count, dim = manifest["count"], manifest["dim"]
+    chunks = read_csv(
+        path / CHUNKS_FILE,
+        dtype={'name': str, 'text': str, 'text_hash': str, 'document_hash': str},
+        keep_default_na=False,
+    )
+    if len(chunks) != count:
+        raise RuntimeError(f"Snapshot {path} has {len(chunks)} chunks, manifest says {count}")
+    size = os.path.getsize(path / EMBEDDINGS_FILE)
+    if size != count * dim * np.dtype(np.float32).itemsize:
+        raise RuntimeError(f"Snapshot {path} has {size} bytes of embeddings, manifest says {count} x {dim}")
+    embeddings = np.memmap(path / EMBEDDINGS_FILE, dtype=np.float32, mode='r', shape=(count, dim)) \
+        if count else np.empty((0, dim), dtype=np.float32)
+    return IndexSnapshot(path, manifest, chunks, embeddings)
+
+
+def load_latest_snapshot(location: str, expected: Optional[dict] = None, verify: bool = True) -> Optional[IndexSnapshot]:
+    version = latest_version(location)
+    if version is None:
+        return None
+    # Older versions are kept so that a snapshot failing verification does not take the server down
+    for candidate in [version] + [old for old in reversed(_existing_versions(Path(location))) if old < version]:
+        try:
+            snapshot = load_snapshot(snapshot_path(location, candidate), expected, verify)
+        except Exception as ex:
+            logger.error(f"Failed to load snapshot {candidate} from {location}: {ex}")
+            continue
+        if candidate != version:
+            logger.warning(f"Serving snapshot {candidate} from {location} instead of the latest {version}")
+        return snapshot
+    logger.error(f"No snapshot in {location} could be loaded")
+    return None
+
+
+class SnapshotWatcher:
+    def __init__(
+        self,
+        location: str,
+        retriever,
+        load: Callable[[], Optional[IndexSnapshot]],
+        interval_s: float = DEFAULT_SNAPSHOT_POLL_INTERVAL_S,
+    ):
+        self.__location = location
+        self.__retriever = weakref.ref(retriever)
+        self.__load = load
+        self.__interval_s = interval_s
+        self.__failed_version = None
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__run, name=f"snapshot-watcher-{location}", daemon=True)
+        self.__thread.start()
+
+    def stop(self) -> None:
+        self.__stopped.set()
+
+    def check(self) -> bool:
+        retriever = self.__retriever()
+        if retriever is None:
+            self.stop()
+            return False
+        version = latest_version(self.__location)
+        if version is None or version <= (retriever.snapshot_version or 0) or version == self.__failed_version:
+            return False
+        try:
+            snapshot = self.__load()
+        except Exception as ex:
+            logger.error(f"Failed to load snapshot {version} from {self.__location}, keep serving the old one: {ex}")
+            return False
+        if snapshot is None or snapshot.version < version:
+            # Verifying a broken snapshot again on every poll would read it in full each time
+            self.__failed_version = version
+        if snapshot is None or snapshot.version <= (retriever.snapshot_version or 0):
+            return False
+        retriever.swap_snapshot(snapshot)
+        return True
+
+    def __run(self) -> None:
+        while not self.__stopped.wait(self.__interval_s):
+            self.check()
@@ -0,0 +1,189 @@
+from .VectorIndex import top_k
+
+from collections import Counter
+from pandas import DataFrame
+from pathlib import Path
+from typing import Iterable, List, Optional, Tuple
+import numpy as np
+import hashlib
+import logging
+import os
+import re
+
+
+logger = logging.getLogger(__name__)
+
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+RRF_CONSTANT = 60
+DEFAULT_HYBRID_CANDIDATES = 50
+TOKEN = re.compile(r"\w+(?:[.,]\d+)*")
+
+
+def tokenize(text: str) -> List[str]:
+    return TOKEN.findall(text.lower())
+
+
+def chunks_fingerprint(chunks: DataFrame) -> str:
+    hashes = chunks['text_hash'] if 'text_hash' in chunks else chunks['text']
+    return hashlib.sha1("\n".join(hashes.astype(str)).encode('utf8')).hexdigest()
+
+
+class BM25Index:
+    FILE_NAME = "bm25.npz"
+
+    def __init__(
+        self,
+        vocabulary: dict,
+        offsets: np.ndarray,
+        documents: np.ndarray,
+        frequencies: np.ndarray,
+        lengths: np.ndarray,
+    ):
+        self.__vocabulary = vocabulary
+        self.__offsets = offsets
+        self.__documents = documents
+        self.__frequencies = frequencies
+        self.__lengths = lengths
+        self.__average_length = float(lengths.mean()) if len(lengths) else 0.0
+
+    def __len__(self) -> int:
+        return len(self.__lengths)
+
+    @property
+    def nbytes(self) -> int:
+        return self.__offsets.nbytes + self.__documents.nbytes + self.__frequencies.nbytes + self.__lengths.nbytes
+
+    @classmethod
+    def build(cls, texts: Iterable[str]) -> "BM25Index":
+        return cls({}, np.zeros(1, dtype=np.int64), np.empty(0, dtype=np.int32),
+                   np.empty(0, dtype=np.uint16), np.empty(0, dtype=np.int32)).extend(texts)
+
+    def extend(self, texts: Iterable[str]) -> "BM25Index":
+        vocabulary = dict(self.__vocabulary)
+        terms, documents, frequencies, lengths = [], [], [], []
+        for (document, text) in enumerate(texts, start=len(self)):
+            tokens = tokenize(str(text))
+            lengths.append(len(tokens))
+            for (term, frequency) in Counter(tokens).items():
+                terms.append(vocabulary.setdefault(term, len(vocabulary)))
+                documents.append(document)
+                frequencies.append(min(frequency, np.iinfo(np.uint16).max))
+        if not lengths:
+            return self
+
+        # Only the new postings are sorted, the existing ones keep their order and move by the growth of earlier terms
+        new_terms = np.asarray(terms, dtype=np.int64)
+        order = np.argsort(new_terms, kind='stable')
+        new_terms = new_terms[order]
+        new_counts = np.bincount(new_terms, minlength=len(vocabulary))
+        old_counts = np.zeros(len(vocabulary), dtype=np.int64)
+        old_counts[:len(self.__offsets) - 1] = np.diff(self.__offsets)
+
+        offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(old_counts + new_counts, out=offsets[1:])
+        new_offsets = np.zeros(len(vocabulary) + 1, dtype=np.int64)
+        np.cumsum(new_counts, out=new_offsets[1:])
+
+        old_positions = np.arange(len(self.__documents), dtype=np.int64) \
+            + np.repeat(offsets[:len(self.__offsets) - 1] - self.__offsets[:-1], old_counts[:len(self.__offsets) - 1])
+        new_positions = offsets[new_terms] + old_counts[new_terms] \
+            + np.arange(len(new_terms), dtype=np.int64) - new_offsets[new_terms]
+
+        merged_documents = np.empty(offsets[-1], dtype=np.int32)
+        merged_documents[old_positions] = self.__documents
+        merged_documents[new_positions] = np.asarray(documents, dtype=np.int32)[order]
+        merged_frequencies = np.empty(offsets[-1], dtype=np.uint16)
+        merged_frequencies[old_positions] = self.__frequencies
+        merged_frequencies[new_positions] = np.asarray(frequencies, dtype=np.uint16)[order]
+        return BM25Index(
+            vocabulary,
+            offsets,
+            merged_documents,
+            merged_frequencies,
+            np.concatenate([self.__lengths, np.asarray(lengths, dtype=np.int32)]),
+        )
+
+    def search(self, query: str, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        documents, scores = [], []
+        for term in set(tokenize(query)):
+            term_id = self.__vocabulary.get(term)
+            if term_id is None:
+                continue
+            begin, end = self.__offsets[term_id], self.__offsets[term_id + 1]
+            term_documents = self.__documents[begin:end]
+            frequencies = self.__frequencies[begin:end].astype(np.float32)
+            idf = np.log1p((len(self) - len(term_documents) + 0.5) / (len(term_documents) + 0.5))
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * self.__lengths[term_documents] / max(self.__average_length, 1e-9))
+            documents.append(term_documents)
+            scores.append(idf * frequencies * (BM25_K1 + 1) / (frequencies + norm))
+
+        if not documents:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        candidates, inverse = np.unique(np.concatenate(documents), return_inverse=True)
+        candidate_scores = np.bincount(inverse, weights=np.concatenate(scores)).astype(np.float32)
+        best = top_k(candidate_scores, k)[0]
+        return candidate_scores[best], candidates[best].astype(np.int64)
+
+    def save(self, path: Path, fingerprint: str) -> None:
+        tmp_path = path / f"{self.FILE_NAME}.tmp.npz"
+        terms = [""] * len(self.__vocabulary)
+        for (term, term_id) in self.__vocabulary.items():
+            terms[term_id] = term
+        np.savez(
+            tmp_path,
+            terms="\n".join(terms),
+            offsets=self.__offsets,
+            documents=self.__documents,
+            frequencies=self.__frequencies,
+            lengths=self.__lengths,
+            fingerprint=fingerprint,
+        )
+        os.replace(tmp_path, path / self.FILE_NAME)
+
+    @classmethod
+    def load(cls, path: Path, fingerprint: str) -> Optional["BM25Index"]:
+        try:
+            with np.load(path / cls.FILE_NAME) as saved:
+                if str(saved["fingerprint"]) != fingerprint:
+                    raise RuntimeError("saved index does not match the chunks")
+                terms = str(saved["terms"]).split("\n") if len(saved["offsets"]) > 1 else []
+                return cls(
+                    {term: term_id for (term_id, term) in enumerate(terms)},
+                    saved["offsets"], saved["documents"], saved["frequencies"], saved["lengths"],
+                )
+        except Exception as ex:
+            logger.info(f"Building new BM25 index, saved one is not usable: {ex}")
+            return None
+
+
+def reciprocal_rank_fusion(rankings: List[np.ndarray], k: int, constant: int) -> np.ndarray:
+    scores = {}
+    for ranking in rankings:
+        for (rank, document) in enumerate(ranking.tolist()):
+            if document >= 0:
+                scores[document] = scores.get(document, 0.0) + 1.0 / (constant + rank + 1)
+    return np.array(sorted(scores, key=lambda document: -scores[document])[:k], dtype=np.int64)
+
+
+def create_lexical_index(
+    chunks: DataFrame, config: Optional[dict] = None, path: Optional[Path] = None,
+) -> Optional[BM25Index]:
+    config = config or {}
+    retrieval = config.get("retrieval", "vector")
+    if retrieval == "vector":
+        return None
+    if retrieval != "hybrid":
+        raise RuntimeError(f"Got unexpected retrieval type {retrieval}")
+
+    if path is not None and len(chunks):
+        index = BM25Index.load(path, chunks_fingerprint(chunks))
+        if index is not None:
+            return index
+
+    index = BM25Index.build(chunks['text'].values if len(chunks) else [])
+    if path is not None and len(index):
+        index.save(path, chunks_fingerprint(chunks))
+    logger.info(f"Built BM25 index over {len(index)} chunks")
+    return index
@@ -1,95 +1,310 @@
-from .PdfReader import load_pdfs
-from .embeddings import create_embeddings
+from .PdfReader import iter_pdfs, file_hash
+from .embeddings import create_embeddings, append_embeddings, normalize_embeddings
 from .embedders import get_embedder
+from .chunking import ChunkCache
+from .EmbeddingStore import EmbeddingStore, text_hash
+from .IndexSnapshot import IndexSnapshot, SnapshotWatcher
+from .VectorIndex import VectorIndex, create_vector_index, recall_at_k
+from . import metrics
+from .LexicalIndex import (
+    BM25Index, create_lexical_index, chunks_fingerprint, reciprocal_rank_fusion, DEFAULT_HYBRID_CANDIDATES, RRF_CONSTANT,
+)
 
-from langchain_core.retrievers import BaseRetriever
-from langchain_core.callbacks import CallbackManagerForRetrieverRun
-from langchain_core.documents import Document
-
-from numpy.linalg import norm
-from numpy import dot
-from typing import List, Optional
+import numpy as np
+from typing import Iterable, List, NamedTuple, Optional, Tuple
+import asyncio
+import threading
 from pandas import DataFrame, concat
 from pathlib import Path
 from uuid import uuid4
+import shutil
 import logging
 
 
 logger = logging.getLogger(__name__)
 
 
-def cosine_distances(a, b):
-    return dot(a, b)/(norm(a)*norm(b))
+class Snapshot(NamedTuple):
+    data: DataFrame
+    vector_index: VectorIndex
+    lexical_index: Optional[BM25Index]
 
 
-class MyRetriever(BaseRetriever):
+class MyRetriever:
 
-    def __init__(self, data: DataFrame, embedder, max_tokens: int = 256):
+    def __init__(
+        self,
+        data: DataFrame | Iterable[Tuple[str, str]],
+        embedder,
+        max_tokens: int = 256,
+        store: Optional[EmbeddingStore] = None,
+        parse_options: Optional[dict] = None,
+        index_config: Optional[dict] = None,
+        chunk_cache: Optional[ChunkCache] = None,
+    ):
         logger.info("Creating MyRetriever")
-        super().__init__()
+        self.__init_state(embedder, max_tokens, store, parse_options, index_config, chunk_cache)
+        self.__set_data(*create_embeddings(
+            data, self._embedder, max_tokens=max_tokens, store=store,
+            keep_documents={source["document_hash"] for source in self._sources.values()},
+            chunk_cache=chunk_cache,
+        ))
+        logger.info(f"MyRetriever created with data")
 
+    def __init_state(
+        self,
+        embedder,
+        max_tokens: int,
+        store: Optional[EmbeddingStore],
+        parse_options: Optional[dict],
+        index_config: Optional[dict],
+        chunk_cache: Optional[ChunkCache],
+    ) -> None:
         self.__dict__['_num_of_relevant_chunks'] = 2
         self.__dict__['_max_tokens'] = max_tokens
         self.__dict__['_embedder'] = embedder
-        self.__dict__['_data'] = create_embeddings(data, self._embedder, max_tokens=max_tokens)
-        logger.info(f"MyRetriever created with data")
+        self.__dict__['_store'] = store
+        self.__dict__['_parse_options'] = parse_options or {}
+        self.__dict__['_index_config'] = index_config or {}
+        self.__dict__['_chunk_cache'] = chunk_cache
+        self.__dict__['_sources'] = dict(store.sources) if store is not None else {}
+        self.__dict__['_write_lock'] = threading.Lock()
+
+    @classmethod
+    def from_snapshot(
+        cls,
+        snapshot: IndexSnapshot,
+        embedder,
+        max_tokens: int = 256,
+        parse_options: Optional[dict] = None,
+        index_config: Optional[dict] = None,
+        chunk_cache: Optional[ChunkCache] = None,
+    ) -> "MyRetriever":
+        logger.info(f"Creating MyRetriever from snapshot {snapshot.path}")
+        retriever = cls.__new__(cls)
+        retriever.__init_state(embedder, max_tokens, None, parse_options, index_config, chunk_cache)
+        retriever.swap_snapshot(snapshot)
+        return retriever
+
+    def swap_snapshot(self, snapshot: IndexSnapshot) -> None:
+        # Indexes are built before taking the lock, queries in flight keep the Snapshot they started with
+        vector_index = create_vector_index(snapshot.embeddings, self._index_config, snapshot.path)
+        lexical_index = create_lexical_index(snapshot.chunks, self._index_config, snapshot.path)
+        with self._write_lock:
+            self.__dict__['_snapshot_location'] = str(snapshot.path.parent)
+            self.__dict__['_sources'] = dict(snapshot.sources)
+            self.__dict__['_index'] = Snapshot(snapshot.chunks, vector_index, lexical_index)
+            self.__dict__['_snapshot_version'] = snapshot.version
+        logger.info(f"Serving snapshot {snapshot.version} with {len(snapshot.chunks)} chunks")
+
+    def watch_snapshots(self, location: str, load, interval_s: float) -> SnapshotWatcher:
+        self.__dict__['_snapshot_location'] = location
+        return SnapshotWatcher(location, self, load, interval_s)
+
+    def __set_data(self, data: DataFrame, embeddings: np.ndarray) -> None:
+        store_path = self._store.path if self._store is not None else None
+        self.__set_index(
+            data,
+            create_vector_index(embeddings, self._index_config, store_path),
+            create_lexical_index(data, self._index_config, store_path),
+        )
+
+    def __set_index(self, data: DataFrame, vector_index: VectorIndex, lexical_index: Optional[BM25Index]) -> None:
+        if self._store is not None and len(vector_index):
+            vector_index.save(self._store.path)
+            if lexical_index is not None:
+                lexical_index.save(self._store.path, chunks_fingerprint(data))
+        self.__dict__['_index'] = Snapshot(data, vector_index, lexical_index)
+
+    @property
+    def _data(self) -> DataFrame:
+        return self._index[0]
+
+    @property
+    def embedder(self):
+        return self._embedder
+
+    @property
+    def snapshot(self) -> Snapshot:
+        return self._index
+
+    @property
+    def snapshot_version(self) -> Optional[int]:
+        return self.__dict__.get('_snapshot_version')
+
+    @property
+    def sources(self) -> dict:
+        return self._sources
 
     def add_document(self, path: Path):
-        logger.info(f"Adding document {path}")
-        if path.is_dir():
-            raise RuntimeError("Got folder while adding single document")
-        if len(path.suffixes) > 1 and path.suffix != ".pdf":
-            raise RuntimeError(f"Only supported format is pdf, got {path}")
+        self.add_documents([path])
+
+    def add_documents(self, paths: List[Path]):
+        # The next snapshot swap replaces the whole index, uploaded documents would silently disappear
+        location = self.__dict__.get('_snapshot_location')
+        if location is not None:
+            raise RuntimeError(
+                f"Index is served from snapshots in {location}, add documents to pdfs_location "
+                f"and rebuild it with --mode build-index"
+            )
+        with self._write_lock:
+            self.__add_documents(paths)
+
+    def __add_documents(self, paths: List[Path]):
+        logger.info(f"Adding documents {paths}")
+        new_paths = {}
+        for path in paths:
+            if path.is_dir():
+                raise RuntimeError("Got folder while adding single document")
+            if len(path.suffixes) > 1 and path.suffix != ".pdf":
+                raise RuntimeError(f"Only supported format is pdf, got {path}")
+
+            try:
+                source_hash = file_hash(path)
+            except Exception as ex:
+                logger.error(f"Failed to read {path}, skipping it: {ex}")
+                continue
+            if source_hash in self._sources or source_hash in new_paths:
+                logger.info(f"Document {path} is already added, skipping it")
+                continue
+            new_paths[source_hash] = path
+
+        if not new_paths:
+            return
+
+        known_documents = set(self._data['document_hash'].values)
+        sources = {}
+
+        def new_documents():
+            for (tmp_name, text) in iter_pdfs(str(tmp_dir), **self._parse_options):
+                source_hash = Path(tmp_name).stem
+                name = new_paths[source_hash].name
+                document_hash = text_hash(text)
+                sources[source_hash] = {"name": name, "document_hash": document_hash}
+                if document_hash in known_documents:
+                    continue
+                known_documents.add(document_hash)
+                yield name, text
 
         tmp_dir = Path(f"./{uuid4()}")
         tmp_dir.mkdir()
-        prev_path = path
-        path.rename(tmp_dir / path.name)
-
         try:
-            data = load_pdfs(str(tmp_dir), DataFrame())
-        except Exception:
-            path.rename(prev_path)
-            raise
+            # Files are copied under their hash, so documents with the same name from different folders do not collide
+            for (source_hash, path) in new_paths.items():
+                shutil.copy(path, tmp_dir / f"{source_hash}{path.suffix}")
+            chunks, embeddings = append_embeddings(
+                new_documents(), self._embedder, max_tokens=self._max_tokens, store=self._store, sources=sources,
+                chunk_cache=self._chunk_cache,
+            )
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+        self.__append_data(chunks, embeddings)
+        self._sources.update(sources)
+        logger.info(f"Added {len(sources)} documents with {len(chunks)} chunks")
 
-        self.__dict__["_data"] = concat([self._data, data], ignore_index=True, sort=False)
-        self.__dict__["_data"] = create_embeddings(self._data, self._embedder, max_tokens=self._max_tokens)
-        logger.info("Document added successfully")
+    def __append_data(self, chunks: DataFrame, embeddings: np.ndarray) -> None:
+        if not len(chunks):
+            return
+        data, vector_index, lexical_index = self._index
+        if lexical_index is not None:
+            lexical_index = lexical_index.extend(chunks['text'].values)
+        if self._store is not None and len(self._store) == len(data) + len(chunks):
+            self.__set_index(self._store.chunks, vector_index.extend(self._store.embeddings), lexical_index)
+        elif data.empty:
+            self.__set_data(chunks.reset_index(drop=True), embeddings)
+        else:
+            self.__set_index(
+                concat([data, chunks], ignore_index=True, sort=False),
+                vector_index.extend(np.concatenate([vector_index.embeddings, embeddings])),
+                lexical_index,
+            )
 
     def set_num_of_relevant_chunks(self, num: int) -> None:
         self.__dict__["_num_of_relevant_chunks"] = num
 
-    def __get_text_from_table(self, relevant_chunk_index: int) -> str:
-        if self._data.empty:
+    def __get_text_from_table(self, data: DataFrame, relevant_chunk_index: int) -> str:
+        if data.empty:
             return ""
 
-        filename = self._data['name']
-        filtered_data = self._data['text']
-
-        relevant_chunk = filtered_data.astype(str).values[relevant_chunk_index]
+        relevant_chunk = str(data['text'].values[relevant_chunk_index])
 
         logger.info(f"Relevant document is: {repr(relevant_chunk)}")
         return relevant_chunk
 
-    def __sort_data_by_relevancy(self, query: str) -> None:
-        query_embedding = self._embedder.embed_query(query)
-        self._data.sort_values(
-            by=['embedding'],
-            key=lambda series: series.apply(lambda x: cosine_distances(query_embedding, x)),
-            inplace=True,
-            ascending=False,
-        )
+    def recall_at_k(self, k: int = 10, num_of_queries: int = 100) -> float:
+        vector_index = self._index.vector_index
+        if not len(vector_index):
+            return 1.0
+        rng = np.random.default_rng(0)
+        rows = np.sort(rng.choice(len(vector_index), min(num_of_queries, len(vector_index)), replace=False))
+        return recall_at_k(vector_index, np.asarray(vector_index.embeddings[rows]), k)
 
-    def get_relevant_documents(
-        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
-    ) -> List[Document]:
-        self.__sort_data_by_relevancy(query)
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        with metrics.span("query_embedding"):
+            if len(queries) == 1:
+                return normalize_embeddings([self._embedder.embed_query(queries[0])])
+            return normalize_embeddings(self._embedder.embed_documents(queries))
 
-        indexes = self._data['chunk'].astype(str).values
+    def search_embeddings(
+        self,
+        query_embeddings: np.ndarray,
+        k: Optional[int] = None,
+        queries: Optional[List[str]] = None,
+        snapshot: Optional[Snapshot] = None,
+    ) -> List[DataFrame]:
+        data, vector_index, lexical_index = snapshot if snapshot is not None else self._index
+        if data.empty:
+            return [data] * len(query_embeddings)
+
+        k = k or self._num_of_relevant_chunks
+        with metrics.span("search"):
+            if lexical_index is None or queries is None:
+                _, indexes = vector_index.search(query_embeddings, k)
+            else:
+                indexes = [
+                    self.__hybrid_search(vector_index, lexical_index, query_embedding, query, k)
+                    for (query_embedding, query) in zip(query_embeddings, queries)
+                ]
         logger.debug(f"After searching for best documents got indexes: {indexes}")
+        return [data.iloc[row[row >= 0]] for row in indexes]
+
+    def __hybrid_search(
+        self, vector_index: VectorIndex, lexical_index: BM25Index, query_embedding: np.ndarray, query: str, k: int,
+    ) -> np.ndarray:
+        num_of_candidates = max(self._index_config.get("hybrid_candidates", DEFAULT_HYBRID_CANDIDATES), k)
+        prefilter = self._index_config.get("lexical_prefilter", 0)
+        _, lexical_ids = lexical_index.search(query, max(num_of_candidates, prefilter))
+
+        if prefilter and len(vector_index) > prefilter and len(lexical_ids) >= num_of_candidates:
+            candidates = np.sort(lexical_ids)
+            scores = vector_index.embeddings[candidates] @ query_embedding
+            vector_ids = candidates[np.argsort(-scores, kind='stable')[:num_of_candidates]]
+        else:
+            _, vector_ids = vector_index.search(query_embedding, num_of_candidates)
+            vector_ids = vector_ids[0]
+
+        return reciprocal_rank_fusion([vector_ids, lexical_ids[:num_of_candidates]], k, RRF_CONSTANT)
+
+    def search(self, query: str, k: Optional[int] = None) -> DataFrame:
+        return self.search_embeddings(self.embed_queries([query]), k, [query])[0]
+
+    def search_batch(self, queries: List[str], k: Optional[int] = None) -> List[DataFrame]:
+        return self.search_embeddings(self.embed_queries(queries), k, queries)
+
+    async def embed_queries_async(self, queries: List[str]) -> np.ndarray:
+        with metrics.span("query_embedding"):
+            if len(queries) == 1:
+                return normalize_embeddings([await self._embedder.embed_query_async(queries[0])])
+            return normalize_embeddings(await self._embedder.embed_documents_async(queries))
+
+    async def search_async(self, query: str, k: Optional[int] = None) -> DataFrame:
+        query_embeddings = await self.embed_queries_async([query])
+        return (await asyncio.to_thread(self.search_embeddings, query_embeddings, k, [query]))[0]
 
-        num_of_chunks = min(self._num_of_relevant_chunks, len(self._data["name"].values))
+    def get_relevant_documents(self, query: str, *, run_manager=None) -> str:
+        chunks = self.search(query)
         return "\n".join([
-            self.__get_text_from_table(index)
-            for index in range(num_of_chunks)
+            self.__get_text_from_table(chunks, index)
+            for index in range(len(chunks))
         ])
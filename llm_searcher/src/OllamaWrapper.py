@@ -1,35 +1,70 @@
-from langchain.prompts.chat import ChatPromptTemplate
-from typing import Optional
-import logging
+from .clients import get_client, get_async_client
+from . import metrics
 
-import ollama
+from typing import AsyncIterator, Iterator, Optional
+import logging
 
 logger = logging.getLogger(__name__)
 
 
+def count_tokens(response) -> None:
+    metrics.count("prompt_tokens", response.get("prompt_eval_count") or 0)
+    metrics.count("completion_tokens", response.get("eval_count") or 0)
+
+
 class OllamaWrapper:
     def __init__(self, model_name, model_host, prompt_template: Optional[str] = None):
-        logger.info("Creating Ollama client")
         self.__model_name = model_name
-        self.__client = ollama.Client(host=model_host)
-
-        if prompt_template:
-            self.__chat_prompt = ChatPromptTemplate.from_messages([
-                ("system", prompt_template),
-                ("human", "{text}"),
-            ])
-        else:
-            self.__chat_prompt = ChatPromptTemplate.from_messages([
-                ("human", "{text}"),
-            ])
+        self.__model_host = model_host
+        self.__client = get_client(model_host)
+        self.__prompt_template = prompt_template
 
-    def ask_question(self, question: str, context: str) -> str:
-        prompt = self.__chat_prompt.format_messages(
-            context = context,
-            text = question
-        )
-        prompt = [{"role": "user" if msg.type == "human" else "assistant" if msg.type == "ai" else msg.type, "content": msg.content} for msg in prompt]
+    @property
+    def model_name(self) -> str:
+        return self.__model_name
+
+    def __format_prompt(self, question: str, context: str) -> list:
+        # Same messages ChatPromptTemplate produced, without importing langchain on the Ollama path
+        with metrics.span("prompt_formatting"):
+            prompt = [{"role": "user", "content": question}]
+            if self.__prompt_template:
+                system = self.__prompt_template.format(context=context, text=question)
+                prompt.insert(0, {"role": "system", "content": system})
         logger.debug(f"Invoking chat model with prompt: {prompt}")
-        ollama_response = self.__client.chat(model=self.__model_name, messages=prompt)
+        return prompt
+
+    def ask_question(self, question: str, context: str) -> str:
+        prompt = self.__format_prompt(question, context)
+        with metrics.span("generation"):
+            ollama_response = self.__client.chat(model=self.__model_name, messages=prompt)
+        logger.info(f"Got response from ollama: {ollama_response}")
+        count_tokens(ollama_response)
+        return ollama_response["message"]["content"]
+
+    def ask_question_stream(self, question: str, context: str) -> Iterator[str]:
+        prompt = self.__format_prompt(question, context)
+        for chunk in self.__client.chat(model=self.__model_name, messages=prompt, stream=True):
+            if chunk.get("done"):
+                count_tokens(chunk)
+            content = chunk["message"]["content"]
+            if content:
+                yield content
+
+    async def ask_question_async(self, question: str, context: str) -> str:
+        prompt = self.__format_prompt(question, context)
+        with metrics.span("generation"):
+            ollama_response = await get_async_client(self.__model_host).chat(model=self.__model_name, messages=prompt)
         logger.info(f"Got response from ollama: {ollama_response}")
+        count_tokens(ollama_response)
         return ollama_response["message"]["content"]
+
+    async def ask_question_stream_async(self, question: str, context: str) -> AsyncIterator[str]:
+        prompt = self.__format_prompt(question, context)
+        async for chunk in await get_async_client(self.__model_host).chat(
+            model=self.__model_name, messages=prompt, stream=True,
+        ):
+            if chunk.get("done"):
+                count_tokens(chunk)
+            content = chunk["message"]["content"]
+            if content:
+                yield content
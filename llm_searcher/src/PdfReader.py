@@ -1,45 +1,76 @@
-from pandas import DataFrame, read_csv
-from multiprocessing import Process, Queue, cpu_count
+from pandas import DataFrame, read_csv, concat
+from multiprocessing import cpu_count, active_children, Pool, SimpleQueue
+from collections import deque
 from time import time
 import os
 import re
+import hashlib
 import logging
 from pathlib import Path
-from typing import List
+from typing import Iterable, Iterator, List, Optional, Tuple
 
-from .PdfReader_impl import read_pdf
+from .PdfReader_impl import read_pdf, PARSER_VERSION
 
 
 logger = logging.getLogger(__name__)
 
 
-class TextReplacer:
-    def __init__(self, pattern: str, replace_on: str):
-        self.__pattern = pattern
-        self.__replace_on = replace_on
+DEFAULT_PARSE_TIMEOUT_S = 600
+PARSE_TASKS_PER_WORKER = 16
+PARSE_POLL_S = 0.5
+DATABASE_READ_ROWS = 64
 
-    def __call__(self, text: str, flag = 0) -> str:
-        return re.sub(
-            self.__pattern,
-            self.__replace_on,
-            text,
-            flags=flag
-        )
+
+EMPTY_TABLE_CELL = re.compile(r"\|[ \t]*None[ \t]*(?=\|)")
+REPEATED_SPACES = re.compile(r"  +")
+TRAILING_SEPARATORS = re.compile(r"[\s|]*\Z")
+# str.strip() understands only explicit characters, unicode whitespace ends at U+3000
+SEPARATORS = "".join(char for char in map(chr, range(0x3001)) if char.isspace()) + "|"
+
+
+def _remove_empty_cells(text: str) -> str:
+    return EMPTY_TABLE_CELL.sub("|", text) if "None" in text else text
+
+
+def _collapse_separators(text: str) -> str:
+    lines = text.split("\n")
+    if len(lines) > 1:
+        lines = [lines[0].rstrip(SEPARATORS)] \
+            + [stripped for stripped in (line.strip(SEPARATORS) for line in lines[1:-1]) if stripped] \
+            + [lines[-1].lstrip(SEPARATORS)]
+        text = "\n".join(lines)
+    return REPEATED_SPACES.sub(" ", text.replace("|", " "))
 
 
 def clean_text(text: str) -> str:
-    regexes = (
-        TextReplacer(r"[\n]+", r"\n"),
-        TextReplacer(r"[ |]+", r" "),
-        TextReplacer(r"\n+\s+", r"\n"),
-        TextReplacer(r"\s+\n+", r"\n"),
-        TextReplacer(r"None", r""),
-    )
+    return _collapse_separators(_remove_empty_cells(text))
 
-    for replace in regexes:
-        text = replace(text)
 
-    return text
+def clean_text_chunks(chunks: Iterable[str]) -> Iterator[str]:
+    partial_line = ""
+    separators = ""
+    for chunk in chunks:
+        text = partial_line + chunk
+        lines_end = text.rfind("\n") + 1
+        text, partial_line = text[:lines_end], text[lines_end:]
+
+        text = separators + _remove_empty_cells(text)
+        text_end = TRAILING_SEPARATORS.search(text).start()
+        text, separators = text[:text_end], text[text_end:]
+        if text:
+            yield _collapse_separators(text)
+
+    text = separators + _remove_empty_cells(partial_line)
+    if text:
+        yield _collapse_separators(text)
+
+def file_hash(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
 
 def read_file(path: Path):
     extension = path.suffix
@@ -51,80 +82,206 @@ def read_file(path: Path):
 
 
 
-def process_worker(
-    filename_queue: Queue,
-    folder_name: str,
-    result_queue: Queue,
-) -> None:
-    for file in iter(filename_queue.get, None):
-        begin = time()
-        text = read_file(Path(folder_name) / Path(file))
-        end = time()
-        result_queue.put({
-            "name": str(file),
-            "text": clean_text(text),
-            "embedding" : None
-        })
+class ParseCache:
+    def __init__(self, location: str):
+        self.__path = Path(location)
+        self.__path.mkdir(parents=True, exist_ok=True)
 
-        logger.info(
-            f'Finished reading "{file}" it took {end - begin}'
-        )
-    result_queue.put(None)
+    def path_for(self, hash_: str) -> str:
+        return str(self.__path / f"{hash_}-{PARSER_VERSION}.md")
+
+    def get(self, hash_: str) -> Optional[str]:
+        try:
+            with open(self.path_for(hash_), 'r', encoding='utf8') as file:
+                return file.read()
+        except FileNotFoundError:
+            return None
+
+
+_started = None
+
+
+def _init_parse_worker(started: SimpleQueue) -> None:
+    global _started
+    _started = started
+
+
+def parse_worker(path: str, cache_path: Optional[str]) -> str:
+    if _started is not None:
+        _started.put((path, os.getpid()))
+    begin = time()
+    text = read_file(Path(path))
+    end = time()
+    logger.info(
+        f'Finished reading "{path}" it took {end - begin}'
+    )
+
+    if cache_path is not None:
+        tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf8') as file:
+            file.write(text)
+        os.replace(tmp_path, cache_path)
+    return text
 
 
-def load_pdfs(folder_with_pdf: str, database: DataFrame | str, num_of_jobs: int = cpu_count()) -> DataFrame:
-    data = database if isinstance(database, DataFrame) else read_csv(database)
+def terminate_worker(pid: int) -> None:
+    # The pool starts a new worker in place of the terminated one
+    for process in active_children():
+        if process.pid == pid:
+            process.terminate()
 
-    directory = os.fsencode(folder_with_pdf)
 
-    filename_queue = Queue()
-    result_queue = Queue()
+def iter_pdfs(
+    folder_with_pdf: str,
+    skip_names: Iterable[str] = (),
+    num_of_jobs: int = cpu_count(),
+    timeout_s: float = DEFAULT_PARSE_TIMEOUT_S,
+    cache_location: Optional[str] = None,
+) -> Iterator[Tuple[str, str]]:
+    skip_names = set(skip_names)
+    cache = ParseCache(cache_location) if cache_location else None
 
-    for file in os.listdir(directory):
+    pending = deque()
+    for file in os.listdir(os.fsencode(folder_with_pdf)):
         filename = os.fsdecode(file)
-        if data.empty or filename not in data['name'].unique():
-            logger.info(f'Reading file {filename}')
-            filename_queue.put(filename)
-
-    for _ in range(num_of_jobs):
-        filename_queue.put(None)
-
-    jobs = []
-    for _ in range(num_of_jobs - 1):
-        p = Process(
-                target=process_worker,
-                args=(filename_queue, folder_with_pdf, result_queue)
-            )
-        p.start()
-        jobs.append(p)
-
-    process_worker(filename_queue, folder_with_pdf, result_queue)
-
-    result_data = {
-        "name": [],
-        "text": [],
-        "embedding" : []
-    }
-    item = result_queue.get()
-    num_of_nones = 1 if item is None else 0
-
-    while num_of_nones < num_of_jobs:
-        if item is not None:
-            for key, value in item.items():
-                result_data[key].append(value)
-        item = result_queue.get()
-        if item is None:
-            num_of_nones += 1
-
-    for job in jobs:
-        job.join()
-
-    if data.empty:
-        data = DataFrame(result_data)
-    else:
-        for (name, text) in zip(result_data["name"], result_data["text"]):
-            data.loc[len(data)] = [name, text, None]
+        if filename in skip_names:
+            continue
+        if not (Path(folder_with_pdf) / filename).is_file():
+            logger.warning(f'Skipping "{filename}", it is not a regular file')
+            continue
+        logger.info(f'Reading file {filename}')
+        pending.append(filename)
+
+    # Each file's time budget starts when a worker reports that it picked the file up
+    in_flight = {}
+    workers = {}
+    started = None
+    pool = None
+
+    try:
+        while pending or in_flight:
+            while pending and len(in_flight) < num_of_jobs:
+                filename = pending.popleft()
+                path = Path(folder_with_pdf) / filename
+                cache_path = None
+                if cache is not None:
+                    try:
+                        hash_ = file_hash(path)
+                        text = cache.get(hash_)
+                    except Exception as ex:
+                        logger.error(f'Failed to read "{filename}": {ex}')
+                        continue
+                    if text is not None:
+                        logger.info(f'Found "{filename}" in parse cache')
+                        yield filename, text
+                        continue
+                    cache_path = cache.path_for(hash_)
+
+                if pool is None:
+                    started = SimpleQueue()
+                    pool = Pool(num_of_jobs, _init_parse_worker, (started,), PARSE_TASKS_PER_WORKER)
+                in_flight[str(path)] = (filename, pool.apply_async(parse_worker, (str(path), cache_path)))
+
+            if not in_flight:
+                continue
+
+            wait_s = min([PARSE_POLL_S] + [workers[path][1] - time() for path in in_flight if path in workers])
+            next(iter(in_flight.values()))[1].wait(max(wait_s, 0))
+
+            for (path, (filename, result)) in list(in_flight.items()):
+                if not result.ready():
+                    continue
+                del in_flight[path]
+                try:
+                    text = result.get(timeout=0)
+                except Exception as ex:
+                    logger.error(f'Failed to read "{filename}": {ex}')
+                    continue
+                yield filename, text
+
+            while not started.empty():
+                path, pid = started.get()
+                workers[path] = (pid, time() + timeout_s)
+
+            alive = {process.pid for process in active_children()}
+            for (path, (filename, result)) in list(in_flight.items()):
+                if path not in workers:
+                    continue
+                pid, deadline = workers[path]
+                if deadline <= time():
+                    logger.error(f'Reading "{filename}" took more than {timeout_s}s, skipping it')
+                    terminate_worker(pid)
+                elif pid not in alive and not result.wait(PARSE_POLL_S):
+                    logger.error(f'Worker crashed while reading "{filename}", skipping it')
+                else:
+                    continue
+                del in_flight[path]
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def load_pdfs(
+    folder_with_pdf: str,
+    database: DataFrame | str,
+    num_of_jobs: int = cpu_count(),
+    timeout_s: float = DEFAULT_PARSE_TIMEOUT_S,
+    cache_location: Optional[str] = None,
+) -> DataFrame:
+    data = database if isinstance(database, DataFrame) else read_csv(database, keep_default_na=False)
+
+    skip_names = data['name'].unique() if not data.empty else ()
+    new_data = DataFrame(
+        list(iter_pdfs(folder_with_pdf, skip_names, num_of_jobs, timeout_s, cache_location)),
+        columns=["name", "text"],
+    )
+    new_data["embedding"] = None
+
+    data = new_data if data.empty else concat([data, new_data], ignore_index=True, sort=False)
 
     if isinstance(database, str):
         data.to_csv(database, index=False)
     return data
+
+
+def iter_database(location: str) -> Iterator[Tuple[str, str]]:
+    name, texts = None, []
+    for rows in read_csv(location, usecols=['name', 'text'], dtype=str, keep_default_na=False,
+                         chunksize=DATABASE_READ_ROWS):
+        for (row_name, text) in zip(rows['name'].values, rows['text'].values):
+            if texts and row_name != name:
+                yield name, ''.join(texts)
+                texts = []
+            name = row_name
+            texts.append(text)
+    if texts:
+        yield name, ''.join(texts)
+
+
+def stream_pdfs(
+    folder_with_pdf: str,
+    database_location: str,
+    num_of_jobs: int = cpu_count(),
+    timeout_s: float = DEFAULT_PARSE_TIMEOUT_S,
+    cache_location: Optional[str] = None,
+) -> Iterator[Tuple[str, str]]:
+    names = set()
+    columns = ["name", "text", "embedding"]
+    if os.path.exists(database_location) and os.path.getsize(database_location):
+        columns = list(read_csv(database_location, nrows=0).columns)
+        for (name, text) in iter_database(database_location):
+            names.add(name)
+            yield name, text
+        write_header = False
+    else:
+        write_header = True
+
+    # Every parsed document is appended as soon as it arrives, so an interrupted start keeps what it parsed
+    with open(database_location, 'a', encoding='utf8', newline='') as database:
+        for (name, text) in iter_pdfs(folder_with_pdf, names, num_of_jobs, timeout_s, cache_location):
+            row = DataFrame([{"name": name, "text": text}], columns=columns)
+            row.to_csv(database, header=write_header, index=False)
+            database.flush()
+            write_header = False
+            yield name, text
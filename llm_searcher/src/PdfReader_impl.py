@@ -1,4 +1,10 @@
-import pymupdf4llm
+from importlib.metadata import version
+
+
+PARSER_VERSION = f"pymupdf4llm-{version('pymupdf4llm')}"
+
 
 def read_pdf(pdf_path: str) -> list[str]:
+    import pymupdf4llm
+
     return pymupdf4llm.to_markdown(pdf_path)
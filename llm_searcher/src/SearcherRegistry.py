@@ -0,0 +1,121 @@
+from .search import Searcher, AsyncSearcher, build_retriever, retriever_key
+from .MyRetriever import MyRetriever
+from .ShardedRetriever import ShardedRetriever, LocalShard
+
+from collections import OrderedDict
+from typing import Dict, Optional, Type
+import logging
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MEMORY_BUDGET_MB = 4096
+
+
+def retriever_memory(retriever: Optional[MyRetriever]) -> int:
+    if retriever is None:
+        return 0
+    if isinstance(retriever, ShardedRetriever):
+        return sum(retriever_memory(shard.retriever) for shard in retriever.shards if isinstance(shard, LocalShard))
+    data, vector_index, lexical_index = retriever.snapshot
+    return int(data.memory_usage(index=True, deep=True).sum()) + vector_index.nbytes \
+        + (lexical_index.nbytes if lexical_index is not None else 0)
+
+
+def retriever_snapshots(retriever: Optional[MyRetriever]) -> tuple:
+    # ShardedRetriever builds a new tuple on every access, the shard snapshots in it stay the same objects
+    if retriever is None:
+        return ()
+    if isinstance(retriever, ShardedRetriever):
+        return retriever.snapshot
+    return (retriever.snapshot,)
+
+
+class SearcherRegistry:
+    def __init__(
+        self,
+        configs: dict,
+        memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB,
+        searcher_class: Type[Searcher] = AsyncSearcher,
+    ):
+        self.__configs = configs
+        self.__memory_budget = memory_budget_mb * 2 ** 20
+        self.__searcher_class = searcher_class
+        self.__searchers: "OrderedDict[str, Searcher]" = OrderedDict()
+        self.__retrievers: Dict[str, Optional[MyRetriever]] = {}
+        self.__memory: Dict[str, tuple] = {}
+        self.__lock = threading.Lock()
+        self.__build_locks: Dict[str, threading.Lock] = {}
+
+    def __contains__(self, searcher_name: str) -> bool:
+        return searcher_name in self.__searchers
+
+    def get(self, searcher_name: str) -> Searcher:
+        with self.__lock:
+            searcher = self.__searchers.get(searcher_name)
+            if searcher is not None:
+                self.__searchers.move_to_end(searcher_name)
+                return searcher
+
+        config = self.__configs.get(searcher_name)
+        if not config:
+            raise RuntimeError(f"Could not find searcher config {searcher_name}")
+        key = retriever_key(config)
+        with self.__lock:
+            build_lock = self.__build_locks.setdefault(key, threading.Lock())
+
+        with build_lock:
+            with self.__lock:
+                searcher = self.__searchers.get(searcher_name)
+                shared = key in self.__retrievers
+                retriever = self.__retrievers.get(key)
+            if searcher is not None:
+                return searcher
+
+            begin = time.time()
+            if not shared:
+                retriever = build_retriever(config)
+            searcher = self.__searcher_class(config, retriever=retriever)
+            logger.info(
+                f"Built searcher {searcher_name} in {time.time() - begin:.2f}s"
+                f"{' reusing shared retriever' if shared else ''}"
+            )
+
+            with self.__lock:
+                self.__retrievers[key] = retriever
+                self.__searchers[searcher_name] = searcher
+                self.__evict()
+        return searcher
+
+    def __used_memory(self) -> int:
+        used = 0
+        for key, retriever in self.__retrievers.items():
+            snapshots = retriever_snapshots(retriever)
+            cached = self.__memory.get(key)
+            if cached is None or len(cached[0]) != len(snapshots) \
+                    or any(old is not new for (old, new) in zip(cached[0], snapshots)):
+                cached = self.__memory[key] = (snapshots, retriever_memory(retriever))
+            used += cached[1]
+        return used
+
+    def __evict(self) -> None:
+        while len(self.__searchers) > 1 and self.__used_memory() > self.__memory_budget:
+            searcher_name, searcher = self.__searchers.popitem(last=False)
+            logger.info(f"Evicting searcher {searcher_name} to stay under the memory budget")
+            retriever = searcher.retriever
+            if all(other.retriever is not retriever for other in self.__searchers.values()):
+                for key in [key for key, value in self.__retrievers.items() if value is retriever]:
+                    del self.__retrievers[key]
+                    self.__memory.pop(key, None)
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                "searchers": list(self.__searchers),
+                "retrievers": len(self.__retrievers),
+                "memory_mb": self.__used_memory() / 2 ** 20,
+                "memory_budget_mb": self.__memory_budget / 2 ** 20,
+            }
@@ -0,0 +1,72 @@
+from .MyRetriever import MyRetriever
+from .ShardedRetriever import LocalShard
+from .EmbeddingStore import CHUNK_COLUMNS
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+import json
+import logging
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+
+class ShardServer:
+    def __init__(self, retriever: MyRetriever, host: str = "127.0.0.1", port: int = 0):
+        shard = LocalShard(retriever, f"{host}:{port}")
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def do_GET(self):
+                if self.path != "/health":
+                    return self.__reply(404, {"error": f"Unknown path {self.path}"})
+                self.__reply(200, {"snapshot_version": retriever.snapshot_version, "chunks": len(retriever.snapshot.data)})
+
+            def do_POST(self):
+                if self.path != "/search":
+                    return self.__reply(404, {"error": f"Unknown path {self.path}"})
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    results = shard.search(np.asarray(request["embeddings"], dtype=np.float32), int(request["k"]))
+                except Exception as ex:
+                    logger.error(f"Failed to serve search request: {ex}")
+                    return self.__reply(400, {"error": str(ex)})
+                self.__reply(200, {"results": [
+                    {"scores": scores.tolist(), "chunks": chunks[CHUNK_COLUMNS].to_dict('records')}
+                    for (scores, chunks) in results
+                ]})
+
+            def __reply(self, status: int, body: dict) -> None:
+                payload = json.dumps(body).encode('utf8')
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                logger.debug(f"{self.address_string()} {format % args}")
+
+        self.__server = ThreadingHTTPServer((host, port), Handler)
+        self.__server.daemon_threads = True
+
+    @property
+    def url(self) -> str:
+        host, port = self.__server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def serve_forever(self) -> None:
+        logger.info(f"Serving shard on {self.url}")
+        self.__server.serve_forever()
+
+    def shutdown(self) -> None:
+        self.__server.shutdown()
+        self.__server.server_close()
+
+
+def bind_address(url: str) -> tuple:
+    parts = urlsplit(url)
+    return parts.hostname, parts.port
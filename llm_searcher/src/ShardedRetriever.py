@@ -0,0 +1,216 @@
+from .MyRetriever import MyRetriever
+from .EmbeddingStore import CHUNK_COLUMNS
+from .embeddings import normalize_embeddings
+from . import metrics
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait
+from itertools import islice
+from pathlib import Path
+from typing import List, Optional, Tuple
+import asyncio
+import heapq
+import logging
+import threading
+import time
+
+import httpx
+import numpy as np
+from pandas import DataFrame, concat
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_SHARD_TIMEOUT_S = 2.0
+DEFAULT_SHARD_RETRY_S = 10.0
+MAX_CONCURRENT_SEARCHES_PER_SHARD = 8
+
+ShardResult = Tuple[np.ndarray, DataFrame]
+
+
+def shard_of(document_hash: str, num_of_shards: int) -> int:
+    return int(document_hash[:16], 16) % num_of_shards
+
+
+def shard_location(location: str, shard: int) -> str:
+    return str(Path(location) / f"shard-{shard:03d}")
+
+
+def partition(chunks: DataFrame, num_of_shards: int) -> List[np.ndarray]:
+    shards = np.array([shard_of(document_hash, num_of_shards) for document_hash in chunks['document_hash'].values],
+                      dtype=np.int64)
+    return [np.flatnonzero(shards == shard) for shard in range(num_of_shards)]
+
+
+class Shard(ABC):
+    name: str
+
+    @abstractmethod
+    def search(self, query_embeddings: np.ndarray, k: int) -> List[ShardResult]:
+        pass
+
+
+class LocalShard(Shard):
+    def __init__(self, retriever: MyRetriever, name: str):
+        self.name = name
+        self.__retriever = retriever
+
+    @property
+    def retriever(self) -> MyRetriever:
+        return self.__retriever
+
+    def search(self, query_embeddings: np.ndarray, k: int) -> List[ShardResult]:
+        data, vector_index, _ = self.__retriever.snapshot
+        if data.empty:
+            return [(np.empty(0, dtype=np.float32), data)] * len(query_embeddings)
+        scores, ids = vector_index.search(query_embeddings, k)
+        return [(row_scores[row >= 0], data.iloc[row[row >= 0]]) for (row_scores, row) in zip(scores, ids)]
+
+
+class HttpShard(Shard):
+    def __init__(self, url: str, timeout_s: float = DEFAULT_SHARD_TIMEOUT_S):
+        self.name = url
+        self.__client = httpx.Client(base_url=url, timeout=timeout_s)
+
+    def search(self, query_embeddings: np.ndarray, k: int) -> List[ShardResult]:
+        response = self.__client.post("/search", json={"embeddings": np.asarray(query_embeddings).tolist(), "k": k})
+        response.raise_for_status()
+        return [
+            (np.array(result["scores"], dtype=np.float32), DataFrame(result["chunks"], columns=CHUNK_COLUMNS))
+            for result in response.json()["results"]
+        ]
+
+
+class ShardedRetriever:
+    def __init__(
+        self,
+        shards: List[Shard],
+        embedder,
+        timeout_s: float = DEFAULT_SHARD_TIMEOUT_S,
+        retry_s: float = DEFAULT_SHARD_RETRY_S,
+    ):
+        logger.info(f"Creating ShardedRetriever over {len(shards)} shards")
+        self.__shards = shards
+        self.__embedder = embedder
+        self.__timeout_s = timeout_s
+        self.__retry_s = retry_s
+        self.__num_of_relevant_chunks = 2
+        self.__down_until = [0.0] * len(shards)
+        self.__lock = threading.Lock()
+        self.__executor = ThreadPoolExecutor(
+            max_workers=max(len(shards), 1) * MAX_CONCURRENT_SEARCHES_PER_SHARD, thread_name_prefix="shard",
+        )
+
+    @property
+    def embedder(self):
+        return self.__embedder
+
+    @property
+    def shards(self) -> List[Shard]:
+        return self.__shards
+
+    @property
+    def snapshot(self) -> tuple:
+        return tuple(shard.retriever.snapshot for shard in self.__shards if isinstance(shard, LocalShard))
+
+    def add_documents(self, paths: List[Path]) -> None:
+        raise RuntimeError("Sharded index is read only, rebuild it with --mode build-index")
+
+    def add_document(self, path: Path) -> None:
+        self.add_documents([path])
+
+    def set_num_of_relevant_chunks(self, num: int) -> None:
+        self.__num_of_relevant_chunks = num
+
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        with metrics.span("query_embedding"):
+            if len(queries) == 1:
+                return normalize_embeddings([self.__embedder.embed_query(queries[0])])
+            return normalize_embeddings(self.__embedder.embed_documents(queries))
+
+    async def embed_queries_async(self, queries: List[str]) -> np.ndarray:
+        with metrics.span("query_embedding"):
+            if len(queries) == 1:
+                return normalize_embeddings([await self.__embedder.embed_query_async(queries[0])])
+            return normalize_embeddings(await self.__embedder.embed_documents_async(queries))
+
+    def __mark_down(self, shard: int) -> None:
+        # Queries skip the shard until it may have recovered instead of waiting for it again
+        with self.__lock:
+            self.__down_until[shard] = time.monotonic() + self.__retry_s
+
+    def __search_shard(self, shard: int, query_embeddings: np.ndarray, k: int) -> List[ShardResult]:
+        try:
+            return self.__shards[shard].search(query_embeddings, k)
+        except Exception:
+            self.__mark_down(shard)
+            raise
+
+    def search_embeddings(
+        self, query_embeddings: np.ndarray, k: Optional[int] = None, queries: Optional[List[str]] = None,
+    ) -> List[DataFrame]:
+        k = k or self.__num_of_relevant_chunks
+        now = time.monotonic()
+        with self.__lock:
+            skipped = [shard for shard in range(len(self.__shards)) if self.__down_until[shard] > now]
+
+        with metrics.span("search"):
+            futures = {
+                self.__executor.submit(self.__search_shard, shard, query_embeddings, k): shard
+                for shard in range(len(self.__shards)) if shard not in skipped
+            }
+            _, not_done = wait(futures, timeout=self.__timeout_s)
+
+            results, missing = [], [self.__shards[shard].name for shard in skipped]
+            for future in futures:
+                shard = self.__shards[futures[future]]
+                if future in not_done:
+                    self.__mark_down(futures[future])
+                    logger.warning(f"Shard {shard.name} did not answer in {self.__timeout_s}s")
+                    metrics.count("shard_timeouts", shard=shard.name)
+                    missing.append(shard.name)
+                elif future.exception() is not None:
+                    logger.warning(f"Shard {shard.name} failed: {future.exception()}")
+                    metrics.count("shard_errors", shard=shard.name)
+                    missing.append(shard.name)
+                else:
+                    results.append(future.result())
+
+        if missing:
+            logger.warning(f"Returning results without shards {missing}")
+        return [
+            self.__merge([shard_results[query] for shard_results in results], k, missing)
+            for query in range(len(query_embeddings))
+        ]
+
+    def __merge(self, results: List[ShardResult], k: int, missing: List[str]) -> DataFrame:
+        # Every shard returns its local top k sorted by score, so the global top k is a k-way merge
+        ranked = heapq.merge(
+            *[
+                zip(scores.tolist(), [shard] * len(scores), range(len(scores)))
+                for (shard, (scores, _)) in enumerate(results)
+            ],
+            key=lambda item: item[0],
+            reverse=True,
+        )
+        best = list(islice(ranked, k))
+        if best:
+            chunks = concat([results[shard][1].iloc[[row]] for (_, shard, row) in best], ignore_index=True)
+        else:
+            chunks = DataFrame(columns=CHUNK_COLUMNS)
+        chunks.attrs["missing_shards"] = missing
+        return chunks
+
+    def search(self, query: str, k: Optional[int] = None) -> DataFrame:
+        return self.search_embeddings(self.embed_queries([query]), k, [query])[0]
+
+    def search_batch(self, queries: List[str], k: Optional[int] = None) -> List[DataFrame]:
+        return self.search_embeddings(self.embed_queries(queries), k, queries)
+
+    async def search_async(self, query: str, k: Optional[int] = None) -> DataFrame:
+        query_embeddings = await self.embed_queries_async([query])
+        return (await asyncio.to_thread(self.search_embeddings, query_embeddings, k, [query]))[0]
+
+    def get_relevant_documents(self, query: str, *, run_manager=None) -> str:
+        return "\n".join(str(text) for text in self.search(query)['text'].values)
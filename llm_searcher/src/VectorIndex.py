@@ -0,0 +1,321 @@
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Optional, Tuple
+import numpy as np
+import hashlib
+import logging
+import math
+import os
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_IVF_NUM_PROBES = 8
+IVF_TRAINING_ITERATIONS = 10
+IVF_TRAINING_POINTS_PER_LIST = 64
+IVF_ASSIGNMENT_BLOCK = 1 << 16
+QUANTIZATION_BLOCK = 1 << 14
+SCORING_BLOCK_BYTES = 1 << 19
+DEFAULT_RESCORE_FACTOR = 4
+INT8_MAX = 127
+
+
+def fingerprint(embeddings: np.ndarray, count: int) -> str:
+    rows = np.unique(np.linspace(0, count - 1, num=min(count, 64)).astype(np.int64)) if count else []
+    return hashlib.sha1(np.ascontiguousarray(embeddings[rows]).tobytes()).hexdigest()
+
+
+def top_k(scores: np.ndarray, k: int) -> np.ndarray:
+    scores = np.atleast_2d(scores)
+    k = min(k, scores.shape[1])
+    if k <= 0:
+        return np.empty((scores.shape[0], 0), dtype=np.int64)
+    if k < scores.shape[1]:
+        best = np.argpartition(scores, -k, axis=1)[:, -k:]
+    else:
+        best = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+    order = np.argsort(-np.take_along_axis(scores, best, axis=1), axis=1, kind='stable')
+    return np.take_along_axis(best, order, axis=1)
+
+
+class QuantizedMatrix:
+    def __init__(self, values: np.ndarray, scales: Optional[np.ndarray] = None):
+        self.values = values
+        self.scales = scales
+
+    @classmethod
+    def build(cls, embeddings: np.ndarray, quantization: str) -> "QuantizedMatrix":
+        if quantization not in ("float16", "int8"):
+            raise RuntimeError(f"Got unexpected vector quantization {quantization}")
+        dtype = np.float16 if quantization == "float16" else np.int8
+        values = np.empty(embeddings.shape, dtype=dtype)
+        scales = np.empty(len(embeddings), dtype=np.float32) if dtype == np.int8 else None
+        for begin in range(0, len(embeddings), QUANTIZATION_BLOCK):
+            block = np.asarray(embeddings[begin:begin + QUANTIZATION_BLOCK], dtype=np.float32)
+            if scales is None:
+                values[begin:begin + len(block)] = block
+                continue
+            block_scales = np.abs(block).max(axis=1, initial=0) / INT8_MAX
+            block_scales[block_scales == 0] = 1
+            values[begin:begin + len(block)] = np.rint(block / block_scales[:, None])
+            scales[begin:begin + len(block)] = block_scales
+        return cls(values, scales)
+
+    @property
+    def quantization(self) -> str:
+        return "int8" if self.scales is not None else "float16"
+
+    @property
+    def nbytes(self) -> int:
+        return self.values.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+    def extend(self, embeddings: np.ndarray) -> "QuantizedMatrix":
+        added = QuantizedMatrix.build(embeddings[len(self):], self.quantization)
+        return QuantizedMatrix(
+            np.concatenate([self.values, added.values]),
+            np.concatenate([self.scales, added.scales]) if self.scales is not None else None,
+        )
+
+    def scores(self, queries: np.ndarray, rows: Optional[np.ndarray] = None) -> np.ndarray:
+        values = self.values if rows is None else self.values[rows]
+        scores = np.empty((len(queries), len(values)), dtype=np.float32)
+        # numpy has no float16/int8 matrix product, so blocks are widened while they are still in cache
+        block_size = max(SCORING_BLOCK_BYTES // (4 * max(values.shape[1], 1)), 1)
+        for begin in range(0, len(values), block_size):
+            block = values[begin:begin + block_size].astype(np.float32)
+            scores[:, begin:begin + len(block)] = queries @ block.T
+        if self.scales is not None:
+            scores *= self.scales if rows is None else self.scales[rows]
+        return scores
+
+
+class VectorIndex(ABC):
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        quantized: Optional[QuantizedMatrix] = None,
+        rescore_factor: int = DEFAULT_RESCORE_FACTOR,
+    ):
+        self._embeddings = embeddings
+        self._quantized = quantized
+        self._rescore_factor = rescore_factor
+        if quantized is not None and len(quantized) != len(embeddings):
+            self._quantized = quantized.extend(embeddings)
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        return self._embeddings
+
+    @property
+    def quantized(self) -> Optional[QuantizedMatrix]:
+        return self._quantized
+
+    @property
+    def nbytes(self) -> int:
+        if self._quantized is None:
+            return self._embeddings.nbytes
+        # Full precision rows are only paged in for rescoring when they are memory mapped
+        resident = 0 if isinstance(self._embeddings, np.memmap) else self._embeddings.nbytes
+        return resident + self._quantized.nbytes
+
+    def __len__(self) -> int:
+        return len(self._embeddings)
+
+    def _top_k_rows(self, query: np.ndarray, k: int, candidates: Optional[np.ndarray] = None,
+                    approximate: Optional[np.ndarray] = None) -> Tuple[np.ndarray, np.ndarray]:
+        if self._quantized is None:
+            scores = (self._embeddings if candidates is None else self._embeddings[candidates]) @ query
+            best = top_k(scores, k)[0]
+            return scores[best], best if candidates is None else candidates[best]
+
+        if approximate is None:
+            approximate = self._quantized.scores(query[None, :], candidates)[0]
+        coarse = top_k(approximate, k * self._rescore_factor)[0]
+        coarse = np.sort(coarse if candidates is None else candidates[coarse])
+        scores = np.asarray(self._embeddings[coarse], dtype=np.float32) @ query
+        best = top_k(scores, k)[0]
+        return scores[best], coarse[best]
+
+    @abstractmethod
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        pass
+
+    @abstractmethod
+    def extend(self, embeddings: np.ndarray) -> "VectorIndex":
+        pass
+
+    def save(self, path: Path) -> None:
+        pass
+
+
+class FlatIndex(VectorIndex):
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.atleast_2d(queries)
+        if not len(self):
+            return np.empty((len(queries), 0), dtype=np.float32), np.empty((len(queries), 0), dtype=np.int64)
+        if self._quantized is None:
+            scores = queries @ self._embeddings.T
+            ids = top_k(scores, k)
+            return np.take_along_axis(scores, ids, axis=1), ids
+
+        approximate = self._quantized.scores(queries)
+        results = [self._top_k_rows(query, k, approximate=row) for (query, row) in zip(queries, approximate)]
+        return np.stack([scores for (scores, _) in results]), np.stack([ids for (_, ids) in results])
+
+    def extend(self, embeddings: np.ndarray) -> "FlatIndex":
+        return FlatIndex(embeddings, self._quantized, self._rescore_factor)
+
+
+class IVFIndex(VectorIndex):
+    FILE_NAME = "ivf.npz"
+
+    def __init__(
+        self,
+        embeddings: np.ndarray,
+        num_lists: Optional[int] = None,
+        num_probes: int = DEFAULT_IVF_NUM_PROBES,
+        centroids: Optional[np.ndarray] = None,
+        assignments: Optional[np.ndarray] = None,
+        quantized: Optional[QuantizedMatrix] = None,
+        rescore_factor: int = DEFAULT_RESCORE_FACTOR,
+    ):
+        super().__init__(embeddings, quantized, rescore_factor)
+        self.__num_lists = num_lists
+        self.__num_probes = num_probes
+        self.__centroids = centroids
+        self.__assignments = np.empty(0, dtype=np.int32) if assignments is None else assignments
+        self.__lists = []
+
+        if self.__centroids is None:
+            self.__train()
+        self.__assignments = np.concatenate([
+            self.__assignments, self.__assign(self._embeddings[len(self.__assignments):]),
+        ])
+        self.__build_lists()
+
+    @property
+    def num_lists(self) -> int:
+        return 0 if self.__centroids is None else len(self.__centroids)
+
+    def __train(self) -> None:
+        num_lists = self.__num_lists or max(1, int(2 * math.sqrt(len(self))))
+        if len(self) < num_lists * IVF_TRAINING_POINTS_PER_LIST // 4:
+            logger.info(f"Not enough vectors ({len(self)}) to train {num_lists} IVF lists, using exact search")
+            return
+
+        rng = np.random.default_rng(0)
+        sample_size = min(len(self), num_lists * IVF_TRAINING_POINTS_PER_LIST)
+        sample = np.asarray(self._embeddings[np.sort(rng.choice(len(self), sample_size, replace=False))])
+        centroids = sample[rng.choice(sample_size, num_lists, replace=False)].copy()
+
+        for _ in range(IVF_TRAINING_ITERATIONS):
+            assignments = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, assignments, sample)
+            empty = np.bincount(assignments, minlength=num_lists) == 0
+            sums[empty] = sample[rng.choice(sample_size, int(empty.sum()))]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1
+            centroids = (sums / norms).astype(np.float32)
+
+        self.__centroids = centroids
+        logger.info(f"Trained IVF index with {num_lists} lists on {sample_size} vectors")
+
+    def __assign(self, embeddings: np.ndarray) -> np.ndarray:
+        if self.__centroids is None or not len(embeddings):
+            return np.empty(0, dtype=np.int32)
+        return np.concatenate([
+            np.argmax(embeddings[begin:begin + IVF_ASSIGNMENT_BLOCK] @ self.__centroids.T, axis=1).astype(np.int32)
+            for begin in range(0, len(embeddings), IVF_ASSIGNMENT_BLOCK)
+        ])
+
+    def __build_lists(self) -> None:
+        if self.__centroids is None:
+            return
+        order = np.argsort(self.__assignments, kind='stable')
+        bounds = np.searchsorted(self.__assignments[order], np.arange(self.num_lists + 1))
+        self.__lists = [order[begin:end] for begin, end in zip(bounds[:-1], bounds[1:])]
+
+    def search(self, queries: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        queries = np.atleast_2d(queries)
+        if self.__centroids is None:
+            return FlatIndex(self._embeddings, self._quantized, self._rescore_factor).search(queries, k)
+
+        num_probes = min(self.__num_probes, self.num_lists)
+        probes = top_k(queries @ self.__centroids.T, num_probes)
+        k = min(k, len(self))
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        for (row, query) in enumerate(queries):
+            candidates = np.concatenate([self.__lists[probe] for probe in probes[row]])
+            best_scores, best_ids = self._top_k_rows(query, k, candidates)
+            scores[row, :len(best_ids)] = best_scores
+            ids[row, :len(best_ids)] = best_ids
+        return scores, ids
+
+    def extend(self, embeddings: np.ndarray) -> "IVFIndex":
+        return IVFIndex(
+            embeddings, self.__num_lists, self.__num_probes,
+            centroids=self.__centroids, assignments=self.__assignments,
+            quantized=self._quantized, rescore_factor=self._rescore_factor,
+        )
+
+    def save(self, path: Path) -> None:
+        if self.__centroids is None:
+            return
+        tmp_path = path / f"{self.FILE_NAME}.tmp.npz"
+        np.savez(
+            tmp_path,
+            centroids=self.__centroids,
+            assignments=self.__assignments,
+            fingerprint=fingerprint(self._embeddings, len(self.__assignments)),
+        )
+        os.replace(tmp_path, path / self.FILE_NAME)
+
+    @classmethod
+    def load(cls, path: Path, embeddings: np.ndarray, num_lists: Optional[int] = None,
+             num_probes: int = DEFAULT_IVF_NUM_PROBES, quantized: Optional[QuantizedMatrix] = None,
+             rescore_factor: int = DEFAULT_RESCORE_FACTOR) -> "IVFIndex":
+        try:
+            with np.load(path / cls.FILE_NAME) as saved:
+                centroids, assignments = saved["centroids"], saved["assignments"]
+                saved_fingerprint = str(saved["fingerprint"])
+            if centroids.shape[1] != embeddings.shape[1] or len(assignments) > len(embeddings) \
+                    or (num_lists and num_lists != len(centroids)) \
+                    or saved_fingerprint != fingerprint(embeddings, len(assignments)):
+                raise RuntimeError("saved index does not match the embeddings")
+        except Exception as ex:
+            logger.info(f"Building new IVF index, saved one is not usable: {ex}")
+            return cls(embeddings, num_lists, num_probes, quantized=quantized, rescore_factor=rescore_factor)
+        return cls(embeddings, num_lists, num_probes, centroids=centroids, assignments=assignments,
+                   quantized=quantized, rescore_factor=rescore_factor)
+
+
+def recall_at_k(index: VectorIndex, queries: np.ndarray, k: int) -> float:
+    _, expected = FlatIndex(index.embeddings).search(queries, k)
+    _, found = index.search(queries, k)
+    hits = sum(len(set(row_expected) & set(row_found)) for row_expected, row_found in zip(expected, found))
+    return hits / max(expected.size, 1)
+
+
+def create_vector_index(embeddings: np.ndarray, config: Optional[dict] = None, path: Optional[Path] = None) -> VectorIndex:
+    config = config or {}
+    index_name = config.get("vector_index", "flat")
+    quantization = config.get("vector_quantization", "float32")
+    rescore_factor = config.get("rescore_factor", DEFAULT_RESCORE_FACTOR)
+    quantized = QuantizedMatrix.build(embeddings, quantization) if quantization != "float32" else None
+
+    if index_name == "flat":
+        return FlatIndex(embeddings, quantized, rescore_factor)
+    if index_name == "ivf":
+        num_lists = config.get("ivf_num_lists")
+        num_probes = config.get("ivf_num_probes", DEFAULT_IVF_NUM_PROBES)
+        if path is not None and len(embeddings):
+            return IVFIndex.load(path, embeddings, num_lists, num_probes, quantized, rescore_factor)
+        return IVFIndex(embeddings, num_lists, num_probes, quantized=quantized, rescore_factor=rescore_factor)
+
+    raise RuntimeError(f"Got unexpected vector index type {index_name}")
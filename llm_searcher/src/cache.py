@@ -0,0 +1,76 @@
+from collections import OrderedDict
+from typing import Any, Hashable, Optional
+import json
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+class LRUCache:
+    def __init__(self, max_size: int, ttl_s: Optional[float] = None):
+        self.__max_size = max_size
+        self.__ttl_s = ttl_s
+        self.__items = OrderedDict()
+        self.__lock = threading.Lock()
+        self.__hits = 0
+        self.__misses = 0
+
+    def __len__(self) -> int:
+        return len(self.__items)
+
+    @property
+    def stats(self) -> dict:
+        return {"hits": self.__hits, "misses": self.__misses, "size": len(self.__items)}
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.__lock:
+            item = self.__items.get(key)
+            if item is not None and self.__ttl_s is not None and time.time() - item[1] > self.__ttl_s:
+                del self.__items[key]
+                item = None
+            if item is None:
+                self.__misses += 1
+                return None
+            self.__items.move_to_end(key)
+            self.__hits += 1
+            return item[0]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        if self.__max_size <= 0:
+            return
+        with self.__lock:
+            self.__items[key] = (value, time.time())
+            self.__items.move_to_end(key)
+            while len(self.__items) > self.__max_size:
+                self.__items.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.__lock:
+            self.__items.clear()
+
+    def save(self, path: str) -> None:
+        with self.__lock:
+            items = [[list(key), value, created] for key, (value, created) in self.__items.items()]
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf8') as file:
+            json.dump(items, file)
+        os.replace(tmp_path, path)
+        logger.info(f"Saved {len(items)} cache entries to {path}")
+
+    def load(self, path: str) -> None:
+        if not os.path.exists(path):
+            return
+        try:
+            with open(path, 'r', encoding='utf8') as file:
+                items = json.load(file)
+        except Exception as ex:
+            logger.warning(f"Failed to load cache from {path}: {ex}")
+            return
+        with self.__lock:
+            for key, value, created in items[-self.__max_size:] if self.__max_size > 0 else []:
+                self.__items[tuple(key)] = (value, created)
+        logger.info(f"Loaded {len(items)} cache entries from {path}")
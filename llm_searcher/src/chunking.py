@@ -0,0 +1,182 @@
+from .PdfReader import clean_text
+
+from functools import lru_cache
+from pathlib import Path
+from typing import TYPE_CHECKING, List, Optional, Tuple
+import json
+import logging
+import os
+import re
+
+if TYPE_CHECKING:
+    import tiktoken
+
+
+logger = logging.getLogger(__name__)
+
+
+ENCODING_NAME = "gpt2"
+CHUNKER_VERSION = 2
+CHUNKER_NAME = f"markdown{CHUNKER_VERSION}.{ENCODING_NAME}"
+
+HEADING_BREAK = 4
+PARAGRAPH_BREAK = 3
+SENTENCE_BREAK = 2
+LINE_BREAK = 1
+WORD_BREAK = 0
+
+# A chunk may end this much before its budget to finish at a stronger break
+STRUCTURAL_CUT_SLACK = 1 / 8
+
+HEADING = re.compile(r"#{1,6}\s")
+TABLE_ROW = re.compile(r"\s*\|")
+SENTENCE_END = re.compile(r"[.!?:;]\W*\Z")
+SENTENCE = re.compile(r".+?(?:[.!?]+\s+|\Z)", re.DOTALL)
+WORD = re.compile(r"[^\s|]+[\s|]*|[\s|]+")
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer() -> "tiktoken.Encoding":
+    import tiktoken
+
+    logger.info(f"Loading tokenizer {ENCODING_NAME}")
+    return tiktoken.get_encoding(ENCODING_NAME)
+
+
+def count_tokens(texts: List[str]) -> List[int]:
+    return [len(tokens) for tokens in get_tokenizer().encode_ordinary_batch(texts)]
+
+
+def _clean_line(text: str) -> str:
+    return clean_text(text).strip()
+
+
+def chunk_texts(text: str, boundaries: List[Tuple[int, int]]) -> List[str]:
+    return [clean_text(text[begin:end]) for (begin, end) in boundaries]
+
+
+def _split_long_word(text: str, begin: int, end: int, tokens: int, max_tokens: int) -> List[tuple]:
+    if tokens <= max_tokens or end - begin < 2:
+        return [(begin, end, tokens)]
+    middle = (begin + end) // 2
+    halves = [(begin, middle), (middle, end)]
+    return [
+        unit
+        for ((b, e), half_tokens) in zip(halves, count_tokens([_clean_line(text[b:e]) for (b, e) in halves]))
+        for unit in _split_long_word(text, b, e, half_tokens, max_tokens)
+    ]
+
+
+def _split_long_line(text: str, begin: int, end: int, max_tokens: int, priority: int) -> List[tuple]:
+    sentences = [match.span() for match in SENTENCE.finditer(text, begin, end)]
+    units = []
+    for (sentence, tokens) in zip(sentences, count_tokens([_clean_line(text[b:e]) for (b, e) in sentences])):
+        if tokens <= max_tokens:
+            units.append((*sentence, tokens, priority))
+        else:
+            words = [match.span() for match in WORD.finditer(text, *sentence)]
+            pieces = [
+                piece
+                for (word, word_tokens) in zip(words, count_tokens([_clean_line(text[b:e]) for (b, e) in words]))
+                for piece in _split_long_word(text, *word, word_tokens, max_tokens)
+            ]
+            units.extend((*piece, priority if i == 0 else WORD_BREAK) for i, piece in enumerate(pieces))
+        priority = SENTENCE_BREAK
+    return units
+
+
+def _units(text: str, max_tokens: int) -> List[tuple]:
+    # Breaks are read from the raw markdown, sizes from the cleaned text that gets embedded
+    lines = []
+    begin = 0
+    blank = True
+    for line in text.split("\n"):
+        cleaned = _clean_line(line)
+        if cleaned:
+            lines.append((begin, begin + len(line), cleaned, blank))
+        blank = not cleaned and (not line.strip() or blank)
+        begin += len(line) + 1
+
+    units = []
+    previous_line = None
+    for ((begin, end, cleaned, after_blank), tokens) in zip(lines, count_tokens([line[2] for line in lines])):
+        line = text[begin:end]
+        if HEADING.match(line):
+            priority = HEADING_BREAK
+        elif previous_line is None or after_blank:
+            priority = PARAGRAPH_BREAK
+        elif TABLE_ROW.match(line):
+            priority = SENTENCE_BREAK if TABLE_ROW.match(previous_line) else PARAGRAPH_BREAK
+        elif SENTENCE_END.search(previous_line):
+            priority = SENTENCE_BREAK
+        else:
+            priority = LINE_BREAK
+        previous_line = line
+
+        if tokens + 1 > max_tokens:
+            units.extend(_split_long_line(text, begin, end, max_tokens, priority))
+        else:
+            units.append((begin, end, tokens + 1, priority))
+    return units
+
+
+def split_markdown(text: str, max_tokens: int, overlap: int = 0) -> List[Tuple[int, int]]:
+    units = _units(text, max_tokens)
+    boundaries = []
+    begin = 0
+    while begin < len(units):
+        end, total = begin, 0
+        while end < len(units) and (end == begin or total + units[end][2] <= max_tokens):
+            total += units[end][2]
+            end += 1
+
+        if end < len(units):
+            cut, tail = end, 0
+            for candidate in range(end - 1, begin, -1):
+                tail += units[candidate][2]
+                if tail > max_tokens * STRUCTURAL_CUT_SLACK:
+                    break
+                if units[candidate][3] > units[cut][3]:
+                    cut = candidate
+            end = cut
+        boundaries.append((units[begin][0], units[end - 1][1]))
+
+        next_begin, overlap_tokens = end, 0
+        while next_begin - 1 > begin and overlap_tokens + units[next_begin - 1][2] <= overlap:
+            next_begin -= 1
+            overlap_tokens += units[next_begin][2]
+        begin = next_begin if end < len(units) else end
+    return boundaries
+
+
+class ChunkCache:
+    def __init__(self, location: Optional[str], max_tokens: int, overlap: int):
+        self.__path = Path(location) if location else None
+        self.__suffix = f"{CHUNKER_NAME}-{max_tokens}-{overlap}.json"
+        self.__boundaries = {}
+        if self.__path is not None:
+            self.__path.mkdir(parents=True, exist_ok=True)
+
+    def get(self, document_hash: str) -> Optional[List[Tuple[int, int]]]:
+        boundaries = self.__boundaries.get(document_hash)
+        if boundaries is not None or self.__path is None:
+            return boundaries
+        try:
+            with open(self.__path / f"{document_hash}-{self.__suffix}", 'r', encoding='utf8') as file:
+                boundaries = [tuple(boundary) for boundary in json.load(file)]
+        except FileNotFoundError:
+            return None
+        except Exception as ex:
+            logger.warning(f"Ignoring unreadable chunk boundaries for {document_hash}: {ex}")
+            return None
+        self.__boundaries[document_hash] = boundaries
+        return boundaries
+
+    def put(self, document_hash: str, boundaries: List[Tuple[int, int]]) -> None:
+        self.__boundaries[document_hash] = boundaries
+        if self.__path is None:
+            return
+        path = self.__path / f"{document_hash}-{self.__suffix}"
+        with open(f"{path}.tmp", 'w', encoding='utf8') as file:
+            json.dump(boundaries, file)
+        os.replace(f"{path}.tmp", path)
@@ -0,0 +1,46 @@
+from typing import Dict, Tuple
+import asyncio
+import logging
+import threading
+
+import httpx
+import ollama
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 32
+
+_lock = threading.Lock()
+_clients: Dict[str, ollama.Client] = {}
+_async_clients: Dict[Tuple[str, asyncio.AbstractEventLoop], ollama.AsyncClient] = {}
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=DEFAULT_MAX_CONNECTIONS_PER_HOST,
+        max_keepalive_connections=DEFAULT_MAX_CONNECTIONS_PER_HOST,
+    )
+
+
+def get_client(host: str) -> ollama.Client:
+    with _lock:
+        client = _clients.get(host)
+        if client is None:
+            logger.info(f"Creating Ollama client for {host}")
+            client = _clients[host] = ollama.Client(host=host, limits=_limits())
+        return client
+
+
+def get_async_client(host: str) -> ollama.AsyncClient:
+    loop = asyncio.get_running_loop()
+    with _lock:
+        for key in [key for key in _async_clients if key[1].is_closed()]:
+            del _async_clients[key]
+
+        client = _async_clients.get((host, loop))
+        if client is None:
+            logger.info(f"Creating async Ollama client for {host}")
+            client = _async_clients[(host, loop)] = ollama.AsyncClient(host=host, limits=_limits())
+        return client
@@ -0,0 +1,100 @@
+from .chunking import get_tokenizer
+
+from pandas import DataFrame
+from typing import List, Optional
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_DEDUP_THRESHOLD = 0.9
+MAX_OVERLAP_CHARS = 2048
+MIN_OVERLAP_CHARS = 4
+MIN_TRUNCATED_TOKENS = 32
+SHINGLE_SIZE = 3
+
+
+def merge_overlapping(first: str, second: str) -> str:
+    prefix = second[:MIN_OVERLAP_CHARS]
+    position = first.find(prefix, max(len(first) - MAX_OVERLAP_CHARS, 0))
+    while len(prefix) == MIN_OVERLAP_CHARS and position >= 0:
+        if second.startswith(first[position:]):
+            return first + second[len(first) - position:]
+        position = first.find(prefix, position + 1)
+    return first + "\n" + second
+
+
+def _merge_adjacent(chunks: DataFrame) -> List[str]:
+    groups = {}
+    for (rank, (document, index, text)) in enumerate(zip(
+            chunks['document_hash'].values, chunks['chunk'].astype(int).values, chunks['text'].astype(str).values)):
+        groups.setdefault(document, []).append((index, rank, text))
+
+    passages = []
+    for parts in groups.values():
+        parts.sort()
+        index, rank, text = parts[0]
+        for (next_index, next_rank, next_text) in parts[1:]:
+            if next_index == index + 1:
+                text = merge_overlapping(text, next_text)
+                rank = min(rank, next_rank)
+            else:
+                passages.append((rank, text))
+                rank, text = next_rank, next_text
+            index = next_index
+        passages.append((rank, text))
+    return [text for (_, text) in sorted(passages, key=lambda passage: passage[0])]
+
+
+def _shingles(text: str) -> set:
+    words = text.lower().split()
+    return {tuple(words[i:i + SHINGLE_SIZE]) for i in range(max(len(words) - SHINGLE_SIZE + 1, 1))}
+
+
+def _drop_near_duplicates(passages: List[str], threshold: float) -> List[str]:
+    kept, kept_shingles = [], []
+    for passage in passages:
+        shingles = _shingles(passage)
+        # Containment rather than Jaccard, so a chunk already covered by a merged passage is dropped too
+        if any(len(shingles & other) >= threshold * len(shingles) for other in kept_shingles):
+            continue
+        kept.append(passage)
+        kept_shingles.append(shingles)
+    return kept
+
+
+def _fit_to_budget(passages: List[str], max_tokens: int) -> List[str]:
+    tokenizer = get_tokenizer()
+    fitted, used = [], 0
+    for (passage, tokens) in zip(passages, tokenizer.encode_ordinary_batch(passages)):
+        remaining = max_tokens - used - (1 if fitted else 0)
+        if len(tokens) <= remaining:
+            fitted.append(passage)
+            used += len(tokens) + (1 if len(fitted) > 1 else 0)
+        elif remaining >= MIN_TRUNCATED_TOKENS:
+            fitted.append(tokenizer.decode(tokens[:remaining]))
+            break
+        else:
+            break
+    return fitted
+
+
+def pack_context(
+    chunks: DataFrame,
+    max_tokens: Optional[int] = None,
+    dedup_threshold: float = DEFAULT_DEDUP_THRESHOLD,
+) -> str:
+    if chunks.empty:
+        return ""
+
+    if 'document_hash' in chunks and 'chunk' in chunks:
+        passages = _merge_adjacent(chunks)
+    else:
+        passages = chunks['text'].astype(str).tolist()
+    passages = _drop_near_duplicates(passages, dedup_threshold)
+    if max_tokens:
+        passages = _fit_to_budget(passages, max_tokens)
+
+    logger.debug(f"Packed {len(chunks)} chunks into {len(passages)} passages")
+    return "\n".join(passages)
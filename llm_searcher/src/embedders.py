@@ -1,29 +1,224 @@
+from .cache import LRUCache
+from .clients import get_client, get_async_client
+from . import metrics
+
 # from langchain_community.embeddings import GPT4AllEmbeddings, HuggingFaceEmbeddings
+import httpx
 import ollama
 # from sentence_transformers import SentenceTransformer
 from abc import ABC, abstractmethod
-from typing import Optional
+from typing import Iterator, List, Optional
+import asyncio
+import atexit
 import logging
+import threading
+import unicodedata
 
 
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_BATCH_SIZE = 32
+DEFAULT_MAX_CONCURRENT_REQUESTS = 4
+DEFAULT_RETRIES = 3
+DEFAULT_RETRY_BACKOFF_S = 0.5
+QUERY_CACHE_SAVE_EVERY = 32
+
+# The latest CachedEmbedder of each cache file saves it on exit, one exit hook per file
+_caches_to_save_on_exit = {}
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(unicodedata.normalize("NFC", query).split())
+
+
+def _save_cache_on_exit(cache_location: str) -> None:
+    _caches_to_save_on_exit[cache_location].save()
+
+
+def split_into_batches(items: list, batch_size: int) -> Iterator[list]:
+    for begin in range(0, len(items), max(batch_size, 1)):
+        yield items[begin:begin + batch_size]
+
+
 class Embedder(ABC):
+    batch_size: int = DEFAULT_BATCH_SIZE
+    max_concurrent_requests: int = 1
+    retries: int = 0
+    retry_backoff_s: float = DEFAULT_RETRY_BACKOFF_S
+
+    @property
+    def model_name(self) -> str:
+        return type(self).__name__
+
     @abstractmethod
     def embed_query(self, query: str) -> list:
         pass
 
+    def embed_documents(self, texts: List[str]) -> List[list]:
+        return [self.embed_query(text) for text in texts]
+
+    async def embed_query_async(self, query: str) -> list:
+        return await asyncio.to_thread(self.embed_query, query)
+
+    async def embed_documents_async(self, texts: List[str]) -> List[list]:
+        return await asyncio.to_thread(self.embed_documents, texts)
+
+    def is_transient_error(self, ex: Exception) -> bool:
+        return isinstance(ex, (ConnectionError, TimeoutError))
+
 class OllamaEmbedder(Embedder):
-    def __init__(self, hostname, model_name):
-        self.__client = ollama.Client(host=hostname)
+    def __init__(
+        self,
+        hostname,
+        model_name,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_REQUESTS,
+        retries: int = DEFAULT_RETRIES,
+        retry_backoff_s: float = DEFAULT_RETRY_BACKOFF_S,
+    ):
+        self.__hostname = hostname
+        self.__client = get_client(hostname)
         self.__model_name = model_name
+        self.batch_size = batch_size
+        self.max_concurrent_requests = max_concurrent_requests
+        self.retries = retries
+        self.retry_backoff_s = retry_backoff_s
+
+    @property
+    def model_name(self) -> str:
+        return self.__model_name
 
     def embed_query(self, query: str) -> list:
-        response = self.__client.embed(model=self.__model_name, input=query)
+        with metrics.span("embedding_request"):
+            response = self.__client.embed(model=self.__model_name, input=query)
         logger.debug(f"Got embedings response from ollama: {response}")
         return response["embeddings"][0]
 
+    def embed_documents(self, texts: List[str]) -> List[list]:
+        embeddings = []
+        for batch in split_into_batches(texts, self.batch_size):
+            with metrics.span("embedding_request"):
+                response = self.__client.embed(model=self.__model_name, input=batch)
+            logger.debug(f"Got {len(response['embeddings'])} embeddings from ollama for batch of {len(batch)}")
+            embeddings.extend(response["embeddings"])
+        return embeddings
+
+    async def embed_query_async(self, query: str) -> list:
+        with metrics.span("embedding_request"):
+            response = await get_async_client(self.__hostname).embed(model=self.__model_name, input=query)
+        return response["embeddings"][0]
+
+    async def embed_documents_async(self, texts: List[str]) -> List[list]:
+        semaphore = asyncio.Semaphore(max(self.max_concurrent_requests, 1))
+        responses = await asyncio.gather(*[
+            self.__embed_batch_async(semaphore, batch)
+            for batch in split_into_batches(texts, self.batch_size)
+        ])
+        return [embedding for response in responses for embedding in response["embeddings"]]
+
+    async def __embed_batch_async(self, semaphore: asyncio.Semaphore, batch: List[str]):
+        # Same retry policy as embed_with_retries, the backoff sleep releases the slot for other batches
+        client = get_async_client(self.__hostname)
+        for attempt in range(self.retries + 1):
+            try:
+                async with semaphore:
+                    with metrics.span("embedding_request"):
+                        return await client.embed(model=self.__model_name, input=batch)
+            except Exception as ex:
+                if attempt == self.retries or not self.is_transient_error(ex):
+                    raise
+                delay = self.retry_backoff_s * 2 ** attempt
+                logger.warning(f"Embedding request failed with {ex!r}, retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+
+    def is_transient_error(self, ex: Exception) -> bool:
+        if isinstance(ex, ollama.ResponseError):
+            return ex.status_code >= 500 or ex.status_code == 429
+        return isinstance(ex, httpx.TransportError) or super().is_transient_error(ex)
+
+class CachedEmbedder(Embedder):
+    def __init__(self, embedder: Embedder, cache: LRUCache, cache_location: Optional[str] = None):
+        self.__embedder = embedder
+        self.__cache = cache
+        self.__cache_location = cache_location
+        self.__unsaved = 0
+        self.__saving = False
+        self.__lock = threading.Lock()
+        self.__save_lock = threading.Lock()
+        self.batch_size = embedder.batch_size
+        self.max_concurrent_requests = embedder.max_concurrent_requests
+        self.retries = embedder.retries
+        self.retry_backoff_s = embedder.retry_backoff_s
+
+        if cache_location:
+            cache.load(cache_location)
+            if cache_location not in _caches_to_save_on_exit:
+                atexit.register(_save_cache_on_exit, cache_location)
+            _caches_to_save_on_exit[cache_location] = self
+
+    @property
+    def model_name(self) -> str:
+        return self.__embedder.model_name
+
+    @property
+    def cache(self) -> LRUCache:
+        return self.__cache
+
+    def embed_query(self, query: str) -> list:
+        key = (self.model_name, normalize_query(query))
+        embedding = self.__cache.get(key)
+        metrics.cache_lookup("query_embeddings", embedding is not None)
+        if embedding is None:
+            embedding = self.__embedder.embed_query(query)
+            self.__put(key, embedding)
+        return embedding
+
+    def embed_documents(self, texts: List[str]) -> List[list]:
+        return self.__embedder.embed_documents(texts)
+
+    async def embed_query_async(self, query: str) -> list:
+        key = (self.model_name, normalize_query(query))
+        embedding = self.__cache.get(key)
+        metrics.cache_lookup("query_embeddings", embedding is not None)
+        if embedding is None:
+            embedding = await self.__embedder.embed_query_async(query)
+            self.__put(key, embedding)
+        return embedding
+
+    async def embed_documents_async(self, texts: List[str]) -> List[list]:
+        return await self.__embedder.embed_documents_async(texts)
+
+    def __put(self, key: tuple, embedding: list) -> None:
+        self.__cache.put(key, list(embedding))
+        with self.__lock:
+            self.__unsaved += 1
+            if not self.__cache_location or self.__saving or self.__unsaved < QUERY_CACHE_SAVE_EVERY:
+                return
+            self.__saving = True
+        # Writing the whole cache is slow, so the query that filled it does not wait for it
+        threading.Thread(target=self.__save_in_background, name="query-cache-save", daemon=True).start()
+
+    def __save_in_background(self) -> None:
+        try:
+            self.save()
+        except Exception as ex:
+            logger.error(f"Failed to save query cache to {self.__cache_location}: {ex}")
+        finally:
+            with self.__lock:
+                self.__saving = False
+
+    def is_transient_error(self, ex: Exception) -> bool:
+        return self.__embedder.is_transient_error(ex)
+
+    def save(self) -> None:
+        with self.__save_lock:
+            with self.__lock:
+                if not self.__cache_location or not self.__unsaved:
+                    return
+                self.__unsaved = 0
+            self.__cache.save(self.__cache_location)
+
 # class GPT4AllEmbedder(Embedder):
 #     def __init__(self):
 #         self.__embedder = GPT4AllEmbeddings()
@@ -55,7 +250,14 @@ def get_embedder(embedder_name: Optional[str] = None, config: Optional[dict] = N
     }
     try:
         if embedder_name in ("ollama", None) and config:
-            return OllamaEmbedder(hostname=config["embedder_hostname"], model_name=config["embedder_model_name"])
+            return OllamaEmbedder(
+                hostname=config["embedder_hostname"],
+                model_name=config["embedder_model_name"],
+                batch_size=config.get("embedder_batch_size", DEFAULT_BATCH_SIZE),
+                max_concurrent_requests=config.get("max_concurrent_embedding_requests", DEFAULT_MAX_CONCURRENT_REQUESTS),
+                retries=config.get("embedding_retries", DEFAULT_RETRIES),
+                retry_backoff_s=config.get("embedding_retry_backoff_s", DEFAULT_RETRY_BACKOFF_S),
+            )
         embedder = embedders.get(embedder_name, lambda: None)()
 
         if embedder is None:
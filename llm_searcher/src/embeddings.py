@@ -1,57 +1,205 @@
 from .embedders import Embedder
+from .EmbeddingStore import EmbeddingStore, text_hash, CHUNK_COLUMNS
+from .chunking import ChunkCache, split_markdown, chunk_texts
 
-from pandas import read_csv, DataFrame
-from langchain.text_splitter import CharacterTextSplitter
+from pandas import read_csv, DataFrame, concat
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from typing import Iterable, Iterator, List, Optional, Tuple
+import numpy as np
 import logging
+import time
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
 
-def create_embeddings(data: DataFrame | str, embedder: Embedder, max_tokens: int = 512) -> DataFrame:
-    data_path = None
-    if isinstance(data, str):
-        data_path = data
-        data = read_csv(data)
+CHUNK_OVERLAP = 5
+
+
+def normalize_embeddings(embeddings) -> np.ndarray:
+    matrix = np.ascontiguousarray(embeddings, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def embed_with_retries(embedder: Embedder, texts: List[str]) -> List[list]:
+    for attempt in range(embedder.retries + 1):
+        try:
+            return embedder.embed_documents(texts)
+        except Exception as ex:
+            if attempt == embedder.retries or not embedder.is_transient_error(ex):
+                raise
+            delay = embedder.retry_backoff_s * 2 ** attempt
+            logger.warning(f"Embedding request failed with {ex!r}, retrying in {delay:.1f}s")
+            time.sleep(delay)
+
+
+def embed_batches(batches: Iterable[Tuple[list, List[str]]], embedder: Embedder) -> Iterator[Tuple[list, List[list]]]:
+    max_in_flight = max(embedder.max_concurrent_requests, 1)
+    begin = time.time()
+    num_of_chunks = 0
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor, \
+            tqdm(desc="Embedding chunks", unit="chunk") as progress:
+        in_flight = deque()
+
+        def finish_oldest():
+            keys, future = in_flight.popleft()
+            embeddings = future.result()
+            progress.update(len(keys))
+            return keys, embeddings
+
+        for (keys, texts) in batches:
+            in_flight.append((keys, executor.submit(embed_with_retries, embedder, texts)))
+            num_of_chunks += len(keys)
+            if len(in_flight) >= max_in_flight:
+                yield finish_oldest()
+
+        while in_flight:
+            yield finish_oldest()
+
+    elapsed = time.time() - begin
+    if num_of_chunks:
+        logger.info(
+            f"Embedded {num_of_chunks} chunks in {elapsed:.2f}s ({num_of_chunks / max(elapsed, 1e-9):.1f} chunks/s)"
+        )
+
+
+def iter_documents(data: DataFrame) -> Iterator[Tuple[str, str]]:
+    for (name, texts) in data.groupby('name', sort=False, dropna=False)['text']:
+        yield name, ''.join(texts.astype(str))
 
-    names_with_text = {}
 
-    for idx in data.index:
-        name = data['name'][idx]
-        text = data['text'][idx]
+def _split_documents(
+    data: DataFrame | Iterable[Tuple[str, str]],
+    embedder: Embedder,
+    max_tokens: int,
+    store: Optional[EmbeddingStore],
+    chunk_cache: Optional[ChunkCache],
+) -> Tuple[DataFrame, list, dict]:
+    documents = iter_documents(data) if isinstance(data, DataFrame) else data
+    chunk_cache = chunk_cache or ChunkCache(None, max_tokens, CHUNK_OVERLAP)
 
-        if name not in names_with_text:
-            names_with_text[name] = [text]
-        else:
-            names_with_text[name].append(text)
+    split_stats = {"documents": 0, "characters": 0, "seconds": 0.0}
 
-    text_splitter = CharacterTextSplitter.from_tiktoken_encoder(
-                        chunk_size=max_tokens, chunk_overlap=5, separator=' ',
-                    )
+    def split_text(document_hash: str, text: str) -> List[str]:
+        boundaries = chunk_cache.get(document_hash)
+        if boundaries is None:
+            begin = time.perf_counter()
+            boundaries = split_markdown(text, max_tokens, CHUNK_OVERLAP)
+            split_stats["seconds"] += time.perf_counter() - begin
+            split_stats["documents"] += 1
+            split_stats["characters"] += len(text)
+            chunk_cache.put(document_hash, boundaries)
+        return chunk_texts(text, boundaries)
 
-    for (name, text) in names_with_text.items():
-        names_with_text[name] = text_splitter.split_text(''.join(text))
+    result_data = {column: [] for column in CHUNK_COLUMNS}
+    stored_rows = []
 
-    result_data = {
-        'name' : [],
-        'text' : [],
-        'embedding' : [],
-        'chunk' : [],
-    }
+    def split_into_batches():
+        pending_rows, pending_chunks = [], []
+        for (name, text) in documents:
+            document_hash = text_hash(text)
+
+            stored_chunks = store.find_document(document_hash) if store is not None else None
+            if stored_chunks is not None:
+                chunks = store.chunks['text'].values[stored_chunks]
+            else:
+                chunks = split_text(document_hash, text)
+
+            for (index, chunk) in enumerate(chunks):
+                chunk_hash = text_hash(chunk)
+
+                result_data['name'].append(name)
+                result_data['chunk'].append(index)
+                result_data['text'].append(chunk)
+                result_data['text_hash'].append(chunk_hash)
+                result_data['document_hash'].append(document_hash)
+
+                stored_row = store.find_text(chunk_hash) if store is not None else None
+                if stored_row is None:
+                    pending_rows.append(len(stored_rows))
+                    pending_chunks.append(chunk)
+                    if len(pending_chunks) >= embedder.batch_size:
+                        yield pending_rows, pending_chunks
+                        pending_rows, pending_chunks = [], []
+                stored_rows.append(stored_row)
+
+        if pending_chunks:
+            yield pending_rows, pending_chunks
 
     logger.info("Creating embeddings")
-    for (name, text) in names_with_text.items():
-        for (index, chunk) in enumerate(text):
+    new_embeddings = {}
+    for (rows, embeddings) in embed_batches(split_into_batches(), embedder):
+        new_embeddings.update(zip(rows, embeddings))
+
+    if split_stats["documents"]:
+        logger.info(
+            f"Split {split_stats['documents']} documents in {split_stats['seconds']:.2f}s "
+            f"({split_stats['characters'] / max(split_stats['seconds'], 1e-9) / 2 ** 20:.2f} MiB/s)"
+        )
+    logger.info(f"Embedded {len(new_embeddings)} new chunks, reused {len(stored_rows) - len(new_embeddings)} stored")
+    return DataFrame(result_data), stored_rows, new_embeddings
+
+
+def _collect_embeddings(stored_rows: list, new_embeddings: dict, store: Optional[EmbeddingStore]) -> np.ndarray:
+    embeddings = None
+    for (row, stored_row) in enumerate(stored_rows):
+        embedding = store.embeddings[stored_row] if stored_row is not None else normalize_embeddings(new_embeddings[row])
+        if embeddings is None:
+            embeddings = np.empty((len(stored_rows), len(embedding)), dtype=np.float32)
+        embeddings[row] = embedding
+    if embeddings is None:
+        embeddings = np.empty((0, 0), dtype=np.float32)
+    return embeddings
+
+
+def create_embeddings(
+    data: DataFrame | Iterable[Tuple[str, str]] | str,
+    embedder: Embedder,
+    max_tokens: int = 512,
+    store: Optional[EmbeddingStore] = None,
+    keep_documents: Optional[set] = None,
+    chunk_cache: Optional[ChunkCache] = None,
+) -> Tuple[DataFrame, np.ndarray]:
+    if isinstance(data, str):
+        data = read_csv(data, keep_default_na=False)
+
+    chunks, stored_rows, new_embeddings = _split_documents(data, embedder, max_tokens, store, chunk_cache)
+
+    if store is not None and keep_documents:
+        kept_rows = []
+        for document_hash in keep_documents - set(chunks['document_hash'].values):
+            rows = store.find_document(document_hash)
+            if rows is not None:
+                kept_rows.extend(rows.tolist())
+        if kept_rows:
+            kept_rows.sort()
+            chunks = concat([chunks, store.chunks.iloc[kept_rows]], ignore_index=True)
+            stored_rows.extend(kept_rows)
 
-            result_data['name'].append(name)
-            result_data['text'].append(chunk)
-            result_data['chunk'].append(index)
+    if store is not None and not new_embeddings and stored_rows == list(range(len(store))):
+        return store.chunks, store.embeddings
 
-            embedding = embedder.embed_query(chunk)
-            result_data['embedding'].append(embedding)
+    embeddings = _collect_embeddings(stored_rows, new_embeddings, store)
+    if store is not None:
+        store.replace(chunks, embeddings)
+        return store.chunks, store.embeddings
+    return chunks, embeddings
 
-    data = DataFrame(result_data)
-    if data_path is not None:
-        data.to_csv(data_path)
 
-    return data
+def append_embeddings(
+    data: DataFrame | Iterable[Tuple[str, str]],
+    embedder: Embedder,
+    max_tokens: int = 512,
+    store: Optional[EmbeddingStore] = None,
+    sources: Optional[dict] = None,
+    chunk_cache: Optional[ChunkCache] = None,
+) -> Tuple[DataFrame, np.ndarray]:
+    chunks, stored_rows, new_embeddings = _split_documents(data, embedder, max_tokens, store, chunk_cache)
+    embeddings = _collect_embeddings(stored_rows, new_embeddings, store)
+    if store is not None:
+        store.append(chunks, embeddings, sources=sources)
+    return chunks, embeddings
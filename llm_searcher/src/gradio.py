@@ -1,39 +1,69 @@
-from .search import Searcher
+from .search import AsyncSearcher
+from .SearcherRegistry import SearcherRegistry, DEFAULT_MEMORY_BUDGET_MB
+from . import metrics
 
 import gradio as gr
+import asyncio
+import json
 import logging
 from pathlib import Path
+from typing import AsyncIterator, List, Optional, Tuple
 
 logger = logging.getLogger(__name__)
 
 
+DEFAULT_MAX_CONCURRENT_SESSIONS = 64
+
 HELP_MESSAGE = (
     "This chat bot supports commands:\n"
     "\thelp - view this message\n"
     "\tchange_config <config name> - change config for chat bot\n"
+    "\tstats - view cache hit and miss counters\n"
+    "\tmetrics - view stage timings and token counters in Prometheus text format\n"
 )
 
 
 class SearcherForGradio:
     def __init__(self, config: dict, searcher_name: str):
-        self.__config = config
-        self.__searcher = None
+        self.__default_searcher_name = searcher_name
+        self.__registry = SearcherRegistry(
+            config,
+            memory_budget_mb=config.get(searcher_name, {}).get("searcher_cache_memory_mb", DEFAULT_MEMORY_BUDGET_MB),
+        )
         self.change_searcher(searcher_name)
 
-    def change_searcher(self, searcher_name: str):
+    @property
+    def default_searcher_name(self) -> str:
+        return self.__default_searcher_name
+
+    def change_searcher(self, searcher_name: str) -> bool:
         try:
-            searcher_config = self.__config[searcher_name]
+            self.get_searcher(searcher_name)
         except Exception:
             logger.error(f"Could not load searcher config {searcher_name}")
-            return
+            return False
+        return True
+
+    def get_searcher(self, searcher_name: Optional[str] = None) -> AsyncSearcher:
+        return self.__registry.get(searcher_name or self.__default_searcher_name)
+
+    def ask_question(self, query: str, searcher_name: Optional[str] = None) -> str:
+        return self.get_searcher(searcher_name).ask_question(query)
+
+    async def ask_question_stream(self, query: str, searcher_name: Optional[str] = None) -> AsyncIterator[str]:
+        # An evicted searcher is rebuilt on its next use, which must not block the other sessions
+        searcher = await asyncio.to_thread(self.get_searcher, searcher_name)
+        async for token in searcher.ask_question_stream_async(query):
+            yield token
 
-        self.__searcher =  Searcher(searcher_config)
+    def add_document(self, document_path: str, searcher_name: Optional[str] = None) -> None:
+        self.get_searcher(searcher_name).add_document(Path(document_path))
 
-    def ask_question(self, query: str) -> str:
-        return self.__searcher.ask_question(query)
+    def cache_stats(self, searcher_name: Optional[str] = None) -> dict:
+        return dict(self.get_searcher(searcher_name).cache_stats(), registry=self.__registry.stats())
 
-    def add_document(self, document_path: str) -> None:
-        self.__searcher.add_document(Path(document_path))
+    def add_documents(self, document_paths: List[str], searcher_name: Optional[str] = None) -> None:
+        self.get_searcher(searcher_name).add_documents([Path(path) for path in document_paths])
 
 
 class StopServerException(Exception):
@@ -43,30 +73,54 @@ class GradioLLMSearcher:
     def __init__(self, config: dict, searcher_name: str) -> None:
         self.__searcher = SearcherForGradio(config, searcher_name)
 
-    def __call__(self, query: str, history) -> str:
+    @property
+    def default_searcher_name(self) -> str:
+        return self.__searcher.default_searcher_name
+
+    async def __call__(self, query: str, history, searcher_name: str) -> AsyncIterator[Tuple[list, str]]:
         command = query.strip().split()[0].lower()
 
         if command == "change_config":
-            searcher_name = query.strip().split()[1]
-            return self.__searcher.change_searcher(searcher_name)
+            new_searcher_name = query.strip().split()[1]
+            if await asyncio.to_thread(self.__searcher.change_searcher, new_searcher_name):
+                searcher_name = new_searcher_name
+                history.append((query, f"Switched to {searcher_name}"))
+            else:
+                history.append((query, f"Could not load config {new_searcher_name}"))
+            yield history, searcher_name
+            return
         if command == "help":
-            return HELP_MESSAGE
+            history.append((query, HELP_MESSAGE))
+            yield history, searcher_name
+            return
+        if command == "stats":
+            history.append((query, json.dumps(await asyncio.to_thread(self.__searcher.cache_stats, searcher_name))))
+            yield history, searcher_name
+            return
+        if command == "metrics":
+            history.append((query, metrics.export_prometheus()))
+            yield history, searcher_name
+            return
         if command == "exit":
             raise StopServerException()
 
-        answer = self.__searcher.ask_question(query)
+        answer = ""
         history.append((query, answer))
-        return history
+        async for token in self.__searcher.ask_question_stream(query, searcher_name):
+            answer += token
+            history[-1] = (query, answer)
+            yield history, searcher_name
 
-    def add_document(self, files):
+    async def add_document(self, files, searcher_name: str):
         if isinstance(files, str):
             files = [files]
-        for file in files:
-            self.__searcher.add_document(file)
+        await asyncio.to_thread(self.__searcher.add_documents, files, searcher_name)
 
 def gradio_main(config: dict, searcher_name: str, publish_link_to_web: bool = False):
+    metrics.enable(config.get(searcher_name, {}).get("metrics", False))
     searcher = GradioLLMSearcher(config, searcher_name)
     with gr.Blocks() as demo:
+        session = gr.State(searcher.default_searcher_name)
         chatbot = gr.Chatbot(label='Виртуальный ассистент')
         msg = gr.Textbox(scale=1)
         with gr.Row():
@@ -74,8 +128,11 @@ def gradio_main(config: dict, searcher_name: str, publish_link_to_web: bool = Fa
         with gr.Row():
             file = gr.File()
             upload = gr.UploadButton("Click to upload a document")
-            upload.upload(lambda paths: searcher.add_document(paths), upload, file)
-        msg.submit(searcher, [msg, chatbot], [chatbot])
+            upload.upload(searcher.add_document, [upload, session], file)
+        msg.submit(searcher.__call__, [msg, chatbot, session], [chatbot, session])
+        demo.queue(default_concurrency_limit=config.get(searcher_name, {}).get(
+            "max_concurrent_sessions", DEFAULT_MAX_CONCURRENT_SESSIONS,
+        ))
         try:
             if publish_link_to_web:
                 demo.launch(share=True)
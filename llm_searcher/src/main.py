@@ -1,16 +1,43 @@
-from .search import Searcher
+from .search import Searcher, build_retriever, snapshot_metadata, num_of_shards, load_shard_retriever
+from .IndexSnapshot import write_snapshot, DEFAULT_SNAPSHOTS_TO_KEEP
+from .ShardedRetriever import partition, shard_location, shard_of
+from .ShardServer import ShardServer, bind_address
+from .VectorIndex import create_vector_index
+from . import metrics
 
-from typing import Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Optional, Tuple
+import os
 import sys
 import time
 import json
 import logging
 
+import numpy as np
+
 logger = logging.getLogger(__name__)
 
 
+def read_answered_questions(path: str) -> set:
+    answered = set()
+    if not os.path.exists(path):
+        return answered
+    with open(path, "r", encoding="utf8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+                answered.add((record["index"], record["question"]))
+            except Exception:
+                logger.warning(f"Skipping malformed line in {path}: {line!r}")
+    return answered
+
+
 def ask_question_from_file(
-    searcher: Searcher, path: str, outstream: Callable[[str], None] = sys.stdout.write
+    searcher: Searcher,
+    path: str,
+    outstream: Callable[[str], None] = sys.stdout.write,
+    output_path: Optional[str] = None,
+    max_concurrent_questions: int = 1,
 ):
     questions = None
     try:
@@ -18,20 +45,116 @@ def ask_question_from_file(
             questions = json.load(f)["questions"]
     except Exception as ex:
         logger.error(f"Failed while loading questions. Reading from stdin: {ex}. ")
-    else:
-        for question in questions:
-            begining = time.time()
-            res = searcher.ask_question(question)
-            end = time.time()
-            d = json.dumps(
-                {
+        return
+
+    # An edited questions file shifts indexes, so an answer only counts for the same question at the same index
+    answered = read_answered_questions(output_path) if output_path else set()
+    pending = [(index, question) for (index, question) in enumerate(questions) if (index, question) not in answered]
+    logger.info(f"Answering {len(pending)} questions, {len(questions) - len(pending)} already answered")
+    if not pending:
+        return
+
+    # Questions share one embedding request and one search, each record carries the spans of that batch
+    with metrics.trace() as batch_trace:
+        contexts, batch_timings = searcher.retrieve_batch([question for (_, question) in pending])
+    logger.info(f"Retrieved contexts for {len(pending)} questions: {batch_timings}")
+
+    def answer(question: str, chunks) -> Tuple[str, float, dict]:
+        begining = time.time()
+        with metrics.trace() as trace:
+            res = searcher.answer(question, chunks)
+        return res, time.time() - begining, trace
+
+    output = open(output_path, "a", encoding="utf8") if output_path else None
+    try:
+        with ThreadPoolExecutor(max_workers=max(max_concurrent_questions, 1)) as executor:
+            futures = {
+                executor.submit(answer, question, chunks): (index, question)
+                for ((index, question), chunks) in zip(pending, contexts)
+            }
+            for future in as_completed(futures):
+                index, question = futures[future]
+                try:
+                    res, elapsed, answer_trace = future.result()
+                except Exception as ex:
+                    logger.error(f"Failed to answer question {index}: {ex}")
+                    continue
+                record = {
+                    "index": index,
                     "question": question,
                     "answer": res,
-                    "time_elapsed_s": (end - begining),
+                    "time_elapsed_s": elapsed,
+                    "timings": dict(batch_timings, llm_s=elapsed),
                 }
-            )
-            logger.info(f"Got answer to file: {d}")
-            outstream(d)
+                trace = metrics.merge_traces(batch_trace, answer_trace)
+                if trace:
+                    record["trace"] = trace
+                d = json.dumps(record)
+                logger.info(f"Got answer to file: {d}")
+                if output is not None:
+                    output.write(d + "\n")
+                    output.flush()
+                outstream(d + "\n")
+    finally:
+        if output is not None:
+            output.close()
+
+
+def build_index(config: dict, searcher_name: str) -> None:
+    searcher_config = config.get(searcher_name)
+    if not searcher_config:
+        raise RuntimeError(f"Could not load searcher config {searcher_name}")
+    location = searcher_config.get("snapshot_location")
+    if not location:
+        raise RuntimeError(f"Searcher config {searcher_name} has no snapshot_location")
+
+    begining = time.time()
+    retriever = build_retriever(searcher_config, use_snapshot=False)
+    if retriever is None:
+        raise RuntimeError(f"Searcher config {searcher_name} has no pdfs_location to build index from")
+
+    snapshot = retriever.snapshot
+    metadata = snapshot_metadata(retriever.embedder, searcher_config.get("max_num_of_tokens", 256))
+    keep = searcher_config.get("snapshots_to_keep", DEFAULT_SNAPSHOTS_TO_KEEP)
+    shards = num_of_shards(searcher_config)
+    if shards <= 1:
+        path = write_snapshot(
+            location, snapshot.data, snapshot.vector_index, snapshot.lexical_index, retriever.sources, metadata, keep,
+        )
+        logger.info(f"Built index snapshot {path} in {time.time() - begining:.1f}s")
+        print(path)
+        return
+
+    shard_config = dict(searcher_config, retrieval="vector")
+    for (shard, rows) in enumerate(partition(snapshot.data, shards)):
+        sources = {
+            source_hash: source for (source_hash, source) in retriever.sources.items()
+            if shard_of(source["document_hash"], shards) == shard
+        }
+        path = write_snapshot(
+            shard_location(location, shard),
+            snapshot.data.iloc[rows],
+            create_vector_index(np.asarray(snapshot.vector_index.embeddings[rows]), shard_config),
+            None,
+            sources,
+            metadata,
+            keep,
+        )
+        logger.info(f"Built snapshot of shard {shard} with {len(rows)} chunks at {path}")
+        print(path)
+    logger.info(f"Built {shards} index shards in {time.time() - begining:.1f}s")
+
+
+def serve_shard(config: dict, searcher_name: str, shard: Optional[int]) -> None:
+    searcher_config = config.get(searcher_name)
+    if not searcher_config:
+        raise RuntimeError(f"Could not load searcher config {searcher_name}")
+    urls = searcher_config.get("shard_urls") or []
+    if shard is None or not 0 <= shard < len(urls):
+        raise RuntimeError(f"Shard must be one of 0..{len(urls) - 1} of shard_urls in {searcher_name}, got {shard}")
+
+    host, port = bind_address(urls[shard])
+    ShardServer(load_shard_retriever(searcher_config, shard), host, port).serve_forever()
 
 
 def main(config: dict, searcher_name: str) -> None:
@@ -40,14 +163,25 @@ def main(config: dict, searcher_name: str) -> None:
     if not searcher_config:
         logger.error("Could not load searcher config")
 
+    metrics.enable(searcher_config.get("metrics", False))
+    metrics_output = searcher_config.get("metrics_output")
     searcher = Searcher(searcher_config)
 
     path_to_questions = searcher_config.get("questions")
     if path_to_questions:
-        ask_question_from_file(searcher, path_to_questions)
+        ask_question_from_file(
+            searcher,
+            path_to_questions,
+            output_path=searcher_config.get("questions_output"),
+            max_concurrent_questions=searcher_config.get("max_concurrent_questions", 1),
+        )
+        if metrics_output:
+            metrics.write_prometheus(metrics_output)
 
     question = input("Your questions:\n")
     while question.upper() != "EXIT":
         res = searcher.ask_question(question)
         print(res)
+        if metrics_output:
+            metrics.write_prometheus(metrics_output)
         question = input()
@@ -0,0 +1,163 @@
+from bisect import bisect_left
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator
+import logging
+import os
+import threading
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+METRIC_PREFIX = "llm_searcher"
+STAGE_BUCKETS_S = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}
+_stages = {}
+_trace = ContextVar("trace", default=None)
+
+
+def enable(enabled: bool = True) -> None:
+    global _enabled
+    _enabled = enabled
+    logger.info(f"Metrics {'enabled' if enabled else 'disabled'}")
+
+
+def is_enabled() -> bool:
+    return _enabled
+
+
+def reset() -> None:
+    with _lock:
+        _counters.clear()
+        _stages.clear()
+
+
+class _NullSpan:
+    def __enter__(self) -> "_NullSpan":
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ("name", "begin")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> "_Span":
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> bool:
+        record(self.name, time.perf_counter() - self.begin)
+        return False
+
+
+def span(name: str):
+    return _Span(name) if _enabled else _NULL_SPAN
+
+
+def record(stage: str, seconds: float) -> None:
+    if not _enabled:
+        return
+    with _lock:
+        histogram = _stages.get(stage)
+        if histogram is None:
+            histogram = _stages[stage] = [[0] * (len(STAGE_BUCKETS_S) + 1), 0.0]
+        histogram[0][bisect_left(STAGE_BUCKETS_S, seconds)] += 1
+        histogram[1] += seconds
+    trace = _trace.get()
+    if trace is not None:
+        trace["spans"][stage] = trace["spans"].get(stage, 0.0) + seconds
+
+
+def count(name: str, value: float = 1, **labels) -> None:
+    if not _enabled:
+        return
+    key = (name, tuple(sorted(labels.items())))
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+    trace = _trace.get()
+    if trace is not None:
+        trace_key = ".".join([name, *(str(label) for (_, label) in key[1])])
+        trace["counts"][trace_key] = trace["counts"].get(trace_key, 0) + value
+
+
+def cache_lookup(cache: str, hit: bool) -> None:
+    count("cache_hits" if hit else "cache_misses", cache=cache)
+
+
+@contextmanager
+def trace() -> Iterator[dict]:
+    if not _enabled:
+        yield {}
+        return
+    current = {"spans": {}, "counts": {}}
+    token = _trace.set(current)
+    try:
+        yield current
+    finally:
+        _trace.reset(token)
+
+
+def merge_traces(*traces: dict) -> dict:
+    merged = {}
+    for trace in traces:
+        for (kind, values) in trace.items():
+            totals = merged.setdefault(kind, {})
+            for (name, value) in values.items():
+                totals[name] = totals.get(name, 0) + value
+    return merged
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(labels) -> str:
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for (key, value) in labels) + "}"
+
+
+def export_prometheus() -> str:
+    with _lock:
+        counters = dict(_counters)
+        stages = {stage: (list(buckets), total) for (stage, (buckets, total)) in _stages.items()}
+
+    lines = []
+    if stages:
+        name = f"{METRIC_PREFIX}_stage_seconds"
+        lines.append(f"# HELP {name} Time spent in each question answering stage")
+        lines.append(f"# TYPE {name} histogram")
+        for (stage, (buckets, total)) in sorted(stages.items()):
+            cumulative = 0
+            for (bound, bucket) in zip(STAGE_BUCKETS_S + (float("inf"),), buckets):
+                cumulative += bucket
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_labels([('stage', stage), ('le', le)])} {cumulative}")
+            lines.append(f"{name}_sum{_labels([('stage', stage)])} {total}")
+            lines.append(f"{name}_count{_labels([('stage', stage)])} {cumulative}")
+
+    previous = None
+    for ((counter, labels), value) in sorted(counters.items()):
+        name = f"{METRIC_PREFIX}_{counter}_total"
+        if counter != previous:
+            lines.append(f"# TYPE {name} counter")
+            previous = counter
+        lines.append(f"{name}{_labels(labels) if labels else ''} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus(path: str) -> None:
+    with open(f"{path}.tmp", 'w', encoding='utf8') as file:
+        file.write(export_prometheus())
+    os.replace(f"{path}.tmp", path)
@@ -0,0 +1,149 @@
+from .embedders import split_into_batches
+
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor, wait
+from pandas import DataFrame
+from typing import List, Optional, Tuple
+import numpy as np
+import json
+import logging
+import time
+
+import ollama
+
+
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_RERANK_CANDIDATES = 20
+DEFAULT_RERANK_BATCH_SIZE = 8
+DEFAULT_RERANK_TIMEOUT_S = 10.0
+DEFAULT_MAX_CONCURRENT_RERANK_REQUESTS = 4
+DEFAULT_CROSS_ENCODER_MODEL_NAME = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+
+RERANK_PROMPT = (
+    "Rate how useful each passage is for answering the query, from 0 (unrelated) to 10 (answers it directly).\n"
+    "Reply with JSON of the form {{\"scores\": [...]}} containing exactly {count} numbers, one per passage, in order.\n"
+    "QUERY: {query}\n"
+    "{passages}"
+)
+
+
+class Reranker(ABC):
+    def __init__(self, batch_size: int, max_concurrent_requests: int, timeout_s: float):
+        self.batch_size = batch_size
+        self.timeout_s = timeout_s
+        self.__executor = ThreadPoolExecutor(max_workers=max(max_concurrent_requests, 1))
+
+    @abstractmethod
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        pass
+
+    def batches(self, texts: List[str]) -> List[List[str]]:
+        return list(split_into_batches(texts, self.batch_size))
+
+    def rerank(self, query: str, chunks: DataFrame, k: int) -> Tuple[DataFrame, float]:
+        begin = time.perf_counter()
+        texts = chunks['text'].astype(str).tolist()
+        if len(texts) <= 1:
+            return chunks.iloc[:k], 0.0
+
+        batches = self.batches(texts)
+        futures = [self.__executor.submit(self.score, query, batch) for batch in batches]
+        done, not_done = wait(futures, timeout=self.timeout_s)
+        # Only queued batches can be cancelled, running ones end with the client timeout
+        for future in not_done:
+            future.cancel()
+
+        # Passages whose batch timed out or failed keep their retrieval order behind the reranked ones
+        scores = np.full(len(texts), -np.inf)
+        offset = 0
+        for (batch, future) in zip(batches, futures):
+            if future in done:
+                try:
+                    scores[offset:offset + len(batch)] = future.result()
+                except Exception as ex:
+                    logger.warning(f"Reranking batch failed with {ex!r}, keeping retrieval order")
+            offset += len(batch)
+
+        elapsed = time.perf_counter() - begin
+        if not_done:
+            logger.warning(f"Reranking timed out after {elapsed:.2f}s, {len(not_done)} of {len(futures)} batches unscored")
+        order = np.argsort(-scores, kind='stable')[:k]
+        return chunks.iloc[order], elapsed
+
+
+class OllamaReranker(Reranker):
+    def __init__(
+        self,
+        hostname: str,
+        model_name: str,
+        batch_size: int = DEFAULT_RERANK_BATCH_SIZE,
+        max_concurrent_requests: int = DEFAULT_MAX_CONCURRENT_RERANK_REQUESTS,
+        timeout_s: float = DEFAULT_RERANK_TIMEOUT_S,
+    ):
+        super().__init__(batch_size, max_concurrent_requests, timeout_s)
+        # A hung request must release its pool thread, so this client does not share the chat client without timeout
+        self.__client = ollama.Client(host=hostname, timeout=timeout_s)
+        self.__model_name = model_name
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        passages = "\n".join(f"PASSAGE {i + 1}: {' '.join(text.split())}" for (i, text) in enumerate(texts))
+        response = self.__client.generate(
+            model=self.__model_name,
+            prompt=RERANK_PROMPT.format(count=len(texts), query=query, passages=passages),
+            format="json",
+            options={"temperature": 0},
+        )
+        scores = json.loads(response["response"])["scores"]
+        if len(scores) != len(texts):
+            raise RuntimeError(f"Reranker returned {len(scores)} scores for {len(texts)} passages")
+        return [float(score) for score in scores]
+
+
+class CrossEncoderReranker(Reranker):
+    def __init__(
+        self,
+        model_name: str = DEFAULT_CROSS_ENCODER_MODEL_NAME,
+        batch_size: int = DEFAULT_RERANK_BATCH_SIZE,
+        timeout_s: float = DEFAULT_RERANK_TIMEOUT_S,
+    ):
+        from sentence_transformers import CrossEncoder
+
+        super().__init__(batch_size, 1, timeout_s)
+        self.__model = CrossEncoder(model_name)
+
+    def batches(self, texts: List[str]) -> List[List[str]]:
+        return [texts]
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        return self.__model.predict(
+            [(query, text) for text in texts], batch_size=self.batch_size, show_progress_bar=False,
+        ).tolist()
+
+
+def get_reranker(reranker_name: Optional[str], config: dict) -> Optional[Reranker]:
+    if not reranker_name:
+        return None
+
+    try:
+        if reranker_name == "ollama":
+            return OllamaReranker(
+                hostname=config.get("reranker_hostname") or config["model_host"],
+                model_name=config.get("reranker_model_name") or config["model_name"],
+                batch_size=config.get("rerank_batch_size", DEFAULT_RERANK_BATCH_SIZE),
+                max_concurrent_requests=config.get(
+                    "max_concurrent_rerank_requests", DEFAULT_MAX_CONCURRENT_RERANK_REQUESTS,
+                ),
+                timeout_s=config.get("rerank_timeout_s", DEFAULT_RERANK_TIMEOUT_S),
+            )
+        if reranker_name == "cross_encoder":
+            return CrossEncoderReranker(
+                model_name=config.get("reranker_model_name") or DEFAULT_CROSS_ENCODER_MODEL_NAME,
+                batch_size=config.get("rerank_batch_size", DEFAULT_RERANK_BATCH_SIZE),
+                timeout_s=config.get("rerank_timeout_s", DEFAULT_RERANK_TIMEOUT_S),
+            )
+        raise RuntimeError(f"Failed to create reranker, name not found {reranker_name}")
+    except Exception as ex:
+        logger.error(f"Failed to created reranker {reranker_name}: {ex}")
+        raise
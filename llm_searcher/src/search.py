@@ -1,22 +1,62 @@
-from .embedders import get_embedder
-from .GigaChatWrapper import ChatWrapper
+from .embedders import get_embedder, CachedEmbedder, normalize_query
+from .cache import LRUCache
 from .OllamaWrapper import OllamaWrapper
-from .PdfReader import load_pdfs
+from .PdfReader import stream_pdfs, DEFAULT_PARSE_TIMEOUT_S
 from .MyRetriever import MyRetriever
+from .EmbeddingStore import EmbeddingStore, CHUNK_COLUMNS
+from .ShardedRetriever import (
+    ShardedRetriever, LocalShard, HttpShard, shard_location, DEFAULT_SHARD_TIMEOUT_S, DEFAULT_SHARD_RETRY_S,
+)
+from .IndexSnapshot import (
+    IndexSnapshot, load_latest_snapshot, DEFAULT_SNAPSHOT_POLL_INTERVAL_S,
+)
+from .embeddings import CHUNK_OVERLAP
+from .chunking import ChunkCache, CHUNKER_NAME
+from .rerankers import get_reranker, DEFAULT_RERANK_CANDIDATES
+from .context import pack_context, DEFAULT_DEDUP_THRESHOLD
+from . import metrics
 
-from pandas import read_csv, DataFrame
-from typing import Optional
+from pandas import DataFrame
+from typing import AsyncIterator, Callable, Iterator, List, Optional, Tuple
 from pathlib import Path
-from langchain_community.chat_models.gigachat import GigaChat
-from langchain.prompts.chat import ChatPromptTemplate
+import asyncio
+import json
 import logging
 import os.path
+import time
 
 
 logger = logging.getLogger(__name__)
 
 
 DEFAULT_DATABASE_LOCATION = "./data.csv"
+DEFAULT_QUERY_CACHE_SIZE = 1024
+DEFAULT_ANSWER_CACHE_SIZE = 256
+DEFAULT_ANSWER_CACHE_TTL_S = 3600
+
+
+def default_embedding_store_location(database_location: str) -> str:
+    return os.path.splitext(database_location)[0] + "_embeddings"
+
+
+def default_parse_cache_location(database_location: str) -> str:
+    return os.path.splitext(database_location)[0] + "_parsed"
+
+
+def default_chunk_cache_location(database_location: str) -> str:
+    return os.path.splitext(database_location)[0] + "_chunks"
+
+
+def log_stream_stats(begin: float, first_token_s: Optional[float], num_of_tokens: int) -> None:
+    elapsed = time.perf_counter() - begin
+    generation_s = elapsed - (first_token_s or 0)
+    logger.info(
+        f"Streamed {num_of_tokens} tokens in {elapsed:.2f}s, time to first token {first_token_s or 0:.2f}s, "
+        f"{num_of_tokens / max(generation_s, 1e-9):.1f} tokens/s"
+    )
+    metrics.record("generation", elapsed)
+    if first_token_s is not None:
+        metrics.record("time_to_first_token", first_token_s)
 
 
 def try_deco(func):
@@ -37,6 +77,9 @@ def create_chat_model(config: dict):
     model_type = config.get("model_type", "ollama")
 
     if model_type.lower() == "gigachat":
+        from langchain_community.chat_models.gigachat import GigaChat
+        from .GigaChatWrapper import ChatWrapper
+
         chat = GigaChat(model="GigaChat-Plus", credentials=config["credentials"], verify_ssl_certs=False)
         return ChatWrapper(chat, prompt_template=config.get("prompt_template"))
 
@@ -50,50 +93,367 @@ def create_chat_model(config: dict):
         raise RuntimeError(f"Got unexpected chat model type {model_type}")
 
 
-class Searcher:
-    def __init__(self, config: dict):
-        logging.info("Creating searcher")
-        self.__chat_model = create_chat_model(config)
-        self.__data = DataFrame()
+RETRIEVER_CONFIG_KEYS = (
+    "database_location",
+    "pdfs_location",
+    "parse_cache_location",
+    "pdf_parse_timeout_s",
+    "embedding_store_location",
+    "chunk_cache_location",
+    "embedder_name",
+    "embedder_hostname",
+    "embedder_model_name",
+    "max_num_of_tokens",
+    "vector_index",
+    "ivf_num_lists",
+    "ivf_num_probes",
+    "vector_quantization",
+    "rescore_factor",
+    "retrieval",
+    "hybrid_candidates",
+    "lexical_prefilter",
+    "snapshot_location",
+    "num_of_shards",
+    "shard_urls",
+)
+
+
+def retriever_key(config: dict) -> str:
+    return json.dumps({key: config.get(key) for key in RETRIEVER_CONFIG_KEYS}, sort_keys=True)
+
+
+def create_query_embedder(config: dict) -> CachedEmbedder:
+    return CachedEmbedder(
+        get_embedder(config.get("embedder_name"), config),
+        LRUCache(config.get("query_cache_size", DEFAULT_QUERY_CACHE_SIZE)),
+        config.get("query_cache_location"),
+    )
+
+
+def snapshot_metadata(embedder, max_tokens: int) -> dict:
+    return {
+        "embedder_model_name": embedder.model_name,
+        "chunker": CHUNKER_NAME,
+        "chunk_size": max_tokens,
+        "chunk_overlap": CHUNK_OVERLAP,
+    }
+
+
+def num_of_shards(config: dict) -> int:
+    return len(config.get("shard_urls") or []) or config.get("num_of_shards", 1)
+
 
-        database_path = config.get("database_location")
-        if database_path:
-            if os.path.exists(database_path):
-                self.__data = read_csv(config["database_location"])
-            else:
-                logger.warning("Database file not exists")
-                self.__data = DataFrame()
+def snapshot_loader(config: dict, location: str, embedder) -> Callable[[], Optional[IndexSnapshot]]:
+    expected = snapshot_metadata(embedder, config.get("max_num_of_tokens", 256))
+    verify = config.get("verify_snapshot_checksums", True)
+    return lambda: load_latest_snapshot(location, expected, verify)
 
-        if config.get("pdfs_location"):
-            self.__update_database(config)
 
-        if not config.get("pdfs_location") and not config.get("database_location"):
+def watch_snapshots(config: dict, location: str, retriever: MyRetriever) -> None:
+    poll_interval_s = config.get("snapshot_poll_interval_s", DEFAULT_SNAPSHOT_POLL_INTERVAL_S)
+    if poll_interval_s > 0:
+        retriever.watch_snapshots(location, snapshot_loader(config, location, retriever.embedder), poll_interval_s)
+
+
+def load_snapshot_retriever(config: dict, location: Optional[str] = None) -> Optional[MyRetriever]:
+    location = location or config["snapshot_location"]
+    embedder = create_query_embedder(config)
+    snapshot = snapshot_loader(config, location, embedder)()
+    if snapshot is None:
+        logger.warning(f"No snapshot found in {location}, building index from the corpus")
+        return None
+
+    retriever = MyRetriever.from_snapshot(snapshot, embedder, config.get("max_num_of_tokens", 256), index_config=config)
+    watch_snapshots(config, location, retriever)
+    return retriever
+
+
+def load_shard_retriever(config: dict, shard: int) -> MyRetriever:
+    # Scores of lexical ranks are not comparable between shards, so shards serve vector search only
+    retriever = load_snapshot_retriever(
+        dict(config, retrieval="vector"), shard_location(config["snapshot_location"], shard),
+    )
+    if retriever is None:
+        raise RuntimeError(f"No snapshot for shard {shard} in {config['snapshot_location']}, run --mode build-index")
+    return retriever
+
+
+def build_sharded_retriever(config: dict) -> ShardedRetriever:
+    if config.get("retrieval", "vector") != "vector":
+        logger.warning(f"Sharded retrieval serves vector search only, ignoring retrieval {config.get('retrieval')}")
+    timeout_s = config.get("shard_timeout_s", DEFAULT_SHARD_TIMEOUT_S)
+    if config.get("shard_urls"):
+        shards = [HttpShard(url, timeout_s) for url in config["shard_urls"]]
+    else:
+        shards = [
+            LocalShard(load_shard_retriever(config, shard), f"shard-{shard:03d}")
+            for shard in range(num_of_shards(config))
+        ]
+    return ShardedRetriever(
+        shards,
+        create_query_embedder(config),
+        timeout_s,
+        config.get("shard_retry_s", DEFAULT_SHARD_RETRY_S),
+    )
+
+
+def build_retriever(config: dict, use_snapshot: bool = True) -> Optional[MyRetriever]:
+    if use_snapshot and num_of_shards(config) > 1:
+        return build_sharded_retriever(config)
+
+    snapshot_location = config.get("snapshot_location") if use_snapshot else None
+    if snapshot_location:
+        retriever = load_snapshot_retriever(config)
+        if retriever is not None:
+            return retriever
+
+    retriever = build_corpus_retriever(config)
+    if snapshot_location:
+        # A server started before the first build-index run switches to the snapshot once it is written
+        if retriever is None:
+            retriever = MyRetriever(
+                DataFrame(columns=["name", "text"]), create_query_embedder(config),
+                config.get("max_num_of_tokens", 256), index_config=config,
+            )
+        watch_snapshots(config, snapshot_location, retriever)
+    return retriever
+
+
+def build_corpus_retriever(config: dict) -> Optional[MyRetriever]:
+    database_path = config.get("database_location")
+    if database_path and not os.path.exists(database_path):
+        logger.warning("Database file not exists")
+
+    if not config.get("pdfs_location"):
+        if not database_path:
             logger.warning("Database or pdfs locations not given. Chat model will answer only based on it knowledge")
+        return None
+
+    database_location = database_path or DEFAULT_DATABASE_LOCATION
+    parse_options = {
+        "timeout_s": config.get("pdf_parse_timeout_s", DEFAULT_PARSE_TIMEOUT_S),
+        "cache_location": config.get("parse_cache_location") or default_parse_cache_location(database_location),
+    }
+    # Documents are chunked and embedded while the rest of the folder is still being parsed
+    documents = stream_pdfs(config["pdfs_location"], database_location, **parse_options)
+    embedder = create_query_embedder(config)
+    max_tokens = config.get("max_num_of_tokens", 256)
+    store = EmbeddingStore(
+        config.get("embedding_store_location") or default_embedding_store_location(database_location),
+        embedder.model_name,
+        CHUNKER_NAME,
+        max_tokens,
+        CHUNK_OVERLAP,
+    )
+    chunk_cache = ChunkCache(
+        config.get("chunk_cache_location") or default_chunk_cache_location(database_location),
+        max_tokens,
+        CHUNK_OVERLAP,
+    )
+    return MyRetriever(documents,
+                       embedder,
+                       max_tokens,
+                       store=store,
+                       parse_options=parse_options,
+                       index_config=config,
+                       chunk_cache=chunk_cache)
 
-        self.__retriever.set_num_of_relevant_chunks(config.get("num_of_relevant_chunks", 2))
 
-    def __update_database(self, config: dict):
-        if config.get("pdfs_location"):
-            self.__data = load_pdfs(config["pdfs_location"], self.__data)
-        database_location = config.get("database_location") or DEFAULT_DATABASE_LOCATION
-        self.__data.to_csv(database_location)
-        embedder = get_embedder(config.get("embedder_name"), config)
-        retriever = MyRetriever(self.__data,
-                                embedder,
-                                config.get("max_num_of_tokens", 256))
-        self.__retriever = retriever
+class Searcher:
+    def __init__(self, config: dict, retriever: Optional[MyRetriever] = None, chat_model=None):
+        logging.info("Creating searcher")
+        self.__chat_model = chat_model if chat_model is not None else create_chat_model(config)
+        self.__prompt_template = config.get("prompt_template")
+        self.__num_of_relevant_chunks = config.get("num_of_relevant_chunks", 2)
+        self.__answer_cache = LRUCache(
+            config.get("answer_cache_size", DEFAULT_ANSWER_CACHE_SIZE),
+            ttl_s=config.get("answer_cache_ttl_s", DEFAULT_ANSWER_CACHE_TTL_S),
+        )
+        self.__retriever = retriever if retriever is not None else build_retriever(config)
+        self.__reranker = get_reranker(config.get("reranker"), config)
+        self.__num_of_candidates = self.__num_of_relevant_chunks
+        if self.__reranker is not None:
+            self.__num_of_candidates = max(
+                config.get("rerank_candidates", DEFAULT_RERANK_CANDIDATES), self.__num_of_relevant_chunks,
+            )
+        self.__context_max_tokens = config.get("context_max_tokens")
+        self.__context_dedup_threshold = config.get("context_dedup_threshold", DEFAULT_DEDUP_THRESHOLD)
 
     def add_document(self, path: Path) -> None:
-        self.__retriever.add_document(path)
+        self.add_documents([path])
 
-    def ask_question(self, question: str) -> str:
-        # try:
-        logger.info(f"Asking question: {question}")
-        context = self.__retriever.get_relevant_documents(question)
+    def add_documents(self, paths: List[Path]) -> None:
+        if self.__retriever is None:
+            raise RuntimeError("Searcher has no index to add documents to, set pdfs_location in its config")
+        self.__retriever.add_documents(paths)
+        self.__answer_cache.clear()
+
+    def cache_stats(self) -> dict:
+        if self.__retriever is None:
+            return {"answers": self.__answer_cache.stats}
+        return {
+            "query_embeddings": self.__retriever.embedder.cache.stats,
+            "answers": self.__answer_cache.stats,
+        }
+
+    def rerank(self, question: str, chunks: DataFrame) -> DataFrame:
+        if self.__reranker is None:
+            return chunks
+        with metrics.span("rerank"):
+            chunks, elapsed = self.__reranker.rerank(question, chunks, self.__num_of_relevant_chunks)
+        logger.info(f"Reranked {self.__num_of_candidates} candidates in {elapsed:.3f}s")
+        return chunks
+
+    def retrieve(self, question: str) -> DataFrame:
+        # Without any index configured the chat model answers from its own knowledge
+        if self.__retriever is None:
+            return DataFrame(columns=CHUNK_COLUMNS)
+        with metrics.span("retrieval"):
+            return self.rerank(question, self.__retriever.search(question, self.__num_of_candidates))
+
+    def retrieve_batch(self, questions: List[str]) -> Tuple[List[DataFrame], dict]:
+        if self.__retriever is None:
+            return [self.retrieve(question) for question in questions], {}
+        with metrics.span("retrieval"):
+            begin = time.perf_counter()
+            query_embeddings = self.__retriever.embed_queries(questions)
+            embedded = time.perf_counter()
+            chunks = self.__retriever.search_embeddings(query_embeddings, self.__num_of_candidates, questions)
+            retrieved = time.perf_counter()
+            chunks = [self.rerank(question, candidates) for (question, candidates) in zip(questions, chunks)]
+            end = time.perf_counter()
+        return chunks, {"embedding_s": embedded - begin, "retrieval_s": retrieved - embedded, "rerank_s": end - retrieved}
+
+    @property
+    def retriever(self) -> MyRetriever:
+        return self.__retriever
+
+    @property
+    def num_of_relevant_chunks(self) -> int:
+        return self.__num_of_relevant_chunks
+
+    @property
+    def num_of_candidates(self) -> int:
+        return self.__num_of_candidates
+
+    @property
+    def chat_model(self):
+        return self.__chat_model
+
+    def build_context(self, chunks: DataFrame) -> str:
+        with metrics.span("context_packing"):
+            context = pack_context(chunks, self.__context_max_tokens, self.__context_dedup_threshold)
         logger.debug(f"Got context: {context}")
-        result = self.__chat_model.ask_question(question, context)
+        return context
+
+    def cached_answer(self, question: str, chunks: DataFrame) -> Tuple[tuple, Optional[str]]:
+        key = (
+            self.__chat_model.model_name,
+            self.__prompt_template,
+            tuple(chunks['text_hash'].values),
+            normalize_query(question),
+        )
+        result = self.__answer_cache.get(key)
+        metrics.cache_lookup("answers", result is not None)
+        if result is not None:
+            logger.info(f"Got cached result: {result}")
+        return key, result
+
+    def cache_answer(self, key: tuple, result: str) -> None:
+        self.__answer_cache.put(key, result)
         logger.info(f"Got result: {result}")
+
+    def answer(self, question: str, chunks: DataFrame) -> str:
+        key, result = self.cached_answer(question, chunks)
+        if result is not None:
+            return result
+
+        context = self.build_context(chunks)
+        result = self.__chat_model.ask_question(question, context)
+        self.cache_answer(key, result)
         return result
+
+    def answer_stream(self, question: str, chunks: DataFrame) -> Iterator[str]:
+        key, result = self.cached_answer(question, chunks)
+        if result is not None:
+            yield result
+            return
+
+        context = self.build_context(chunks)
+
+        begin = time.perf_counter()
+        first_token_s = None
+        tokens = []
+        for token in self.__chat_model.ask_question_stream(question, context):
+            if first_token_s is None:
+                first_token_s = time.perf_counter() - begin
+            tokens.append(token)
+            yield token
+
+        log_stream_stats(begin, first_token_s, len(tokens))
+        self.cache_answer(key, "".join(tokens))
+
+    def ask_question_stream(self, question: str) -> Iterator[str]:
+        logger.info(f"Asking question: {question}")
+        return self.answer_stream(question, self.retrieve(question))
+
+    def ask_question(self, question: str) -> str:
+        # try:
+        logger.info(f"Asking question: {question}")
+        with metrics.span("question"):
+            return self.answer(question, self.retrieve(question))
         # except Exception as ex:
         #     logger.error(f"Asking question failed with: {ex}")
         #     return "Failed to answer question. See logs for details."
+
+
+class AsyncSearcher(Searcher):
+    async def retrieve_async(self, question: str) -> DataFrame:
+        if self.retriever is None:
+            return self.retrieve(question)
+        with metrics.span("retrieval"):
+            chunks = await self.retriever.search_async(question, self.num_of_candidates)
+            return await asyncio.to_thread(self.rerank, question, chunks)
+
+    async def answer_async(self, question: str, chunks: DataFrame) -> str:
+        key, result = self.cached_answer(question, chunks)
+        if result is not None:
+            return result
+
+        context = self.build_context(chunks)
+        result = await self.chat_model.ask_question_async(question, context)
+        self.cache_answer(key, result)
+        return result
+
+    async def answer_stream_async(self, question: str, chunks: DataFrame) -> AsyncIterator[str]:
+        key, result = self.cached_answer(question, chunks)
+        if result is not None:
+            yield result
+            return
+
+        context = self.build_context(chunks)
+
+        begin = time.perf_counter()
+        first_token_s = None
+        tokens = []
+        async for token in self.chat_model.ask_question_stream_async(question, context):
+            if first_token_s is None:
+                first_token_s = time.perf_counter() - begin
+            tokens.append(token)
+            yield token
+
+        log_stream_stats(begin, first_token_s, len(tokens))
+        self.cache_answer(key, "".join(tokens))
+
+    async def ask_question_async(self, question: str) -> str:
+        logger.info(f"Asking question: {question}")
+        with metrics.span("question"):
+            return await self.answer_async(question, await self.retrieve_async(question))
+
+    async def ask_question_stream_async(self, question: str) -> AsyncIterator[str]:
+        logger.info(f"Asking question: {question}")
+        async for token in self.answer_stream_async(question, await self.retrieve_async(question)):
+            yield token
+
+    async def add_documents_async(self, paths: List[Path]) -> None:
+        await asyncio.to_thread(self.add_documents, paths)
@@ -0,0 +1,40 @@
+from pathlib import Path
+from typing import List, Tuple
+import subprocess
+import sys
+
+
+MODE_MODULES = {
+    "stdio": "src.main",
+    "gradio": "src.gradio",
+    "build-index": "src.main",
+    "shard": "src.main",
+}
+PACKAGE_ROOT = Path(__file__).resolve().parent.parent
+
+
+def import_times(module: str) -> List[Tuple[str, float, float]]:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=PACKAGE_ROOT, capture_output=True, text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Failed to import {module}: {result.stderr.strip().splitlines()[-1:]}")
+
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "[us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        times.append((name.rstrip(), int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return times
+
+
+def profile_startup(mode: str, top: int = 25) -> str:
+    module = MODE_MODULES[mode]
+    times = import_times(module)
+    total = next((cumulative for (name, _, cumulative) in times if name.strip() == module), 0.0)
+    lines = [f"Importing {module} for --mode {mode} took {total:.3f}s", f"{'cumulative s':>12} {'self s':>8}  module"]
+    for (name, self_s, cumulative_s) in sorted(times, key=lambda item: -item[2])[:top]:
+        lines.append(f"{cumulative_s:12.3f} {self_s:8.3f}  {name}")
+    return "\n".join(lines)